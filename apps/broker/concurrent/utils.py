@@ -1,19 +1,86 @@
 import threading
+from enum import Enum
 
-#
-# class RWLock:
-#     def __init__(self):
-#         self.cond = threading.Condition()
-#         self.reads = 0
-#         self.writes = 0
-#
-#     def w_lock(self):
-#         with self.cond.acquire():
-#             while self.reads > 0:
-#                 self.cond.wait()
-#
-#     def w_release(self):
-#         pass
-#
-#     def of(self, l_type: LockType):
-#         return self._r_lock if l_type is LockType.READ else self._r_lock
+
+class LockType(Enum):
+    READ = 1
+    WRITE = 2
+
+
+class RWLock:
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._reads = 0
+        self._writes = 0
+        self._waiting_writes = 0
+        self._r_lock = _RWLockView(self, LockType.READ)
+        self._w_lock = _RWLockView(self, LockType.WRITE)
+
+    def r_lock(self, blocking: bool = True) -> bool:
+        with self._condition:
+            # waiting writers go first, otherwise a steady stream of readers starves them
+            while self._writes > 0 or self._waiting_writes > 0:
+                if not blocking:
+                    return False
+                self._condition.wait()
+            self._reads += 1
+            return True
+
+    def r_release(self):
+        with self._condition:
+            self._reads -= 1
+            if self._reads == 0:
+                self._condition.notify_all()
+
+    def w_lock(self, blocking: bool = True) -> bool:
+        with self._condition:
+            if self._reads > 0 or self._writes > 0:
+                if not blocking:
+                    return False
+                self._waiting_writes += 1
+                try:
+                    while self._reads > 0 or self._writes > 0:
+                        self._condition.wait()
+                finally:
+                    self._waiting_writes -= 1
+            self._writes = 1
+            return True
+
+    def w_release(self):
+        with self._condition:
+            self._writes = 0
+            self._condition.notify_all()
+
+    def locked_for(self, l_type: LockType) -> bool:
+        return self._reads > 0 if l_type is LockType.READ else self._writes > 0
+
+    def of(self, l_type: LockType) -> '_RWLockView':
+        return self._r_lock if l_type is LockType.READ else self._w_lock
+
+
+class _RWLockView:
+    # exposes one side of the RWLock with the threading.Lock interface
+    def __init__(self, rw_lock: RWLock, l_type: LockType):
+        self._rw_lock = rw_lock
+        self.type = l_type
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if self.type is LockType.READ:
+            return self._rw_lock.r_lock(blocking)
+        return self._rw_lock.w_lock(blocking)
+
+    def release(self):
+        if self.type is LockType.READ:
+            self._rw_lock.r_release()
+        else:
+            self._rw_lock.w_release()
+
+    def locked(self) -> bool:
+        return self._rw_lock.locked_for(self.type)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
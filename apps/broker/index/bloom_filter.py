@@ -0,0 +1,80 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+import typing
+
+from apps.broker.index.persistent_data import INT_ENCODING
+
+FILTER_HEADER = struct.Struct('>BBQ')  # clean flag, hashes count, bits count, followed by the bits
+CLEAN = 1
+DIRTY = 0
+INT_KEY_BYTES = 8
+
+
+class BloomFilter:
+    # a key not added is reported as a possible member with the given rate, an added one is never missed,
+    # keys can not be removed, so deleted ones stay possible members until the filter is rebuilt
+    def __init__(self, expected_keys: int, false_positive_rate: float):
+        if expected_keys < 1:
+            raise ValueError(f"Expected keys count has to be positive, got {expected_keys}")
+        if not 0 < false_positive_rate < 1:
+            raise ValueError(f"False positive rate has to be in (0, 1) range, got {false_positive_rate}")
+        bits_count = math.ceil(-expected_keys * math.log(false_positive_rate) / math.log(2) ** 2)
+        self._bits_count = max(8, bits_count)
+        self._hashes_count = max(1, round(self._bits_count / expected_keys * math.log(2)))
+        self._bits = bytearray(-(-self._bits_count // 8))
+        self._lock = threading.Lock()
+
+    def add(self, key: typing.Union[int, bytes]):
+        positions = self._positions(key)
+        # setting a bit reads and writes back its whole byte
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key: typing.Union[int, bytes]) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def clear(self):
+        with self._lock:
+            self._bits = bytearray(len(self._bits))
+
+    def _positions(self, key: typing.Union[int, bytes]) -> typing.List[int]:
+        # the hashes are combinations of two halves of a single digest
+        if isinstance(key, int):
+            key = key.to_bytes(INT_KEY_BYTES, INT_ENCODING)
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], INT_ENCODING)
+        second = int.from_bytes(digest[8:], INT_ENCODING) | 1
+        return [(first + i * second) % self._bits_count for i in range(self._hashes_count)]
+
+    def save(self, file_path: str, clean: bool):
+        with open(file_path, 'wb') as file:
+            file.write(FILTER_HEADER.pack(CLEAN if clean else DIRTY, self._hashes_count, self._bits_count))
+            file.write(self._bits)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def load(self, file_path: str) -> bool:
+        # false when the saved filter is of another size or was not saved after the last change
+        if not os.path.exists(file_path):
+            return False
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        if len(data) != FILTER_HEADER.size + len(self._bits):
+            return False
+        clean, hashes_count, bits_count = FILTER_HEADER.unpack_from(data)
+        if clean != CLEAN or (hashes_count, bits_count) != (self._hashes_count, self._bits_count):
+            return False
+        self._bits = bytearray(data[FILTER_HEADER.size:])
+        return True
+
+    @staticmethod
+    def mark_dirty(file_path: str):
+        # the tree changes from now on, a crash before the next save leaves the filter to be rebuilt
+        with open(file_path, 'r+b') as file:
+            file.write(bytes([DIRTY]))
+            file.flush()
+            os.fsync(file.fileno())
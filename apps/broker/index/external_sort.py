@@ -0,0 +1,86 @@
+import heapq
+import io
+import tempfile
+import typing
+
+from apps.broker.index.persistent_data import INT_ENCODING, PAGE_KEY_BYTES, PersKey
+from apps.broker.storage.storage_engine import DbRecordPointer, HEAP_FILE_BLOCKS_COUNT_BYTES, \
+    BLOCK_NUMBER_OF_SLOTS_SIZE_BYTES
+
+RUN_VALUE_BYTES = HEAP_FILE_BLOCKS_COUNT_BYTES + BLOCK_NUMBER_OF_SLOTS_SIZE_BYTES
+RUN_RECORD_BYTES = PAGE_KEY_BYTES + RUN_VALUE_BYTES
+RUN_KEY_LENGTH_BYTES = 1  # byte string keys are prefixed with their length
+RUN_READ_BUFFER_RECORDS = 1024
+DEFAULT_SORT_BUFFER_RECORDS = 100_000
+
+KeyValue = typing.Tuple[typing.Union[int, bytes], DbRecordPointer]
+
+
+def external_sort(items: typing.Iterable[KeyValue],
+                  buffer_records: int = DEFAULT_SORT_BUFFER_RECORDS,
+                  temp_dir: typing.Optional[str] = None) -> typing.Iterator[KeyValue]:
+    # input is cut into runs of `buffer_records` which are sorted in memory and spilled to temporary files,
+    # then the runs are streamed back through a k-way merge, so memory usage stays bounded
+    run = []
+    run_files = []
+    bytes_keys = False
+    try:
+        for item in items:
+            run.append(item)
+            if len(run) >= buffer_records:
+                bytes_keys = isinstance(run[0][0], bytes)
+                run_files.append(_spill_run(run, temp_dir))
+                run = []
+        if not run_files:
+            # everything fits in memory, no need to touch the disk
+            yield from sorted(run, key=_by_key)
+            return
+        if run:
+            run_files.append(_spill_run(run, temp_dir))
+            run = []
+        read_run = _read_bytes_keys_run if bytes_keys else _read_run
+        yield from heapq.merge(*[read_run(f) for f in run_files], key=_by_key)
+    finally:
+        for f in run_files:
+            f.close()
+
+
+def _by_key(item: KeyValue) -> typing.Union[int, bytes]:
+    return item[0]
+
+
+def _spill_run(run: typing.List[KeyValue], temp_dir: typing.Optional[str]):
+    run.sort(key=_by_key)
+    run_file = tempfile.TemporaryFile(dir=temp_dir)
+    buffer = bytearray()
+    for key, value in run:
+        if isinstance(key, bytes):
+            buffer += len(key).to_bytes(RUN_KEY_LENGTH_BYTES, INT_ENCODING)
+            buffer += key
+        else:
+            buffer += PersKey(key).to_binary()
+        buffer += value.to_binary()
+    run_file.write(buffer)
+    run_file.seek(0)
+    return run_file
+
+
+def _read_run(run_file) -> typing.Iterator[KeyValue]:
+    while True:
+        chunk = run_file.read(RUN_RECORD_BYTES * RUN_READ_BUFFER_RECORDS)
+        if not chunk:
+            return
+        buff = io.BytesIO(chunk)
+        for _ in range(len(chunk) // RUN_RECORD_BYTES):
+            key = PersKey.from_binary(buff)
+            yield key.key, DbRecordPointer.from_binary(buff)
+
+
+def _read_bytes_keys_run(run_file) -> typing.Iterator[KeyValue]:
+    # records differ in length, the temporary file is buffered, so they are just read one by one
+    while True:
+        key_length = run_file.read(RUN_KEY_LENGTH_BYTES)
+        if not key_length:
+            return
+        key = run_file.read(int.from_bytes(key_length, INT_ENCODING))
+        yield key, DbRecordPointer.from_binary(io.BytesIO(run_file.read(RUN_VALUE_BYTES)))
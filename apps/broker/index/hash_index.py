@@ -0,0 +1,217 @@
+import bisect
+import os
+import struct
+import typing
+import zlib
+
+from apps.broker.concurrent.utils import LockType, RWLock
+from apps.broker.index.lock_manager import LockManager
+from apps.broker.index.node_codec import KEY_SIZE, NODE_HEADER_SIZE, VALUE_SIZE, PackedNode, pack_node
+from apps.broker.index.persistent_btree import DuplicateKeyException, NoSuchKeyException
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, INT_ENCODING, PAGE_KEY_BYTES, PagePointer
+from apps.broker.storage.storage_engine import DbRecordPointer
+
+BUCKET_DEPTH = struct.Struct('>B')  # local depth, followed by the entries packed like a leaf
+BUCKET_MAX_KEYS = (BLOCK_SIZE_BYTES - BUCKET_DEPTH.size - NODE_HEADER_SIZE) // (KEY_SIZE + VALUE_SIZE)
+DIRECTORY_HEADER = struct.Struct('>BI')  # global depth, number of directory pages, followed by their pointers
+DIRECTORY_ENTRY = struct.Struct('>i')
+DIRECTORY_PAGE_ENTRIES = BLOCK_SIZE_BYTES // DIRECTORY_ENTRY.size
+MAX_DIRECTORY_PAGES = (BLOCK_SIZE_BYTES - DIRECTORY_HEADER.size) // DIRECTORY_ENTRY.size
+MAX_GLOBAL_DEPTH = (MAX_DIRECTORY_PAGES * DIRECTORY_PAGE_ENTRIES).bit_length() - 1
+MAX_KEY = 2 ** (8 * PAGE_KEY_BYTES) - 1
+
+
+class PersHashIndex:
+    # extendible hashing, the directory of buckets is kept in memory, so a lookup reads a single bucket page,
+    # a full bucket is split in two on its own and only the directory entries pointing to it are changed
+    DIRECTORY_PAGE = PagePointer(1)  # the first page is the file header
+
+    def __init__(self, index_file_path: str, bucket_max_keys: typing.Optional[int] = None):
+        if bucket_max_keys is not None and not 1 <= bucket_max_keys <= BUCKET_MAX_KEYS:
+            raise ValueError(f"Bucket max keys has to be in [1, {BUCKET_MAX_KEYS}] range, got {bucket_max_keys}")
+        self._index_file_path = index_file_path
+        self._bucket_max_keys = bucket_max_keys or BUCKET_MAX_KEYS
+        self._file_handle = None
+        self._page_manager = None
+        self._lock_manager = LockManager()
+        # buckets are latched under the shared lock, splits change the directory under the exclusive one
+        self._directory_lock = RWLock()
+        self._global_depth = 0
+        self._directory: typing.List[PagePointer] = []
+        self._directory_pages: typing.List[PagePointer] = []
+
+    def insert(self, key: int, value: DbRecordPointer):
+        self._check_key(key)
+        with self._directory_lock.of(LockType.READ):
+            pointer = self._bucket_pointer(key)
+            with self._lock_manager.lock(pointer, LockType.WRITE):
+                depth, keys, values = self._read_bucket(pointer)
+                if self._insert_into(keys, values, key, value):
+                    self._save_bucket(pointer, depth, keys, values)
+                    return
+        with self._directory_lock.of(LockType.WRITE):
+            pointer = self._bucket_pointer(key)
+            depth, keys, values = self._read_bucket(pointer)
+            if self._insert_into(keys, values, key, value):
+                self._save_bucket(pointer, depth, keys, values)
+                return
+            i = bisect.bisect_left(keys, key)
+            self._split(pointer, depth, keys[:i] + [key] + keys[i:], values[:i] + [value] + values[i:])
+
+    def find(self, key: int) -> typing.Optional[DbRecordPointer]:
+        self._check_key(key)
+        with self._directory_lock.of(LockType.READ):
+            pointer = self._bucket_pointer(key)
+            with self._lock_manager.lock(pointer, LockType.READ):
+                bucket = PackedNode(self._page_manager.read_block(pointer)[BUCKET_DEPTH.size:])
+        i = bucket.key_index(key)
+        if i is not None:
+            return bucket.value(i)
+
+    def update(self, key: int, value: DbRecordPointer):
+        self._modify_bucket(key, lambda keys, values, i: values.__setitem__(i, value))
+
+    def delete(self, key: int) -> None:
+        # emptied buckets are kept, they are not merged with their buddies
+        def remove(keys: typing.List[int], values: typing.List[DbRecordPointer], i: int):
+            keys.pop(i)
+            values.pop(i)
+
+        self._modify_bucket(key, remove)
+
+    def _modify_bucket(self, key: int, operation: typing.Callable):
+        self._check_key(key)
+        with self._directory_lock.of(LockType.READ):
+            pointer = self._bucket_pointer(key)
+            with self._lock_manager.lock(pointer, LockType.WRITE):
+                depth, keys, values = self._read_bucket(pointer)
+                i = bisect.bisect_left(keys, key)
+                if i == len(keys) or keys[i] != key:
+                    raise NoSuchKeyException(f'No key {key} found in an index')
+                operation(keys, values, i)
+                self._save_bucket(pointer, depth, keys, values)
+
+    def _insert_into(self, keys: typing.List[int], values: typing.List[DbRecordPointer], key: int,
+                     value: DbRecordPointer) -> bool:
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            raise DuplicateKeyException(f"Duplicate key {key}")
+        if len(keys) >= self._bucket_max_keys:
+            return False
+        keys.insert(i, key)
+        values.insert(i, value)
+        return True
+
+    def _split(self, pointer: PagePointer, depth: int, keys: typing.List[int], values: typing.List[DbRecordPointer]):
+        # entries are divided by the next bit of their hashes, until both halves fit
+        while len(keys) > self._bucket_max_keys:
+            if depth == self._global_depth:
+                self._double_directory()
+            bit = 1 << depth
+            low_keys, low_values, high_keys, high_values = [], [], [], []
+            for key, value in zip(keys, values):
+                if _hash(key) & bit:
+                    high_keys.append(key)
+                    high_values.append(value)
+                else:
+                    low_keys.append(key)
+                    low_values.append(value)
+            high_pointer = self._page_manager.save_new_block(self._bucket_binary(depth + 1, high_keys, high_values))
+            self._save_bucket(pointer, depth + 1, low_keys, low_values)
+            # the bucket is pointed to by every entry ending with the lowest bits its keys share
+            changed_pages = set()
+            for i in range((_hash(keys[0]) & (bit - 1)) | bit, len(self._directory), bit << 1):
+                self._directory[i] = high_pointer
+                changed_pages.add(i // DIRECTORY_PAGE_ENTRIES)
+            for page in sorted(changed_pages):
+                self._save_directory_page(page)
+            depth += 1
+            if len(high_keys) > self._bucket_max_keys:
+                pointer, keys, values = high_pointer, high_keys, high_values
+            else:
+                keys, values = low_keys, low_values
+
+    def _double_directory(self):
+        if self._global_depth == MAX_GLOBAL_DEPTH:
+            raise IndexFullException(f"Directory can not grow over {2 ** MAX_GLOBAL_DEPTH} buckets")
+        self._directory = self._directory + self._directory
+        self._global_depth += 1
+        pages_count = -(-len(self._directory) // DIRECTORY_PAGE_ENTRIES)
+        while len(self._directory_pages) < pages_count:
+            self._directory_pages.append(self._page_manager.save_new_block(b''))
+        for page in range(pages_count):
+            self._save_directory_page(page)
+        self._save_directory_header()
+
+    def _bucket_pointer(self, key: int) -> PagePointer:
+        return self._directory[_hash(key) & ((1 << self._global_depth) - 1)]
+
+    def _read_bucket(self, pointer: PagePointer) -> typing.Tuple[int, typing.List[int], typing.List[DbRecordPointer]]:
+        data = self._page_manager.read_block(pointer)
+        bucket = PackedNode(data[BUCKET_DEPTH.size:])
+        return BUCKET_DEPTH.unpack_from(data)[0], bucket.keys(), bucket.values()
+
+    def _save_bucket(self, pointer: PagePointer, depth: int, keys: typing.List[int],
+                     values: typing.List[DbRecordPointer]):
+        self._page_manager.save_block(pointer, self._bucket_binary(depth, keys, values))
+
+    @staticmethod
+    def _bucket_binary(depth: int, keys: typing.List[int], values: typing.List[DbRecordPointer]) -> bytes:
+        return BUCKET_DEPTH.pack(depth) + pack_node(keys, values, [])
+
+    def _save_directory_page(self, page: int):
+        entries = self._directory[page * DIRECTORY_PAGE_ENTRIES:(page + 1) * DIRECTORY_PAGE_ENTRIES]
+        self._page_manager.save_block(self._directory_pages[page],
+                                      b''.join(DIRECTORY_ENTRY.pack(p.block_number) for p in entries))
+
+    def _save_directory_header(self):
+        self._page_manager.save_block(self.DIRECTORY_PAGE,
+                                      DIRECTORY_HEADER.pack(self._global_depth, len(self._directory_pages)) +
+                                      b''.join(DIRECTORY_ENTRY.pack(p.block_number) for p in self._directory_pages))
+
+    def _load_directory(self):
+        data = self._page_manager.read_block(self.DIRECTORY_PAGE)
+        if not data:
+            self._save_directory_header()  # takes the page before the first bucket and directory page do
+            self._directory = [self._page_manager.save_new_block(self._bucket_binary(0, [], []))]
+            self._directory_pages = [self._page_manager.save_new_block(b'')]
+            self._save_directory_page(0)
+            self._save_directory_header()
+            return
+        self._global_depth, pages_count = DIRECTORY_HEADER.unpack_from(data)
+        self._directory_pages = [PagePointer(DIRECTORY_ENTRY.unpack_from(data, DIRECTORY_HEADER.size + i * 4)[0])
+                                 for i in range(pages_count)]
+        entries_count = 1 << self._global_depth
+        self._directory = []
+        for page in self._directory_pages:
+            page_data = self._page_manager.read_block(page)
+            count = min(DIRECTORY_PAGE_ENTRIES, entries_count - len(self._directory))
+            self._directory.extend(PagePointer(block) for block, in DIRECTORY_ENTRY.iter_unpack(page_data[:count * 4]))
+
+    @staticmethod
+    def _check_key(key: int):
+        if not 0 <= key <= MAX_KEY:
+            raise ValueError(f"Key has to be in [0, {MAX_KEY}] range, got {key}")
+
+    def __enter__(self) -> 'PersHashIndex':
+        from apps.broker.index.page_manager import PageManager
+
+        if not os.path.exists(self._index_file_path):
+            open(self._index_file_path, 'w').close()
+        self._file_handle = open(self._index_file_path, 'r+b')
+        self._page_manager = PageManager(self._file_handle, self._bucket_max_keys, self._lock_manager)
+        self._load_directory()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._file_handle.close()
+
+
+def _hash(key: int) -> int:
+    # spreads sequential keys, the lowest bits choose the bucket
+    return zlib.crc32(key.to_bytes(PAGE_KEY_BYTES, INT_ENCODING))
+
+
+class IndexFullException(RuntimeError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
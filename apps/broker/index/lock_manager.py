@@ -1,18 +1,79 @@
 import threading
+import typing
 
+from apps.broker.concurrent.utils import RWLock, LockType
 from apps.broker.index.persistent_data import PagePointer
 
+LOCK_MANAGER_SHARDS = 64
+
 
 class LockManager:
+    # latches live only while some thread holds or waits for them, the table is split into shards,
+    # so threads latching different pages rarely meet on the same internal lock
+    def __init__(self, shards: int = LOCK_MANAGER_SHARDS):
+        self._shards = [_LatchTableShard() for _ in range(shards)]
+        # called with the page before its exclusive latch is released
+        self.write_release_listener: typing.Optional[typing.Callable[[PagePointer], None]] = None
+
+    def lock(self, pointer: PagePointer, lock_type: LockType, blocking: bool = True) -> typing.Optional['PageLatch']:
+        shard = self._shards[pointer.block_number % len(self._shards)]
+        with shard.lock:
+            latch = shard.latches.get(pointer)
+            if latch is None:
+                latch = shard.latches[pointer] = _RefCountedLatch()
+            latch.users += 1
+        if not latch.rw_lock.of(lock_type).acquire(blocking):
+            self._unref(pointer, latch)
+            return None
+        return PageLatch(self, pointer, latch, lock_type)
+
+    def latches_count(self) -> int:
+        count = 0
+        for shard in self._shards:
+            with shard.lock:
+                count += len(shard.latches)
+        return count
+
+    def _unref(self, pointer: PagePointer, latch: '_RefCountedLatch'):
+        shard = self._shards[pointer.block_number % len(self._shards)]
+        with shard.lock:
+            latch.users -= 1
+            if latch.users == 0:
+                del shard.latches[pointer]
+
+
+class PageLatch:
+    # acquired latch of a single page, exposes the threading.Lock interface used by LockContext
+    def __init__(self, lock_manager: LockManager, pointer: PagePointer, latch: '_RefCountedLatch',
+                 lock_type: LockType):
+        self._lock_manager = lock_manager
+        self._pointer = pointer
+        self._latch = latch
+        self.type = lock_type
+
+    def release(self):
+        if self.type is LockType.WRITE and self._lock_manager.write_release_listener is not None:
+            self._lock_manager.write_release_listener(self._pointer)
+        self._latch.rw_lock.of(self.type).release()
+        self._lock_manager._unref(self._pointer, self._latch)
+
+    def locked(self) -> bool:
+        return self._latch.rw_lock.locked_for(self.type)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _RefCountedLatch:
     def __init__(self):
-        self._internal_lock = threading.Lock()
-        self._locks = dict()
+        self.rw_lock = RWLock()
+        self.users = 0  # holders and waiters
 
-    def get_lock(self, pointer: PagePointer) -> threading.Lock:
-        with self._internal_lock:
-            if pointer not in self._locks.keys():
-                self._locks[pointer] = threading.Lock()  # make it RW lock
-            return self._locks[pointer]
 
-    def remove_lock(self, pointer: PagePointer):
-        pass # TODO: remove lock when deleting node from  page_manager
+class _LatchTableShard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latches: typing.Dict[PagePointer, _RefCountedLatch] = {}
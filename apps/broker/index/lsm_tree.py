@@ -0,0 +1,416 @@
+import bisect
+import heapq
+import json
+import os
+import re
+import struct
+import threading
+import typing
+
+from apps.broker.index.node_codec import KEY_FORMAT, KEY_SIZE, NODE_HEADER_SIZE, VALUE_FORMAT, VALUE_SIZE, \
+    PackedNode, pack_node
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PAGE_KEY_BYTES
+from apps.broker.storage.storage_engine import DbRecordPointer
+from apps.broker.utils import private
+
+DEFAULT_MEMTABLE_MAX_KEYS = 64 * 1024
+RUN_BLOCK_MAX_KEYS = (BLOCK_SIZE_BYTES - NODE_HEADER_SIZE) // (KEY_SIZE + VALUE_SIZE)
+L0_COMPACTION_RUNS = 4  # flushed runs overlap each other, when there are that many they are merged into the first level
+L0_STOP_RUNS = 12  # memtables are not flushed until the compaction catches up
+LEVEL_SIZE_RATIO = 10
+MAX_KEY = 2 ** (8 * PAGE_KEY_BYTES) - 1
+# a deleted key is kept as a record pointer to the last slot of the last heap file block until the deepest level
+TOMBSTONE = DbRecordPointer(2 ** 24 - 1, 2 ** 16 - 1)
+
+RUN_FENCE = struct.Struct('>' + KEY_FORMAT)  # the first key of a block
+RUN_FOOTER = struct.Struct('>II' + KEY_FORMAT)  # blocks count, entries count, the last key
+LOG_ENTRY = struct.Struct('>' + KEY_FORMAT + VALUE_FORMAT)
+MANIFEST_FILE = 'manifest'
+RUN_FILE_PATTERN = re.compile(r'run-(\d+)')
+LOG_FILE_PATTERN = re.compile(r'memtable-(\d+)\.log')
+
+KeyValue = typing.Tuple[int, DbRecordPointer]
+
+
+class LSMTree:
+    # writes go only to the memtable and its log, a full memtable is written out as an immutable sorted run
+    # in the background and the runs are merged level by level, every level is ten times bigger than the one above,
+    # inserts overwrite and deletes leave tombstones without looking up the key, so none of them reads a page
+    def __init__(self, index_dir_path: str, memtable_max_keys: int = DEFAULT_MEMTABLE_MAX_KEYS):
+        if memtable_max_keys < 1:
+            raise ValueError(f"Memtable max keys has to be positive, got {memtable_max_keys}")
+        self._index_dir_path = index_dir_path
+        self._memtable_max_keys = memtable_max_keys
+        self._lock = threading.Condition(threading.Lock())
+        self._memtable: typing.Optional[Memtable] = None
+        self._immutable: typing.Optional[Memtable] = None
+        # the first level holds overlapping runs, the newest first, the other ones a single run or none
+        self._levels: typing.List[typing.List[SortedRun]] = [[]]
+        self._next_id = 0
+        self._closing = False
+        self._background_error: typing.Optional[BaseException] = None
+        self._workers: typing.List[threading.Thread] = []
+
+    def insert(self, key: int, value: DbRecordPointer):
+        if value == TOMBSTONE:
+            raise ValueError(f"Record pointer {TOMBSTONE} is reserved for deleted keys")
+        self._put(key, value)
+
+    def delete(self, key: int) -> None:
+        self._put(key, TOMBSTONE)
+
+    def _put(self, key: int, value: DbRecordPointer):
+        _check_key(key)
+        with self._lock:
+            self._check_background()
+            if len(self._memtable) >= self._memtable_max_keys:
+                while self._immutable is not None:
+                    self._lock.wait()
+                    self._check_background()
+                self._immutable = self._memtable
+                self._memtable = Memtable(self._log_path(self._new_id()))
+                self._lock.notify_all()
+            self._memtable.put(key, value)
+
+    def find(self, key: int) -> typing.Optional[DbRecordPointer]:
+        _check_key(key)
+        memtables, runs = self._acquire_view()
+        try:
+            for source in memtables + runs:
+                value = source.find(key)
+                if value is not None:
+                    return None if value == TOMBSTONE else value
+        finally:
+            self._release_runs(runs)
+
+    def find_range(self, lo: int, hi: int) -> typing.List[KeyValue]:
+        memtables, runs = self._acquire_view(lo, hi)
+        try:
+            return [(key, value) for key, value in _newest(memtables + [run.find_range(lo, hi) for run in runs])
+                    if value != TOMBSTONE]
+        finally:
+            self._release_runs(runs)
+
+    def items(self) -> typing.List[KeyValue]:
+        return self.find_range(0, MAX_KEY)
+
+    def _acquire_view(self, lo: typing.Optional[int] = None, hi: typing.Optional[int] = None) \
+            -> typing.Tuple[typing.List, typing.List['SortedRun']]:
+        # the memtable keeps changing, so for a range its entries are copied out under the lock
+        with self._lock:
+            self._check_background()
+            memtables = [m for m in (self._memtable, self._immutable) if m is not None]
+            if lo is not None:
+                memtables = [m.find_range(lo, hi) for m in memtables]
+            runs = [run for level in self._levels for run in level]
+            for run in runs:
+                run.readers += 1
+        return memtables, runs
+
+    def _release_runs(self, runs: typing.List['SortedRun']):
+        with self._lock:
+            for run in runs:
+                run.readers -= 1
+                if run.obsolete and run.readers == 0:
+                    run.remove()
+
+    def _retire_runs(self, runs: typing.List['SortedRun']):
+        # runs merged away are removed once the last reader lets them go
+        for run in runs:
+            run.obsolete = True
+            if run.readers == 0:
+                run.remove()
+
+    def _flush_memtables(self):
+        while True:
+            with self._lock:
+                while not self._closing and (self._immutable is None or len(self._levels[0]) >= L0_STOP_RUNS):
+                    self._lock.wait()
+                if self._immutable is None:
+                    return
+                memtable, run_id = self._immutable, self._new_id()
+            run = SortedRun.write(self._run_path(run_id), memtable.items())
+            with self._lock:
+                if run is not None:
+                    self._levels[0].insert(0, run)
+                self._save_manifest()
+                memtable.remove_log()
+                self._immutable = None
+                self._lock.notify_all()
+
+    def _compact_levels(self):
+        while True:
+            with self._lock:
+                while not self._closing and self._compacted_level() is None:
+                    self._lock.wait()
+                if self._closing:
+                    return
+                level = self._compacted_level()
+                if level + 1 == len(self._levels):
+                    self._levels.append([])
+                merged = self._levels[level] + self._levels[level + 1]
+                # tombstones are needed only as long as an older value may be below
+                bottom = not any(self._levels[level + 2:])
+                run_id = self._new_id()
+            items = _newest([run.items() for run in merged])
+            if bottom:
+                items = (item for item in items if item[1] != TOMBSTONE)
+            run = SortedRun.write(self._run_path(run_id), items)
+            with self._lock:
+                self._levels[level] = [r for r in self._levels[level] if r not in merged]
+                self._levels[level + 1] = [run] if run is not None else []
+                self._save_manifest()
+                self._retire_runs(merged)
+                self._lock.notify_all()
+
+    def _compacted_level(self) -> typing.Optional[int]:
+        if len(self._levels[0]) >= L0_COMPACTION_RUNS:
+            return 0
+        for level in range(1, len(self._levels)):
+            capacity = self._memtable_max_keys * L0_COMPACTION_RUNS * LEVEL_SIZE_RATIO ** level
+            if self._levels[level] and self._levels[level][0].entries_count > capacity:
+                return level
+
+    def _run_in_background(self, work: typing.Callable):
+        try:
+            work()
+        except BaseException as e:
+            with self._lock:
+                self._background_error = e
+                self._lock.notify_all()
+
+    def _check_background(self):
+        if self._background_error is not None:
+            raise LSMBackgroundException(f"Background work of {self._index_dir_path} failed") \
+                from self._background_error
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def _run_path(self, run_id: int) -> str:
+        return os.path.join(self._index_dir_path, f'run-{run_id}')
+
+    def _log_path(self, log_id: int) -> str:
+        return os.path.join(self._index_dir_path, f'memtable-{log_id}.log')
+
+    def _save_manifest(self):
+        path = os.path.join(self._index_dir_path, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'levels': [[run.run_id for run in level] for level in self._levels],
+                       'next_id': self._next_id}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _load(self):
+        path = os.path.join(self._index_dir_path, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path) as file:
+                manifest = json.load(file)
+            self._levels = [[SortedRun(self._run_path(run_id)) for run_id in level] for level in manifest['levels']]
+            self._next_id = manifest['next_id']
+        live = {run.run_id for level in self._levels for run in level}
+        logs = []
+        for name in os.listdir(self._index_dir_path):
+            if RUN_FILE_PATTERN.fullmatch(name) and int(RUN_FILE_PATTERN.fullmatch(name).group(1)) not in live:
+                os.remove(os.path.join(self._index_dir_path, name))  # left by an interrupted flush or compaction
+            elif LOG_FILE_PATTERN.fullmatch(name):
+                logs.append(int(LOG_FILE_PATTERN.fullmatch(name).group(1)))
+        # memtables not flushed before the index was closed are recovered into a new one
+        self._next_id = max([self._next_id] + logs)
+        self._memtable = Memtable(self._log_path(self._new_id()))
+        for log_id in sorted(logs):
+            for key, value in Memtable.replay(self._log_path(log_id)):
+                self._memtable.put(key, value)
+            os.remove(self._log_path(log_id))
+
+    def __enter__(self) -> 'LSMTree':
+        os.makedirs(self._index_dir_path, exist_ok=True)
+        self._load()
+        self._closing = False
+        self._workers = [threading.Thread(target=self._run_in_background, args=(work,), daemon=True)
+                         for work in (self._flush_memtables, self._compact_levels)]
+        for worker in self._workers:
+            worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self._closing = True
+            self._lock.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self._background_error is None and len(self._memtable):
+            run = SortedRun.write(self._run_path(self._new_id()), self._memtable.items())
+            self._levels[0].insert(0, run)
+            self._save_manifest()
+            self._memtable.remove_log()
+        else:
+            for memtable in (self._memtable, self._immutable):
+                if memtable is not None:
+                    memtable.close_log()
+        for level in self._levels:
+            for run in level:
+                run.close()
+
+
+@private
+class Memtable:
+    def __init__(self, log_path: str):
+        self._log_path = log_path
+        self._log = open(log_path, 'ab')
+        self._entries: typing.Dict[int, DbRecordPointer] = {}
+        self._sorted_keys: typing.Optional[typing.List[int]] = None
+
+    def put(self, key: int, value: DbRecordPointer):
+        # a process crash keeps what the os got, a torn entry at the end is skipped on recovery
+        self._log.write(LOG_ENTRY.pack(key >> 32, key & 0xFFFFFFFF, value.block >> 16, value.block & 0xFFFF,
+                                       value.slot))
+        self._log.flush()
+        if key not in self._entries:
+            self._sorted_keys = None
+        self._entries[key] = value
+
+    def find(self, key: int) -> typing.Optional[DbRecordPointer]:
+        return self._entries.get(key)
+
+    def find_range(self, lo: int, hi: int) -> typing.List[KeyValue]:
+        keys = self._keys()
+        return [(key, self._entries[key]) for key in keys[bisect.bisect_left(keys, lo):bisect.bisect_right(keys, hi)]]
+
+    def items(self) -> typing.List[KeyValue]:
+        return [(key, self._entries[key]) for key in self._keys()]
+
+    def _keys(self) -> typing.List[int]:
+        # sorted again only after a new key came in
+        keys = self._sorted_keys
+        if keys is None:
+            keys = self._sorted_keys = sorted(self._entries)
+        return keys
+
+    def close_log(self):
+        self._log.close()
+
+    def remove_log(self):
+        self._log.close()
+        os.remove(self._log_path)
+
+    @staticmethod
+    def replay(log_path: str) -> typing.Iterator[KeyValue]:
+        with open(log_path, 'rb') as file:
+            data = file.read()
+        for key_high, key_low, block_high, block_low, slot in \
+                LOG_ENTRY.iter_unpack(data[:len(data) - len(data) % LOG_ENTRY.size]):
+            yield key_high << 32 | key_low, DbRecordPointer(block_high << 16 | block_low, slot)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@private
+class SortedRun:
+    # blocks of entries packed like leafs, followed by the first key of every block and a footer,
+    # the first keys are kept in memory, so a lookup reads a single block
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.run_id = int(RUN_FILE_PATTERN.fullmatch(os.path.basename(file_path)).group(1))
+        self.readers = 0
+        self.obsolete = False
+        self._file = open(file_path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        blocks_count, self.entries_count, last_high, last_low = \
+            RUN_FOOTER.unpack(os.pread(self._file.fileno(), RUN_FOOTER.size, size - RUN_FOOTER.size))
+        self.last_key = last_high << 32 | last_low
+        fences = os.pread(self._file.fileno(), blocks_count * RUN_FENCE.size, blocks_count * BLOCK_SIZE_BYTES)
+        self._fences = [high << 32 | low for high, low in RUN_FENCE.iter_unpack(fences)]
+
+    @classmethod
+    def write(cls, file_path: str, items: typing.Iterable[KeyValue]) -> typing.Optional['SortedRun']:
+        # nothing is written for no items
+        fences = []
+        entries_count = 0
+        last_key = None
+        with open(file_path, 'wb') as file:
+            keys, values = [], []
+            for key, value in items:
+                keys.append(key)
+                values.append(value)
+                if len(keys) == RUN_BLOCK_MAX_KEYS:
+                    fences.append(keys[0])
+                    file.write(pack_node(keys, values, []).ljust(BLOCK_SIZE_BYTES, b'\0'))
+                    entries_count += len(keys)
+                    last_key = keys[-1]
+                    keys, values = [], []
+            if keys:
+                fences.append(keys[0])
+                file.write(pack_node(keys, values, []).ljust(BLOCK_SIZE_BYTES, b'\0'))
+                entries_count += len(keys)
+                last_key = keys[-1]
+            if not fences:
+                file.close()
+                os.remove(file_path)
+                return None
+            file.write(b''.join(RUN_FENCE.pack(key >> 32, key & 0xFFFFFFFF) for key in fences))
+            file.write(RUN_FOOTER.pack(len(fences), entries_count, last_key >> 32, last_key & 0xFFFFFFFF))
+            file.flush()
+            os.fsync(file.fileno())
+        return cls(file_path)
+
+    def find(self, key: int) -> typing.Optional[DbRecordPointer]:
+        if not self._fences or key < self._fences[0] or key > self.last_key:
+            return None
+        block = self._block(bisect.bisect_right(self._fences, key) - 1)
+        i = block.key_index(key)
+        if i is not None:
+            return block.value(i)
+
+    def find_range(self, lo: int, hi: int) -> typing.Iterator[KeyValue]:
+        if hi < lo or hi < self._fences[0] or lo > self.last_key:
+            return
+        for i in range(max(bisect.bisect_right(self._fences, lo) - 1, 0), len(self._fences)):
+            if self._fences[i] > hi:
+                return
+            block = self._block(i)
+            for key, value in zip(block.keys(), block.values()):
+                if key > hi:
+                    return
+                if key >= lo:
+                    yield key, value
+
+    def items(self) -> typing.Iterator[KeyValue]:
+        return self.find_range(0, MAX_KEY)
+
+    def _block(self, i: int) -> PackedNode:
+        return PackedNode(os.pread(self._file.fileno(), BLOCK_SIZE_BYTES, i * BLOCK_SIZE_BYTES))
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self._file.close()
+        os.remove(self.file_path)
+
+
+def _newest(sources: typing.List[typing.Iterable[KeyValue]]) -> typing.Iterator[KeyValue]:
+    # sources go from the newest, for a key in many of them only the newest value is taken
+    last = None
+    for key, _, value in heapq.merge(*(_aged(source, age) for age, source in enumerate(sources))):
+        if key != last:
+            last = key
+            yield key, value
+
+
+def _aged(source: typing.Iterable[KeyValue], age: int) -> typing.Iterator[typing.Tuple[int, int, DbRecordPointer]]:
+    for key, value in source:
+        yield key, age, value
+
+
+def _check_key(key: int):
+    if not 0 <= key <= MAX_KEY:
+        raise ValueError(f"Key has to be in [0, {MAX_KEY}] range, got {key}")
+
+
+class LSMBackgroundException(RuntimeError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
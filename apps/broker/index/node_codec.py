@@ -0,0 +1,315 @@
+import functools
+import operator
+import struct
+import typing
+
+from apps.broker.index.persistent_data import PagePointer
+from apps.broker.storage.storage_engine import DbRecordPointer
+
+# the layout is the same as written element by element with to_binary, it's just packed in bulk:
+# 6 byte key as 2 + 4 bytes, 5 byte record pointer as 1 + 2 bytes of block and 2 bytes of slot
+KEY_FORMAT = 'HI'
+VALUE_FORMAT = 'BHH'
+CHILD_FORMAT = 'i'
+KEY_SIZE = struct.calcsize('>' + KEY_FORMAT)
+VALUE_SIZE = struct.calcsize('>' + VALUE_FORMAT)
+CHILD_SIZE = struct.calcsize('>' + CHILD_FORMAT)
+COUNT_FORMAT = 'H'  # max 65535 keys
+COUNT_SIZE = struct.calcsize('>' + COUNT_FORMAT)
+NODE_HEADER_SIZE = 3 * COUNT_SIZE  # counts of keys, values and children
+
+# index nodes of an order-statistic tree store the number of keys below each child after the children
+SUBTREE_COUNTS_FLAG = 0x8000  # set in the children count
+SUBTREE_COUNT_FORMAT = 'I'
+SUBTREE_COUNT_SIZE = struct.calcsize('>' + SUBTREE_COUNT_FORMAT)
+
+LEAF_TRAILER = struct.Struct('>iB' + KEY_FORMAT)  # next, flags, high key
+NONE_POINTER = -1
+
+# byte string keys are front coded, each key stores only the suffix not shared with the previous one
+BYTES_KEYS_FLAG = 0x8000  # set in the keys count
+MAX_BYTES_KEY_LENGTH = 255
+BYTES_KEY_HEADER = struct.Struct('>BB')  # length of the prefix shared with the previous key, length of the suffix
+BYTES_LEAF_TRAILER = struct.Struct('>iBB')  # next, flags, high key length followed by the high key
+MAX_BYTES_KEY_ENTRY_SIZE = BYTES_KEY_HEADER.size + MAX_BYTES_KEY_LENGTH + \
+    max(VALUE_SIZE, CHILD_SIZE + SUBTREE_COUNT_SIZE)
+MAX_BYTES_LEAF_TRAILER_SIZE = BYTES_LEAF_TRAILER.size + MAX_BYTES_KEY_LENGTH
+
+# int leafs may be compressed, keys are stored as offsets from the first key of the leaf and record pointers
+# relative to the lowest block of the leaf, every section with the narrowest width fitting all its elements
+COMPRESSED_LEAF_FLAG = 0x4000  # set in the keys count
+COMPRESSED_LEAF_HEADER = struct.Struct('>' + KEY_FORMAT + 'BH' + 'BBB')  # first key, base block, widths of sections
+WIDTH_FORMATS = 'BHIQ'
+_COUNT_MASK = 0x3FFF  # without the flags
+_LOW_KEY_MASK = 0xFFFFFFFF
+_LOW_BLOCK_MASK = 0xFFFF
+_COUNT = struct.Struct('>' + COUNT_FORMAT)
+_KEY = struct.Struct('>' + KEY_FORMAT)
+_BLOCK = operator.attrgetter('block')
+_SLOT = operator.attrgetter('slot')
+_WIDTH_LIMITS = [1 << 8 * struct.calcsize(width_format) for width_format in WIDTH_FORMATS]
+
+
+def max_keys_for_page(page_size: int) -> int:
+    # the biggest fanout for which both full leaf and full index node fit into a page
+    leaf_keys = (page_size - NODE_HEADER_SIZE - LEAF_TRAILER.size) // (KEY_SIZE + VALUE_SIZE)
+    index_keys = (page_size - NODE_HEADER_SIZE - CHILD_SIZE) // (KEY_SIZE + CHILD_SIZE)
+    return min(leaf_keys, index_keys)
+
+
+def max_counted_keys_for_page(page_size: int) -> int:
+    # index nodes keep a subtree count next to every child
+    index_keys = (page_size - NODE_HEADER_SIZE - CHILD_SIZE - SUBTREE_COUNT_SIZE) // \
+        (KEY_SIZE + CHILD_SIZE + SUBTREE_COUNT_SIZE)
+    return min(max_keys_for_page(page_size), index_keys)
+
+
+def max_bytes_keys_for_page(page_size: int) -> int:
+    # upper bound only, pages with byte string keys are split as well when they run out of space
+    leaf_keys = (page_size - NODE_HEADER_SIZE - BYTES_LEAF_TRAILER.size) // (BYTES_KEY_HEADER.size + 1 + VALUE_SIZE)
+    index_keys = (page_size - NODE_HEADER_SIZE - CHILD_SIZE) // (BYTES_KEY_HEADER.size + 1 + CHILD_SIZE)
+    return min(leaf_keys, index_keys)
+
+
+def max_compressed_leaf_keys_for_page(page_size: int) -> int:
+    # upper bound only, compressed leafs are split as well when they run out of space,
+    # every key takes at least a byte for its offset, block offset and slot
+    return (page_size - COUNT_SIZE - COMPRESSED_LEAF_HEADER.size - LEAF_TRAILER.size) // 3
+
+
+def compressed_leaf_size(keys_count: int, max_key_offset: int, max_block_offset: int, max_slot: int) -> int:
+    # without the leaf trailer, known without packing the leaf
+    entry_size = sum(struct.calcsize(WIDTH_FORMATS[_width(value)])
+                     for value in (max_key_offset, max_block_offset, max_slot))
+    return COUNT_SIZE + COMPRESSED_LEAF_HEADER.size + keys_count * entry_size
+
+
+def _width(max_value: int) -> int:
+    # index of the narrowest format in WIDTH_FORMATS
+    for i, limit in enumerate(_WIDTH_LIMITS):
+        if max_value < limit:
+            return i
+    raise ValueError(f"Value {max_value} does not fit into {WIDTH_FORMATS[-1]}")
+
+
+def common_prefix_length(left: bytes, right: bytes) -> int:
+    length = min(len(left), len(right))
+    for i in range(length):
+        if left[i] != right[i]:
+            return i
+    return length
+
+
+@functools.lru_cache(maxsize=None)
+def _node_struct(keys_count: int, values_count: int, children_count: int) -> struct.Struct:
+    return struct.Struct('>' + COUNT_FORMAT + KEY_FORMAT * keys_count +
+                         COUNT_FORMAT + VALUE_FORMAT * values_count +
+                         COUNT_FORMAT + CHILD_FORMAT * children_count)
+
+
+@functools.lru_cache(maxsize=None)
+def _tail_struct(values_count: int, children_count: int) -> struct.Struct:
+    return struct.Struct('>' + COUNT_FORMAT + VALUE_FORMAT * values_count +
+                         COUNT_FORMAT + CHILD_FORMAT * children_count)
+
+
+@functools.lru_cache(maxsize=None)
+def _section_struct(element_format: str, count: int) -> struct.Struct:
+    return struct.Struct('>' + element_format * count)
+
+
+def pack_node(keys: typing.List[typing.Union[int, bytes]], values: typing.List[DbRecordPointer],
+              children: typing.List[PagePointer], bytes_keys: bool = False,
+              subtree_counts: typing.Optional[typing.List[int]] = None) -> bytes:
+    if bytes_keys:
+        binary = _pack_bytes_keys(keys) + \
+            _tail_struct(len(values), len(children)).pack(*_flat_tail(values, children, subtree_counts))
+    else:
+        flat = [len(keys)]
+        for key in keys:
+            flat.append(key >> 32)
+            flat.append(key & _LOW_KEY_MASK)
+        flat.extend(_flat_tail(values, children, subtree_counts))
+        binary = _node_struct(len(keys), len(values), len(children)).pack(*flat)
+    if subtree_counts is None:
+        return binary
+    return binary + _section_struct(SUBTREE_COUNT_FORMAT, len(subtree_counts)).pack(*subtree_counts)
+
+
+def _flat_tail(values: typing.List[DbRecordPointer], children: typing.List[PagePointer],
+               subtree_counts: typing.Optional[typing.List[int]]) -> typing.List[int]:
+    flat = [len(values)]
+    for value in values:
+        flat.append(value.block >> 16)
+        flat.append(value.block & _LOW_BLOCK_MASK)
+        flat.append(value.slot)
+    flat.append(len(children) if subtree_counts is None else len(children) | SUBTREE_COUNTS_FLAG)
+    flat.extend(child.block_number for child in children)
+    return flat
+
+
+def _pack_bytes_keys(keys: typing.List[bytes]) -> bytes:
+    binary = bytearray(_COUNT.pack(len(keys) | BYTES_KEYS_FLAG))
+    prev = b''
+    for key in keys:
+        shared = common_prefix_length(prev, key)
+        binary += BYTES_KEY_HEADER.pack(shared, len(key) - shared)
+        binary += key[shared:]
+        prev = key
+    return bytes(binary)
+
+
+def compressed_values_bounds(values: typing.List[DbRecordPointer]) -> typing.Tuple[int, int, int]:
+    # base block, max block offset and max slot
+    if not values:
+        return 0, 0, 0
+    blocks = list(map(_BLOCK, values))
+    base_block = min(blocks)
+    return base_block, max(blocks) - base_block, max(map(_SLOT, values))
+
+
+def pack_compressed_leaf(keys: typing.List[int], values: typing.List[DbRecordPointer]) -> bytes:
+    first_key = keys[0] if keys else 0
+    base_block, max_block_offset, max_slot = compressed_values_bounds(values)
+    key_offsets = [key - first_key for key in keys]
+    block_offsets = [block - base_block for block in map(_BLOCK, values)]
+    slots = list(map(_SLOT, values))
+    widths = [_width(max_value) for max_value in (keys[-1] - first_key if keys else 0, max_block_offset, max_slot)]
+    binary = _COUNT.pack(len(keys) | COMPRESSED_LEAF_FLAG) + \
+        COMPRESSED_LEAF_HEADER.pack(first_key >> 32, first_key & _LOW_KEY_MASK, base_block >> 16,
+                                    base_block & _LOW_BLOCK_MASK, *widths)
+    for width, section in zip(widths, (key_offsets, block_offsets, slots)):
+        binary += _section_struct(WIDTH_FORMATS[width], len(section)).pack(*section)
+    return binary
+
+
+def pack_leaf_trailer(next: typing.Optional[PagePointer], flags: int, high_key: typing.Union[int, bytes, None],
+                      bytes_keys: bool = False) -> bytes:
+    next_pointer = next.block_number if next else NONE_POINTER
+    if bytes_keys:
+        high = high_key if high_key is not None else b''
+        return BYTES_LEAF_TRAILER.pack(next_pointer, flags, len(high)) + high
+    high = high_key if high_key is not None else 0
+    return LEAF_TRAILER.pack(next_pointer, flags, high >> 32, high & _LOW_KEY_MASK)
+
+
+class PackedNode:
+    # view of a serialized node, sections are unpacked in bulk and only when asked for
+    def __init__(self, data: bytes):
+        self._view = memoryview(data)
+        self.keys_count, = _COUNT.unpack_from(self._view, 0)
+        self._keys_offset = COUNT_SIZE
+        self.bytes_keys = bool(self.keys_count & BYTES_KEYS_FLAG)
+        self.compressed = bool(self.keys_count & COMPRESSED_LEAF_FLAG)
+        self.keys_count &= _COUNT_MASK
+        if self.compressed:
+            self._unpack_compressed_header()
+            return
+        if self.bytes_keys:
+            # front coded keys can be found only by decoding them
+            self._bytes_keys, values_count_offset = self._unpack_bytes_keys()
+        else:
+            values_count_offset = self._keys_offset + self.keys_count * KEY_SIZE
+        self.values_count, = _COUNT.unpack_from(self._view, values_count_offset)
+        self._values_offset = values_count_offset + COUNT_SIZE
+        children_count_offset = self._values_offset + self.values_count * VALUE_SIZE
+        self.children_count, = _COUNT.unpack_from(self._view, children_count_offset)
+        self.counted = bool(self.children_count & SUBTREE_COUNTS_FLAG)
+        self.children_count &= ~SUBTREE_COUNTS_FLAG
+        self._children_offset = children_count_offset + COUNT_SIZE
+        self._trailer_offset = self._children_offset + self.children_count * CHILD_SIZE
+
+    def _unpack_compressed_header(self):
+        high, low, block_high, block_low, *widths = COMPRESSED_LEAF_HEADER.unpack_from(self._view, self._keys_offset)
+        self._first_key = high << 32 | low
+        self._base_block = block_high << 16 | block_low
+        self._sections = []  # offset and element format of key offsets, block offsets and slots
+        offset = self._keys_offset + COMPRESSED_LEAF_HEADER.size
+        for width in widths:
+            self._sections.append((offset, WIDTH_FORMATS[width]))
+            offset += _section_struct(WIDTH_FORMATS[width], self.keys_count).size
+        self.values_count = self.keys_count
+        self.children_count = 0
+        self.counted = False
+        self._trailer_offset = offset
+
+    def keys(self) -> typing.List[typing.Union[int, bytes]]:
+        if self.bytes_keys:
+            return self._bytes_keys
+        if self.compressed:
+            return list(map(self._first_key.__add__, self._unpack_section(0)))
+        flat = _section_struct(KEY_FORMAT, self.keys_count).unpack_from(self._view, self._keys_offset)
+        return [high << 32 | low for high, low in zip(flat[::2], flat[1::2])]
+
+    def key_index(self, key: int) -> typing.Optional[int]:
+        # big-endian keys sort as their bytes, so a single key is searched for without unpacking the section
+        assert not (self.bytes_keys or self.compressed)
+        target = _KEY.pack(key >> 32, key & _LOW_KEY_MASK)
+        lo, hi = 0, self.keys_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._keys_offset + mid * KEY_SIZE
+            if self._view[offset:offset + KEY_SIZE].tobytes() < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        offset = self._keys_offset + lo * KEY_SIZE
+        if lo < self.keys_count and self._view[offset:offset + KEY_SIZE].tobytes() == target:
+            return lo
+
+    def _unpack_bytes_keys(self) -> typing.Tuple[typing.List[bytes], int]:
+        keys = []
+        prev = b''
+        offset = self._keys_offset
+        for _ in range(self.keys_count):
+            shared, suffix_length = BYTES_KEY_HEADER.unpack_from(self._view, offset)
+            offset += BYTES_KEY_HEADER.size
+            prev = prev[:shared] + bytes(self._view[offset:offset + suffix_length])
+            offset += suffix_length
+            keys.append(prev)
+        return keys, offset
+
+    def values(self) -> typing.List[DbRecordPointer]:
+        if self.compressed:
+            blocks = map(self._base_block.__add__, self._unpack_section(1))
+            return list(map(DbRecordPointer, blocks, self._unpack_section(2)))
+        flat = _section_struct(VALUE_FORMAT, self.values_count).unpack_from(self._view, self._values_offset)
+        return [DbRecordPointer(high << 16 | low, slot) for high, low, slot in zip(flat[::3], flat[1::3], flat[2::3])]
+
+    def value(self, i: int) -> DbRecordPointer:
+        # a single one, without unpacking the whole section
+        if self.compressed:
+            return DbRecordPointer(self._base_block + self._unpack_element(1, i), self._unpack_element(2, i))
+        high, low, slot = _section_struct(VALUE_FORMAT, 1).unpack_from(self._view, self._values_offset + i * VALUE_SIZE)
+        return DbRecordPointer(high << 16 | low, slot)
+
+    def _unpack_section(self, section: int) -> typing.Tuple[int, ...]:
+        offset, element_format = self._sections[section]
+        return _section_struct(element_format, self.keys_count).unpack_from(self._view, offset)
+
+    def _unpack_element(self, section: int, i: int) -> int:
+        offset, element_format = self._sections[section]
+        element = _section_struct(element_format, 1)
+        return element.unpack_from(self._view, offset + i * element.size)[0]
+
+    def children(self) -> typing.List[PagePointer]:
+        if self.compressed:
+            return []
+        flat = _section_struct(CHILD_FORMAT, self.children_count).unpack_from(self._view, self._children_offset)
+        return [PagePointer(child) for child in flat]
+
+    def subtree_counts(self) -> typing.Optional[typing.List[int]]:
+        if not self.counted:
+            return None
+        return list(_section_struct(SUBTREE_COUNT_FORMAT, self.children_count).unpack_from(self._view,
+                                                                                          self._trailer_offset))
+
+    def leaf_trailer(self) -> typing.Tuple[typing.Optional[PagePointer], int, typing.Union[int, bytes]]:
+        if self.bytes_keys:
+            next, flags, high_length = BYTES_LEAF_TRAILER.unpack_from(self._view, self._trailer_offset)
+            high_offset = self._trailer_offset + BYTES_LEAF_TRAILER.size
+            high_key = bytes(self._view[high_offset:high_offset + high_length])
+        else:
+            next, flags, high, low = LEAF_TRAILER.unpack_from(self._view, self._trailer_offset)
+            high_key = high << 32 | low
+        return PagePointer(next) if next >= 0 else None, flags, high_key
@@ -1,81 +1,432 @@
+import io
 import os
 import threading
+import typing
+from collections import OrderedDict
 
 from apps.broker.index.lock_manager import LockManager
 from apps.broker.index.persistent_btree import PersBTreeNode, PersBTreeNodeLeaf
-from apps.broker.index.persistent_data import PagePointer
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PagePointer, INT_ENCODING
+from apps.broker.index.write_ahead_log import WriteAheadLog
 from apps.broker.utils import private
 
-BLOCK_SIZE_BYTES = 4096
+HEADER_PAGE = PagePointer(0)
+FREE_PAGES_COUNT_BYTES = 4
+DEFAULT_CHECKPOINT_PAGES = 1024
 
 
 @private  # TODO make it auto-closable and flush on cleanup
 class PageManager:
-    def __init__(self, file_handle, max_keys: int):
+    def __init__(self, file_handle, max_keys: int, lock_manager: LockManager,
+                 max_leaf_keys: typing.Optional[int] = None, log: typing.Optional[WriteAheadLog] = None,
+                 checkpoint_pages: int = DEFAULT_CHECKPOINT_PAGES, cache_pages: int = 0):
         self._file = file_handle
         self._max_keys = max_keys
-        # self._cache = {}  # make it lfu cache
+        self._max_leaf_keys = max_leaf_keys  # of compressed leafs
+        # least recently used pages as they are in the file or about to be written to it, nodes are not cached,
+        # as the trees change them in place before saving
+        self._cache: typing.OrderedDict[PagePointer, bytes] = OrderedDict()
+        self._cache_pages = cache_pages
+        self._read_ahead: typing.Dict[PagePointer, object] = {}  # pages being read without the lock
         self._lock = threading.Lock()
-        self._lock_manager = LockManager()
+        # has to be shared with the tree, otherwise a page read from disk and the same page created in memory
+        # would be latched with different locks
+        self._lock_manager = lock_manager
+        # freed pages are linked into a list starting in the header page, new pages are taken from it first
+        self._free_list_head: typing.Optional[PagePointer] = None
+        self._free_pages_count = 0
+        # open snapshots, a page changed since a snapshot was opened is copied aside before it is overwritten
+        self._snapshots: typing.List[PageSnapshot] = []
+        self._version_refs: typing.Dict[PagePointer, int] = {}  # snapshots sharing a copied page
+        # with a log pages are written back lazily, a thread logs the pages it has written as one record
+        # before releasing the exclusive latch of any of them, so records are in the order of the page changes
+        # and each of them takes the tree from one consistent state to another
+        self._log = log
+        self._checkpoint_pages = checkpoint_pages
+        self._unlogged: typing.Dict[PagePointer, bytes] = {}
+        self._logged: typing.Dict[PagePointer, bytes] = {}  # not written to the file yet
+        self._thread_writes = threading.local()
+        self._direct_writes = False  # not synced pages written around the log
+        self._header_logged = True
+        if log is not None:
+            self._recover()
+            lock_manager.write_release_listener = self._before_write_release
+        self._pages_count = self._file.seek(0, os.SEEK_END) // BLOCK_SIZE_BYTES
+        self._load_header()
 
     def save_page(self, node: 'PersBTreeNode'):
         with self._lock:
             assert node.pointer is not None
-            node_binary = node.to_binary()
-            if len(node_binary) > BLOCK_SIZE_BYTES:
-                raise PageOverflowException(f"Trying to {len(bytes)}, maximum page size is: {BLOCK_SIZE_BYTES}")
-
-            binary_data = bytearray(BLOCK_SIZE_BYTES)
-            binary_data[:len(node_binary)] = node_binary
-
+            self._keep_version(node.pointer)
             # save to file only when cache space needs to be freed
-            self._file.seek(node.pointer.block_number * BLOCK_SIZE_BYTES)
-            self._file.write(binary_data)
+            self._write_page(node.pointer, node.to_binary())
             # self._cache[node.pointer] = node
 
     def read_page(self, pointer: PagePointer) -> 'PersBTreeNode':
         with self._lock:
             # if pointer not in self._cache:
-            self._file.seek(pointer.block_number * BLOCK_SIZE_BYTES)
-            data = self._file.read(BLOCK_SIZE_BYTES)
-            data = PersBTreeNode.from_binary(pointer, data, self._max_keys, self, self._lock_manager)
-            return data
+            return self._read_page(pointer)
 
     def read_page_or_get_empty(self, pointer: PagePointer) -> 'PersBTreeNode':
         with self._lock:
             # if pointer not in self._cache:
-            self._file.seek(pointer.block_number * BLOCK_SIZE_BYTES)
-            data = self._file.read(BLOCK_SIZE_BYTES)
+            data = self._read_block(pointer)
             if len(data) == 0:
                 data = PersBTreeNodeLeaf(pointer, [], [], [], self._max_keys,
                                          None, None, self, self._lock_manager)
             else:
                 data = PersBTreeNode.from_binary(pointer, data, self._max_keys, self,
-                                                 self._lock_manager)
+                                                 self._lock_manager, self._max_leaf_keys)
             return data
 
     def read_debug(self, pointer: PagePointer):
-        self._file.seek(pointer.block_number * BLOCK_SIZE_BYTES)
-        return PersBTreeNode.from_binary(pointer, self._file.read(BLOCK_SIZE_BYTES), 3, None, None)
+        return PersBTreeNode.from_binary(pointer, self._read_block(pointer), 3, None, None)
 
     def save_new_page(self, node: 'PersBTreeNode') -> 'PersBTreeNode':
         with self._lock:
             node_binary = node.to_binary()
-            if len(node_binary) > BLOCK_SIZE_BYTES:
-                raise PageOverflowException(f"Trying to {len(bytes)}, maximum page size is: {BLOCK_SIZE_BYTES}")
-            binary_data = bytearray(BLOCK_SIZE_BYTES)
-            binary_data[:len(node_binary)] = node_binary
-
-            offset = self._seek_to_end()
-            new_node_pointer = PagePointer(offset // BLOCK_SIZE_BYTES)
+            new_node_pointer = self._allocate_page()
+            for snapshot in self._snapshots:
+                snapshot._new_pages.add(new_node_pointer)
             # save to file only when cache space needs to be freed
-            self._file.write(binary_data)
+            self._write_page(new_node_pointer, node_binary)
             # self._cache[new_node_pointer] = node
             node.pointer = new_node_pointer
         return node
 
-    def _seek_to_end(self):
-        return self._file.seek(0, os.SEEK_END)
+    def read_block(self, pointer: PagePointer) -> bytes:
+        # raw pages of the indexes laid out differently than the tree nodes
+        with self._lock:
+            return self._read_block(pointer)
+
+    def save_block(self, pointer: PagePointer, data: bytes):
+        with self._lock:
+            self._keep_version(pointer)
+            self._write_page(pointer, data)
+
+    def save_new_block(self, data: bytes) -> PagePointer:
+        with self._lock:
+            pointer = self._allocate_page()
+            for snapshot in self._snapshots:
+                snapshot._new_pages.add(pointer)
+            self._write_page(pointer, data)
+            return pointer
+
+    def read_ahead(self, pointer: PagePointer) -> bytes:
+        # for the prefetching threads, the file is read without holding the lock, so the page is cached
+        # only if it has not been written in the meantime and no later read ahead of it has started
+        with self._lock:
+            data = self._unlogged.get(pointer) or self._logged.get(pointer) or self._cache.get(pointer)
+            if data is not None or not self._cache_pages:
+                return data
+            self._file.flush()
+            token = self._read_ahead[pointer] = object()
+        data = os.pread(self._file.fileno(), BLOCK_SIZE_BYTES, pointer.block_number * BLOCK_SIZE_BYTES)
+        with self._lock:
+            if self._read_ahead.get(pointer) is token:
+                del self._read_ahead[pointer]
+                if data:
+                    self._cache_block(pointer, data)
+        return data
+
+    def free_page(self, pointer: PagePointer):
+        # the caller guarantees that the page is not reachable from the tree anymore
+        with self._lock:
+            self._keep_version(pointer)
+            if self._log is None:
+                self._free_page(pointer)
+            else:
+                # linked into the free list once the change unlinking it is logged, so it is not reused before
+                self._writes().frees.append(pointer)
+
+    def log_writes(self):
+        # pages written by the current thread are logged as one record
+        with self._lock:
+            self._log_writes()
+
+    def checkpoint(self):
+        # logged pages are written to the file in any order, then the log is not needed anymore
+        with self._lock:
+            self._log_writes()
+            self._checkpoint()
+
+    def open_snapshot(self, root: 'PersBTreeNode') -> 'PageSnapshot':
+        # the caller guarantees that no page is being written, the root is taken from memory,
+        # as its page is written in place only by some of the writers
+        with self._lock:
+            snapshot = PageSnapshot(self, root.pointer, root.to_binary(), self._pages_count)
+            self._snapshots.append(snapshot)
+            return snapshot
+
+    def read_snapshot_page(self, snapshot: 'PageSnapshot', pointer: PagePointer) -> 'PersBTreeNode':
+        with self._lock:
+            if snapshot.closed:
+                raise ValueError("Snapshot is closed")
+            if pointer == snapshot.root_pointer:
+                data = snapshot.root_binary
+            else:
+                data = self._read_block(snapshot._versions.get(pointer, pointer))
+            return PersBTreeNode.from_binary(pointer, data, self._max_keys, self, self._lock_manager,
+                                             self._max_leaf_keys)
+
+    def close_snapshot(self, snapshot: 'PageSnapshot'):
+        # copies no other snapshot refers to are freed
+        with self._lock:
+            if snapshot.closed:
+                return
+            snapshot.closed = True
+            self._snapshots.remove(snapshot)
+            for version in snapshot._versions.values():
+                self._version_refs[version] -= 1
+                if not self._version_refs[version]:
+                    del self._version_refs[version]
+                    self._free_page(version)
+            self._log_writes()
+
+    def close_snapshots(self):
+        for snapshot in list(self._snapshots):
+            self.close_snapshot(snapshot)
+
+    def snapshot_pages_count(self) -> int:
+        with self._lock:
+            return len(self._version_refs)
+
+    def free_pages_count(self) -> int:
+        with self._lock:
+            return self._free_pages_count
+
+    def truncate_free_pages(self) -> int:
+        # cuts off free pages at the end of the file, the remaining ones are relinked in ascending order,
+        # so the pages near the beginning are reused first and the end of the file keeps becoming free
+        with self._lock:
+            free_pages = []
+            pointer = self._free_list_head
+            while pointer is not None:
+                free_pages.append(pointer.block_number)
+                pointer = self._read_page(pointer).next
+            pages_count = self._pages_count
+            new_pages_count = pages_count
+            free_blocks = set(free_pages)
+            while new_pages_count - 1 in free_blocks:
+                new_pages_count -= 1
+
+            kept_pages = sorted(p for p in free_pages if p < new_pages_count)
+            for i, block_number in enumerate(kept_pages):
+                next_free = PagePointer(kept_pages[i + 1]) if i + 1 < len(kept_pages) else None
+                self._write_page(PagePointer(block_number), self._free_page_binary(PagePointer(block_number), next_free))
+            self._free_list_head = PagePointer(kept_pages[0]) if kept_pages else None
+            self._free_pages_count = len(kept_pages)
+            self._save_header()
+            if self._log is not None:
+                # the log must not bring back the cut off pages
+                self._log_writes()
+                self._checkpoint()
+            self._file.truncate(new_pages_count * BLOCK_SIZE_BYTES)
+            self._pages_count = new_pages_count
+            for pointer in [p for p in self._cache if p.block_number >= new_pages_count]:
+                del self._cache[pointer]
+            self._read_ahead.clear()
+            for snapshot in self._snapshots:
+                snapshot._end = min(snapshot._end, new_pages_count)
+            return pages_count - new_pages_count
+
+    def end_pointer(self) -> PagePointer:
+        with self._lock:
+            return PagePointer(self._pages_count)
+
+    def save_page_run(self, nodes: typing.List['PersBTreeNode']):
+        # writes nodes occupying consecutive pages with a single write call
+        with self._lock:
+            binary_data = bytearray(BLOCK_SIZE_BYTES * len(nodes))
+            for i, node in enumerate(nodes):
+                assert node.pointer.block_number == nodes[0].pointer.block_number + i
+                node_binary = node.to_binary()
+                if len(node_binary) > BLOCK_SIZE_BYTES:
+                    raise PageOverflowException(f"Trying to {len(node_binary)}, maximum page size is: {BLOCK_SIZE_BYTES}")
+                binary_data[i * BLOCK_SIZE_BYTES:i * BLOCK_SIZE_BYTES + len(node_binary)] = node_binary
+            # new pages are not reachable before some logged change links them, so they bypass the log
+            self._file.seek(nodes[0].pointer.block_number * BLOCK_SIZE_BYTES)
+            self._file.write(binary_data)
+            for i, node in enumerate(nodes):
+                self._read_ahead.pop(node.pointer, None)
+                self._cache_block(node.pointer, binary_data[i * BLOCK_SIZE_BYTES:(i + 1) * BLOCK_SIZE_BYTES])
+            self._pages_count = max(self._pages_count, nodes[-1].pointer.block_number + 1)
+            self._direct_writes = self._log is not None
+
+    def _allocate_page(self) -> PagePointer:
+        if self._free_list_head is None:
+            self._pages_count += 1
+            return PagePointer(self._pages_count - 1)
+        pointer = self._free_list_head
+        self._free_list_head = self._read_page(pointer).next
+        self._free_pages_count -= 1
+        self._save_header()
+        return pointer
+
+    def _free_page(self, pointer: PagePointer):
+        self._write_page(pointer, self._free_page_binary(pointer, self._free_list_head))
+        self._free_list_head = pointer
+        self._free_pages_count += 1
+        self._save_header()
+
+    def _keep_version(self, pointer: PagePointer):
+        # a single copy is shared by all the snapshots which still see the page as it is now
+        snapshots = [s for s in self._snapshots if s._sees_page_on_disk(pointer)]
+        if not snapshots:
+            return
+        data = self._read_block(pointer)
+        version = self._allocate_page()
+        self._write_page(version, data)
+        self._version_refs[version] = len(snapshots)
+        for snapshot in snapshots:
+            snapshot._versions[pointer] = version
+
+    def _read_page(self, pointer: PagePointer) -> 'PersBTreeNode':
+        data = self._read_block(pointer)
+        return PersBTreeNode.from_binary(pointer, data, self._max_keys, self, self._lock_manager, self._max_leaf_keys)
+
+    def _read_block(self, pointer: PagePointer) -> bytes:
+        data = self._unlogged.get(pointer) or self._logged.get(pointer)
+        if data is None:
+            data = self._cache.get(pointer)
+            if data is not None:
+                self._cache.move_to_end(pointer)
+                return data
+            self._file.seek(pointer.block_number * BLOCK_SIZE_BYTES)
+            data = self._file.read(BLOCK_SIZE_BYTES)
+            if data:
+                self._cache_block(pointer, data)
+        return data
+
+    def _cache_block(self, pointer: PagePointer, data: typing.Union[bytes, bytearray]):
+        if not self._cache_pages:
+            return
+        self._cache[pointer] = bytes(data)
+        self._cache.move_to_end(pointer)
+        if len(self._cache) > self._cache_pages:
+            self._cache.popitem(last=False)
+
+    def _write_page(self, pointer: PagePointer, node_binary: bytes):
+        if len(node_binary) > BLOCK_SIZE_BYTES:
+            raise PageOverflowException(f"Trying to {len(node_binary)}, maximum page size is: {BLOCK_SIZE_BYTES}")
+        binary_data = bytearray(BLOCK_SIZE_BYTES)
+        binary_data[:len(node_binary)] = node_binary
+        self._pages_count = max(self._pages_count, pointer.block_number + 1)
+        self._read_ahead.pop(pointer, None)
+        self._cache_block(pointer, binary_data)
+        if self._log is None:
+            self._write_block(pointer, binary_data)
+        elif pointer == HEADER_PAGE:
+            # goes with the next record of any thread, a crash may only leak the pages taken by not logged changes
+            self._logged[pointer] = bytes(binary_data)
+            self._header_logged = False
+        else:
+            self._unlogged[pointer] = bytes(binary_data)
+            self._writes().pages[pointer] = None
+
+    def _write_block(self, pointer: PagePointer, data: bytes):
+        self._file.seek(pointer.block_number * BLOCK_SIZE_BYTES)
+        self._file.write(data)
+
+    def _writes(self) -> '_ThreadWrites':
+        if not hasattr(self._thread_writes, 'pages'):
+            self._thread_writes.pages = {}
+            self._thread_writes.frees = []
+        return self._thread_writes
+
+    def _before_write_release(self, pointer: PagePointer):
+        if pointer in self._writes().pages:
+            self.log_writes()
+
+    def _log_writes(self):
+        writes = self._writes()
+        if not writes.pages and not writes.frees:
+            return
+        for pointer in writes.frees:
+            self._free_page(pointer)
+        writes.frees.clear()
+        pages = [(pointer, self._unlogged.pop(pointer)) for pointer in writes.pages if pointer in self._unlogged]
+        writes.pages.clear()
+        if not self._header_logged:
+            pages.append((HEADER_PAGE, self._logged[HEADER_PAGE]))
+            self._header_logged = True
+        if self._direct_writes:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._direct_writes = False
+        self._log.append(pages)
+        self._logged.update(pages)
+        # every logged page is in the log at least once, so this bounds both of them
+        if self._log.size() >= self._checkpoint_pages * BLOCK_SIZE_BYTES:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        if self._log is None:
+            return
+        self._log.sync()
+        for pointer in sorted(self._logged, key=lambda p: p.block_number):
+            self._write_block(pointer, self._logged[pointer])
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._log.truncate()
+        self._logged.clear()
+        self._header_logged = True
+
+    def _recover(self):
+        # pages of the complete records are written in the log order, a torn last record is dropped
+        replayed = False
+        for pages in self._log.records():
+            for pointer, data in pages:
+                self._write_block(pointer, data)
+            replayed = True
+        if replayed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._log.truncate()
+
+    def _free_page_binary(self, pointer: PagePointer, next_free: typing.Optional[PagePointer]) -> bytes:
+        # free page is an empty leaf linking the next free one, so a stale pointer never reads garbage
+        return PersBTreeNodeLeaf(pointer, [], [], [], self._max_keys, next_free, None, self,
+                                 self._lock_manager).to_binary()
+
+    def _load_header(self):
+        with self._lock:
+            self._file.seek(HEADER_PAGE.block_number * BLOCK_SIZE_BYTES)
+            data = self._file.read(BLOCK_SIZE_BYTES)
+            if not data:
+                self._save_header()
+                return
+            buff = io.BytesIO(data)
+            self._free_list_head = PagePointer.from_binary(buff)
+            self._free_pages_count = int.from_bytes(buff.read(FREE_PAGES_COUNT_BYTES), INT_ENCODING)
+
+    def _save_header(self):
+        header = io.BytesIO()
+        header.write(self._free_list_head.to_binary() if self._free_list_head else PagePointer.binary_none())
+        header.write(self._free_pages_count.to_bytes(FREE_PAGES_COUNT_BYTES, INT_ENCODING))
+        self._write_page(HEADER_PAGE, header.getvalue())
+
+
+@private
+class PageSnapshot:
+    def __init__(self, page_manager: PageManager, root_pointer: PagePointer, root_binary: bytes, end: int):
+        self.page_manager = page_manager
+        self.root_pointer = root_pointer
+        self.root_binary = root_binary
+        self.closed = False
+        self._end = end  # pages from here on did not exist yet
+        self._new_pages: typing.Set[PagePointer] = set()  # taken from the free list after opening
+        self._versions: typing.Dict[PagePointer, PagePointer] = {}  # changed pages to their copies
+
+    def read_page(self, pointer: PagePointer) -> 'PersBTreeNode':
+        return self.page_manager.read_snapshot_page(self, pointer)
+
+    def close(self):
+        self.page_manager.close_snapshot(self)
+
+    def _sees_page_on_disk(self, pointer: PagePointer) -> bool:
+        return (pointer != self.root_pointer and pointer.block_number < self._end and
+                pointer not in self._new_pages and pointer not in self._versions)
 
 
 class PageOverflowException(RuntimeError):
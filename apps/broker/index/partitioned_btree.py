@@ -0,0 +1,110 @@
+import heapq
+import os
+import re
+import typing
+import zlib
+from operator import itemgetter
+
+from apps.broker.index.node_codec import MAX_BYTES_KEY_LENGTH
+from apps.broker.index.persistent_btree import PersBTree
+from apps.broker.index.persistent_data import INT_ENCODING, PAGE_KEY_BYTES
+from apps.broker.storage.storage_engine import DbRecordPointer, STR_ENCODING
+
+PARTITION_FILE_PATTERN = re.compile(r'partition-(\d+)')
+MAX_INT_KEY = 2 ** (8 * PAGE_KEY_BYTES) - 1
+MAX_STR_KEY = chr(0x10ffff) * (MAX_BYTES_KEY_LENGTH // 4)  # four utf-8 bytes each
+
+
+class PartitionedPersBTree:
+    # independent trees in one directory, a key lives in the tree chosen by its hash, so threads working
+    # on different keys rarely meet on the same root latch, ordered reads merge the results of all the trees
+    def __init__(self, index_dir_path: str, partitions: int, max_keys: typing.Optional[int] = None,
+                 key_type: type = int, **tree_options):
+        if partitions < 1:
+            raise ValueError(f"Partitions count has to be positive, got {partitions}")
+        self._index_dir_path = index_dir_path
+        self._key_type = key_type
+        self._trees = [PersBTree(os.path.join(index_dir_path, f'partition-{i}'), max_keys, key_type, **tree_options)
+                       for i in range(partitions)]
+
+    def insert(self, key, value: DbRecordPointer):
+        self._tree(key).insert(key, value)
+
+    def insert_many(self, items: typing.Iterable[typing.Tuple[typing.Any, DbRecordPointer]]):
+        # not atomic across the partitions
+        for tree, tree_items in self._by_tree(items, itemgetter(0)):
+            tree.insert_many(tree_items)
+
+    def upsert(self, key, value: DbRecordPointer) -> typing.Optional[DbRecordPointer]:
+        return self._tree(key).upsert(key, value)
+
+    def update(self, key, value: DbRecordPointer):
+        self._tree(key).update(key, value)
+
+    def delete(self, key) -> None:
+        self._tree(key).delete(key)
+
+    def find(self, key) -> typing.Optional[DbRecordPointer]:
+        return self._tree(key).find(key)
+
+    def find_many(self, keys: typing.Iterable) -> typing.List[typing.Optional[DbRecordPointer]]:
+        keys = list(keys)
+        found = {}
+        for tree, tree_keys in self._by_tree(keys, lambda key: key):
+            found.update(zip(tree_keys, tree.find_many(tree_keys)))
+        return [found[key] for key in keys]
+
+    def find_range(self, lo, hi) -> typing.List[typing.Tuple[typing.Any, DbRecordPointer]]:
+        # every tree is scanned on its own, so the result is not a snapshot of the whole index
+        return list(heapq.merge(*(tree.find_range(lo, hi) for tree in self._trees), key=itemgetter(0)))
+
+    def items(self) -> typing.List[typing.Tuple[typing.Any, DbRecordPointer]]:
+        if self._key_type is int:
+            return self.find_range(0, MAX_INT_KEY)
+        if self._key_type is str:
+            return self.find_range('', MAX_STR_KEY)
+        return self.find_range(b'', b'\xff' * MAX_BYTES_KEY_LENGTH)
+
+    def count_range(self, lo, hi) -> int:
+        return sum(tree.count_range(lo, hi) for tree in self._trees)
+
+    def _tree(self, key) -> PersBTree:
+        return self._trees[self._partition(key)]
+
+    def _by_tree(self, elements: typing.Iterable, key_of: typing.Callable) \
+            -> typing.Iterator[typing.Tuple[PersBTree, typing.List]]:
+        partitioned = [[] for _ in self._trees]
+        for element in elements:
+            partitioned[self._partition(key_of(element))].append(element)
+        return ((tree, part) for tree, part in zip(self._trees, partitioned) if part)
+
+    def _partition(self, key) -> int:
+        # python hashes of strings differ between processes, so a checksum of the stored key is used
+        if self._key_type is int:
+            key = key.to_bytes(PAGE_KEY_BYTES, INT_ENCODING)
+        elif self._key_type is str:
+            key = key.encode(STR_ENCODING)
+        return zlib.crc32(key) % len(self._trees)
+
+    def _check_partitions(self):
+        existing = [name for name in os.listdir(self._index_dir_path) if PARTITION_FILE_PATTERN.fullmatch(name)]
+        if existing and len(existing) != len(self._trees):
+            raise ValueError(f"Index {self._index_dir_path} has {len(existing)} partitions, "
+                             f"it can not be opened with {len(self._trees)}")
+
+    def __enter__(self) -> 'PartitionedPersBTree':
+        os.makedirs(self._index_dir_path, exist_ok=True)
+        self._check_partitions()
+        entered = []
+        try:
+            for tree in self._trees:
+                entered.append(tree.__enter__())
+        except BaseException:
+            for tree in entered:
+                tree.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for tree in self._trees:
+            tree.__exit__(exc_type, exc_val, exc_tb)
@@ -1,27 +1,40 @@
-import io
+import bisect
+import contextlib
 import logging
 import os
 import threading
 import typing
-from dataclasses import dataclass
-from enum import Enum
+from dataclasses import dataclass, field
+from operator import itemgetter
 
+from apps.broker.concurrent.utils import LockType, RWLock
+from apps.broker.index.bloom_filter import BloomFilter
+from apps.broker.index.external_sort import DEFAULT_SORT_BUFFER_RECORDS, external_sort
 from apps.broker.index.lock_manager import LockManager
-from apps.broker.index.persistent_data import PagePointer, PersKey
-from apps.broker.storage.storage_engine import DbRecordPointer, INT_ENCODING
-
-MAX_KEYS_LENGTH_BYTES = 1  # max 255 keys
-MAX_VALUES_LENGTH_BYTES = 1  # max 255 keys
-MAX_CHILDREN_LENGTH_BYTES = 1  # max 255 keys
-
-
-class LockType(Enum):
-    READ = 1
-    WRITE = 2
+from apps.broker.index.node_codec import BYTES_KEY_HEADER, CHILD_SIZE, LEAF_TRAILER, MAX_BYTES_KEY_ENTRY_SIZE, \
+    MAX_BYTES_KEY_LENGTH, MAX_BYTES_LEAF_TRAILER_SIZE, NODE_HEADER_SIZE, SUBTREE_COUNT_SIZE, VALUE_SIZE, PackedNode, \
+    common_prefix_length, compressed_leaf_size, max_bytes_keys_for_page, max_compressed_leaf_keys_for_page, \
+    compressed_values_bounds, max_counted_keys_for_page, max_keys_for_page, pack_compressed_leaf, pack_leaf_trailer, \
+    pack_node
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PAGE_KEY_BYTES, PagePointer, PersKey
+from apps.broker.index.prefetcher import PagePrefetcher
+from apps.broker.index.write_ahead_log import WriteAheadLog
+from apps.broker.storage.storage_engine import DbRecordPointer, STR_ENCODING
+
+LEAF_INCOMPLETE_SPLIT_FLAG = 0b01  # right sibling is reachable only by the right-link, not from the parent yet
+LEAF_HAS_HIGH_KEY_FLAG = 0b10
+PAGE_MAX_KEYS = max_keys_for_page(BLOCK_SIZE_BYTES)
+BYTES_KEYS_PAGE_MAX_KEYS = max_bytes_keys_for_page(BLOCK_SIZE_BYTES)
+COMPRESSED_LEAF_MAX_KEYS = max_compressed_leaf_keys_for_page(BLOCK_SIZE_BYTES)
+COUNTED_PAGE_MAX_KEYS = max_counted_keys_for_page(BLOCK_SIZE_BYTES)
+
+BULK_LOAD_WRITE_BATCH_PAGES = 64
+REBUILD_CATCH_UP_ROUNDS = 3  # copies of the changed keys made while the writers go on
+REBUILD_FINAL_DELTA_KEYS = 1000  # at most that many are copied with the writers held off, unless they keep up
 
 
 class LockState:
-    def __init__(self, lock: threading.Lock, acquired: bool, permanent: bool):
+    def __init__(self, lock, acquired: bool, permanent: bool):
         self.lock = lock
         self.acquired = acquired
         self.permanent = permanent
@@ -44,7 +57,7 @@ class LockContext:
     def init_new_level(self):
         self._lock_stack.append([])
 
-    def push(self, lock: threading.Lock, permanent: bool = False) -> LockState:
+    def push(self, lock, permanent: bool = False) -> LockState:
         lock_state = LockState(lock, lock.locked(), permanent)
         self._lock_stack[-1].append(lock_state)
         return lock_state
@@ -70,116 +83,190 @@ class LockContext:
     def get_current_level(self) -> int:
         return len(self._lock_stack) - 1
 
+    def last(self) -> LockState:
+        return self._lock_stack[-1][-1]
+
+
+Key = typing.Union[int, bytes]  # keys of a single tree are either all ints or all byte strings
+T = typing.TypeVar('T')
+
 
 @dataclass
 class DeleteResult:
-    new_first: typing.Optional[PersKey]
+    new_first: typing.Optional[Key]
     condition_of_tree_valid: bool = True
     leaf: bool = False
 
 
 class PersBTreeNode:
     def __init__(self, pointer: typing.Optional[PagePointer],
-                 keys: typing.List[PersKey],
+                 keys: typing.List[Key],
                  children: typing.List[PagePointer],
                  values: typing.List[DbRecordPointer],
                  max_keys: int,
                  page_manager,
-                 lock_manager: LockManager):
+                 lock_manager: LockManager,
+                 subtree_counts: typing.Optional[typing.List[int]] = None):
         self.pointer = pointer
-        self.keys = keys
+        self.keys = keys  # plain ints or byte strings, searched with bisect
         self.children = children
-        self.values = values
+        # keys below every child of an order-statistic tree, right siblings not linked yet are counted with
+        # the leaf linking them
+        self.subtree_counts = subtree_counts
+        self._values = values
+        self._packed: typing.Optional[PackedNode] = None  # source of the values until they are needed
         self._max_keys = max_keys
         self._page_manager = page_manager
         self._lock_manager = lock_manager
 
-    def insert(self, key: PersKey, value: DbRecordPointer, lock_ctx: LockContext) -> 'InsertionResult':
-        save_curr_node = False
+    # structure modifying operations release only the latches taken below them, own latch is released by
+    # the caller which may still need it to publish the result (e.g. the new root after a split)
+    def insert_separator(self, separator: Key, right_pointer: PagePointer,
+                         lock_ctx: LockContext) -> 'InsertionResult':
+        # second phase of a leaf split, links the new right leaf (so far reachable only by the right-link) here
         lock_level = lock_ctx.get_current_level()
         lock_ctx.init_new_level()
         try:
             if self._can_release_parents_locks_on_insert():
                 lock_ctx.release_allowed_parent_locks(lock_level)
-            for i in range(len(self.keys)):
-                if self.keys[i] >= key:
-                    self._lock_child(lock_ctx, self.children[i])
-                    child_node = self._page_manager.read_page(self.children[i])
-                    insertion_result = child_node.append(key, value, lock_ctx)
-                    insert_index = i
-                    break
+            child_index = self._child_index(separator)
+            child_pointer = self.children[child_index]
+            self._lock_child(lock_ctx, child_pointer)
+            child_node = self._page_manager.read_page(child_pointer)
+            split_leaf = None
+            if child_node.is_leaf():
+                split_leaf = self._find_split_leaf(child_node, separator, right_pointer, lock_ctx)
+                if split_leaf is None:
+                    # the split has been already completed by another thread
+                    return InsertionResult(is_new_node=False, updated=self)
+                if right_pointer not in self.children:
+                    self.keys.insert(child_index, separator)
+                    self.children.insert(child_index + 1, right_pointer)
+                    if self.subtree_counts is not None:
+                        moved = self._chain_count(right_pointer)
+                        self.subtree_counts[child_index] -= moved
+                        self.subtree_counts.insert(child_index + 1, moved)
             else:
-                self._lock_child(lock_ctx, self.children[-1])
-                child_node = self._page_manager.read_page(self.children[-1])
-                insertion_result = child_node.append(key, value, lock_ctx)
-                insert_index = len(self.children)
-
-            if insertion_result.is_new_node:
-                save_curr_node = True
-                first_key = insertion_result.record.keys[0]
-                self.keys.insert(insert_index, first_key)
-                if insert_index < len(self.children):
-                    self.children = (self.children[:insert_index] + insertion_result.record.children +
-                                     self.children[insert_index + 1:])
-                else:
-                    self.children.pop()
-                    self.children.extend(insertion_result.record.children)
-
-            if len(self.keys) > self._max_keys:
-                mid = len(self.keys) // 2
-                child_mid = (len(self.children) + 1) // 2
-                left_keys, right_keys = self.keys[:mid], self.keys[mid + 1:]
-                left_children, right_children = self.children[:child_mid], self.children[child_mid:]
-                left_child = PersBTreeNode(None, left_keys, left_children, [], self._max_keys,
-                                           self._page_manager, self._lock_manager)
-                right_child = PersBTreeNode(None, right_keys, right_children, [], self._max_keys,
-                                            self._page_manager, self._lock_manager)
-                left_child = self._page_manager.save_new_page(left_child)
+                insertion_result = child_node.insert_separator(separator, right_pointer, lock_ctx)
+                if not insertion_result.is_new_node:
+                    # own latch may have been already released, so the node must not be touched anymore
+                    return InsertionResult(is_new_node=False, updated=self)
+
+                self.keys.insert(child_index, insertion_result.updated.keys[0])
+                self.children = (self.children[:child_index] + insertion_result.updated.children +
+                                 self.children[child_index + 1:])
+                if self.subtree_counts is not None:
+                    self.subtree_counts = (self.subtree_counts[:child_index] +
+                                           insertion_result.updated.subtree_counts +
+                                           self.subtree_counts[child_index + 1:])
+
+            if self._is_overflowing():
+                # index nodes are split under the latch of their parent, so they need no right-links,
+                # the left half stays in place
+                mid = self._split_index()
+                child_mid = mid + 1
+                separator = self.keys[mid]
+                right_counts = None
+                parent_counts = None
+                if self.subtree_counts is not None:
+                    right_counts = self.subtree_counts[child_mid:]
+                    self.subtree_counts = self.subtree_counts[:child_mid]
+                    parent_counts = [sum(self.subtree_counts), sum(right_counts)]
+                right_child = PersBTreeNode(None, self.keys[mid + 1:], self.children[child_mid:], [], self._max_keys,
+                                            self._page_manager, self._lock_manager, right_counts)
                 right_child = self._page_manager.save_new_page(right_child)
-
-                parent = PersBTreeNode(self.pointer, [self.keys[mid]], [left_child.pointer, right_child.pointer],
-                                       [], self._max_keys, self._page_manager, self._lock_manager)
-                return InsertionResult(is_new_node=True, updated=parent)  # mark self as garbage
-            if save_curr_node:
+                self.keys, self.children = self.keys[:mid], self.children[:child_mid]
                 self._page_manager.save_page(self)
+
+                self._clear_incomplete_split(split_leaf)
+                parent = PersBTreeNode(None, [separator], [self.pointer, right_child.pointer],
+                                       [], self._max_keys, self._page_manager, self._lock_manager, parent_counts)
+                return InsertionResult(is_new_node=True, updated=parent)
+            self._page_manager.save_page(self)
+            self._clear_incomplete_split(split_leaf)
             return InsertionResult(is_new_node=False, updated=self)
         finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+            lock_ctx.release_self_and_child_locks(lock_level + 1)
+
+    def _clear_incomplete_split(self, leaf: typing.Optional['PersBTreeNodeLeaf']):
+        # the flag is cleared only after the separator has been written
+        if leaf is not None:
+            leaf.incomplete_split = False
+            self._page_manager.save_page(leaf)
+
+    def _chain_count(self, pointer: PagePointer) -> int:
+        # keys of the leaf and of its right siblings linked only through it
+        count = 0
+        while True:
+            leaf = self._page_manager.read_page(pointer)
+            count += len(leaf.keys)
+            if not leaf.incomplete_split:
+                return count
+            pointer = leaf.next
+
+    def _move_count(self, source: int, target: int, count: typing.Optional[int] = None):
+        # keys moved between subtrees of two children, all of the source ones by default
+        if self.subtree_counts is not None:
+            count = self.subtree_counts[source] if count is None else count
+            self.subtree_counts[source] -= count
+            self.subtree_counts[target] += count
+
+    def _pop_child(self, i: int) -> PagePointer:
+        if self.subtree_counts is not None:
+            self.subtree_counts.pop(i)
+        return self.children.pop(i)
+
+    def _find_split_leaf(self, leaf: 'PersBTreeNodeLeaf', separator: Key, right_pointer: PagePointer,
+                         lock_ctx: LockContext) -> typing.Optional['PersBTreeNodeLeaf']:
+        # the leaf may have been split again in the meantime, so the flag to clear belongs to the leaf linking
+        # to the new one, all leafs on the way are not linked from the parent either and carry the flag as well,
+        # the new leaf may have been freed by a range deletion and its page reused by another split in between
+        lock_state = lock_ctx.last()
+        while leaf.incomplete_split:
+            if leaf.next == right_pointer and leaf.high_key == separator:
+                return leaf
+            next_lock_state = leaf._lock_child(lock_ctx, leaf.next)
+            lock_state.release()
+            lock_state = next_lock_state
+            leaf = self._page_manager.read_page(leaf.next)
+        return None
 
-    def delete(self, key: PersKey, lock_ctx: LockContext) -> DeleteResult:
+    def delete(self, key: Key, lock_ctx: LockContext) -> DeleteResult:
         save_curr_node = False
+        merged_children = False
         lock_level = lock_ctx.get_current_level()
         lock_ctx.init_new_level()
 
         try:
-            if self.can_release_parents_locks_on_delete():
+            parents_released = self.can_release_parents_locks_on_delete()
+            if parents_released:
                 lock_ctx.release_allowed_parent_locks(lock_level)
 
             # search for key to delete
-            for i in range(len(self.keys)):
-                if self.keys[i] > key:
-                    break
-            else:
-                i = len(self.keys)
-
-            child_pointer = self.children[i]
-            lock_state = self._lock_child(lock_ctx, child_pointer)
-            child = self._page_manager.read_page(child_pointer)
-            lock_state.permanent = key in child.keys
+            i = self._child_index(key)
 
-            # take locks upfront, do not try to optimize and take all that may be needed
+            # take locks upfront, do not try to optimize and take all that may be needed,
+            # siblings are locked from left to right, the same order leaf scans use
             left_child = None
             right_child = None
             if i > 0:
                 self._lock_child(lock_ctx, self.children[i - 1])
                 left_child = self._page_manager.read_page(self.children[i - 1])
-                if child.is_leaf() and not child.can_release_parents_locks_on_delete() and left_child.prev:
-                    self._try_lock_child_or_throw(lock_ctx, left_child.prev)
+
+            child_pointer = self.children[i]
+            lock_state = self._lock_child(lock_ctx, child_pointer)
+            child = self._page_manager.read_page(child_pointer)
+            lock_state.permanent = key in child.keys
+
             if i + 1 < len(self.children):
                 self._lock_child(lock_ctx, self.children[i + 1])
                 right_child = self._page_manager.read_page(self.children[i + 1])
-                if child.is_leaf() and not child.can_release_parents_locks_on_delete() and right_child.next:
-                    self._try_lock_child_or_throw(lock_ctx, right_child.next)
+
+            if child.is_leaf():
+                # leafs not linked from the parent yet would be lost by rebalancing, give up before any change
+                for leaf in [left_child, child, right_child]:
+                    if leaf and leaf.incomplete_split:
+                        raise IncompleteSplitException(f"Split of {leaf.pointer} is not completed", leaf.pointer)
 
             delete_res = child.delete(key, lock_ctx)
 
@@ -192,22 +279,26 @@ class PersBTreeNode:
             borrowed_from_right_child = False
             if delete_res.leaf and not delete_res.condition_of_tree_valid:
                 if i > 0:
-                    if left_child.has_enough_to_lend():
+                    if left_child.has_enough_to_lend() and self._can_rebalance_through(left_child):
                         # borrow right-most key from left child
                         borrowed_right_most_key = left_child.keys.pop()
-                        child.keys.append(0, borrowed_right_most_key)
-                        child.values.append(0, left_child.values.pop())
+                        child.keys.insert(0, borrowed_right_most_key)
+                        child.values.insert(0, left_child.values.pop())
                         self.keys[i - 1] = borrowed_right_most_key
+                        self._move_count(i - 1, i, 1)
+                        left_child.high_key = borrowed_right_most_key
                         self._page_manager.save_page(left_child)
                         self._page_manager.save_page(child)
                         save_curr_node = True
                         borrowed_from_left_child = True
                 if not borrowed_from_left_child and i + 1 < len(self.children):
-                    if right_child.has_enough_to_lend():
+                    if right_child.has_enough_to_lend() and self._can_rebalance_through(right_child):
                         # borrow left-most key from right child
                         borrowed_left_most_key = right_child.keys.pop(0)
                         child.keys.append(borrowed_left_most_key)
                         child.values.append(right_child.values.pop(0))
+                        child.high_key = right_child.keys[0]
+                        self._move_count(i + 1, i, 1)
                         self._page_manager.save_page(right_child)
                         self._page_manager.save_page(child)
                         if i > 0:
@@ -217,60 +308,52 @@ class PersBTreeNode:
                         borrowed_from_right_child = True
                 if not borrowed_from_left_child and not borrowed_from_right_child:
                     # we still have invalid child and have to merge
-                    if i > 0:
-                        # merge with left child
-                        new_keys = left_child.keys + child.keys
-                        new_values = left_child.values + child.values
-                        child.keys = new_keys
-                        child.values = new_values
-                        left_child.keys = []
-                        left_child.values = []
-                        # update leaf pointers
+                    if i > 0 and left_child.can_merge(child):
+                        # merge with left child, the left one stays in place so no other leaf points to a removed one
                         assert isinstance(left_child, PersBTreeNodeLeaf)
                         assert isinstance(child, PersBTreeNodeLeaf)
-                        if left_child.prev:
-                            prev_child = self._page_manager.read_page(left_child.prev)
-                            assert isinstance(prev_child, PersBTreeNodeLeaf)
-                            prev_child.next = self.children[i]
-                            self._page_manager.save_page(prev_child)
-                        child.prev = left_child.prev
+                        left_child.keys = left_child.keys + child.keys
+                        left_child.values = left_child.values + child.values
+                        left_child.next = child.next
+                        left_child.high_key = child.high_key
 
-                        self._page_manager.save_page(child)
+                        self._page_manager.save_page(left_child)
                         save_curr_node = True
                         self.keys.pop(i - 1)
-                        self.children.pop(i - 1)  # TODO mark node as garbage
-                    elif i + 1 < len(self.children):
+                        self._move_count(i, i - 1)
+                        self._page_manager.free_page(self._pop_child(i))
+                        merged_children = True
+                    elif i + 1 < len(self.children) and child.can_merge(right_child):
                         # merge with right child
-                        new_keys = child.keys + right_child.keys
-                        new_values = child.values + right_child.values
-                        child.keys = new_keys
-                        child.values = new_values
-                        right_child.keys = []
-                        right_child.values = []
-                        # update leaf pointers
                         assert isinstance(right_child, PersBTreeNodeLeaf)
                         assert isinstance(child, PersBTreeNodeLeaf)
-                        if right_child.next:
-                            next_child = self._page_manager.read_page(right_child.next)
-                            assert isinstance(next_child, PersBTreeNodeLeaf)
-                            next_child.prev = self.children[i]
-                            self._page_manager.save_page(next_child)
+                        child.keys = child.keys + right_child.keys
+                        child.values = child.values + right_child.values
                         child.next = right_child.next
+                        child.high_key = right_child.high_key
 
                         self._page_manager.save_page(child)
                         save_curr_node = True
 
                         self.keys.pop(i)
-                        self.children.pop(i + 1)  # TODO mark node as garbage
+                        self._move_count(i + 1, i)
+                        self._page_manager.free_page(self._pop_child(i + 1))
+                        merged_children = True
+                    else:
+                        # byte string and compressed leafs not fitting into a single page stay less than half full
+                        self._page_manager.save_page(child)
                 delete_res.new_first = self._get_new_first()
             # try to borrow from sibling being grandfather
             if not delete_res.leaf and not delete_res.condition_of_tree_valid:
                 if i > 0:
-                    if left_child.has_enough_to_lend():
+                    if left_child.has_enough_to_lend() and self._can_rebalance_through(left_child):
                         # borrow right-most child from left child
                         child.children.insert(0, left_child.children.pop())
+                        if self.subtree_counts is not None:
+                            child.subtree_counts.insert(0, left_child.subtree_counts.pop())
+                            self._move_count(i - 1, i, child.subtree_counts[0])
                         # it may happen that we need to only override the key or that we need to add a new one
-                        if child.has_enough_keys():
+                        if len(child.children) == len(child.keys) + 1:
                             child.keys[0] = self.keys[i - 1]
                         else:
                             child.keys.insert(0, self.keys[i - 1])
@@ -280,11 +363,14 @@ class PersBTreeNode:
                         save_curr_node = True
                         borrowed_from_left_child = True
                 if not borrowed_from_left_child and i + 1 < len(self.children):
-                    if right_child.has_enough_to_lend():
+                    if right_child.has_enough_to_lend() and self._can_rebalance_through(right_child):
                         # borrow left-most key from right child
                         child.children.append(right_child.children.pop(0))
+                        if self.subtree_counts is not None:
+                            child.subtree_counts.append(right_child.subtree_counts.pop(0))
+                            self._move_count(i + 1, i, child.subtree_counts[-1])
                         # it may happen that we need to only override the key or that we need to add a new one
-                        if child.has_enough_keys():
+                        if len(child.children) == len(child.keys) + 1:
                             child.keys[-1] = self.keys[i]
                         else:
                             child.keys.append(self.keys[i])
@@ -295,76 +381,65 @@ class PersBTreeNode:
                         borrowed_from_right_child = True
                 if not borrowed_from_left_child and not borrowed_from_right_child:
                     # we still have the invalid child and have to merge
-                    if i > 0:
+                    if i > 0 and left_child.can_merge(child, self.keys[i - 1]):
                         # merge with left child
                         new_children = left_child.children + child.children
                         new_keys = left_child.keys + [self.keys.pop(i - 1)] + child.keys
                         left_child.children = new_children
                         left_child.keys = new_keys
+                        if self.subtree_counts is not None:
+                            left_child.subtree_counts = left_child.subtree_counts + child.subtree_counts
+                            self._move_count(i, i - 1)
                         self._page_manager.save_page(left_child)
                         save_curr_node = True
-                        self.children.pop(i)  # TODO mark node as garbage
-                    elif i + 1 < len(self.children):
+                        self._page_manager.free_page(self._pop_child(i))
+                        merged_children = True
+                    elif i + 1 < len(self.children) and child.can_merge(right_child, self.keys[i]):
                         # merge with right child
                         new_children = child.children + right_child.children
                         new_keys = child.keys + [self.keys.pop(i)] + right_child.keys
                         right_child.children = new_children
                         right_child.keys = new_keys
+                        if self.subtree_counts is not None:
+                            right_child.subtree_counts = child.subtree_counts + right_child.subtree_counts
+                            self._move_count(i, i + 1)
                         self._page_manager.save_page(right_child)
                         save_curr_node = True
-                        self.children.pop(i)  # TODO mark node as garbage
-                    else:
+                        self._page_manager.free_page(self._pop_child(i))
+                        merged_children = True
+                    elif not self._has_bytes_keys():
                         print("Impossibru...")
 
-            # we are a parent, we deleted from leaf and tried to restore the tree condition
-            delete_res.condition_of_tree_valid = self._is_at_least_half_full()
+            # we are a parent, we deleted from leaf and tried to restore the tree condition, only a merge
+            # removes a key here, byte string nodes may be less than half full already or shrink by shorter separators
+            delete_res.condition_of_tree_valid = (parents_released or not merged_children or
+                                                  self._is_at_least_half_full())
             delete_res.leaf = False
             if save_curr_node:
                 self._page_manager.save_page(self)
             return delete_res
         finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
-
-    def find(self, key: PersKey, lock_ctx: LockContext) -> DbRecordPointer:
-        lock_level = lock_ctx.get_current_level()
-        lock_ctx.init_new_level()
-
-        for i in range(len(self.keys)):
-            if self.keys[i] > key:
-                break
-        else:
-            i = len(self.keys)
-
-        try:
-            child_pointer = self.children[i]
-            self._lock_child(lock_ctx, child_pointer)
-            lock_ctx.release_allowed_parent_locks(lock_level)
-            child = self._page_manager.read_page(child_pointer)
-            return child.find(key, lock_ctx)
-        finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+            lock_ctx.release_self_and_child_locks(lock_level + 1)
 
-    def update(self, key: PersKey, value: DbRecordPointer, lock_ctx: LockContext):
+    def lock_leaf(self, key: Key, lock_ctx: LockContext, leaf_lock_type: LockType) -> 'PersBTreeNodeLeaf':
+        # descends coupling shared latches, only the leaf is latched with the requested type
         lock_level = lock_ctx.get_current_level()
         lock_ctx.init_new_level()
-
-        for i in range(len(self.keys)):
-            if self.keys[i] > key:
-                break
-        else:
-            i = len(self.keys)
-
-        try:
-            child_pointer = self.children[i]
+        child_pointer = self.children[self._child_index(key)]
+        lock_state = self._lock_child(lock_ctx, child_pointer, lock_type=LockType.READ)
+        child = self._page_manager.read_page(child_pointer)
+        if child.is_leaf() and leaf_lock_type is LockType.WRITE:
+            # the parent is still latched, so the leaf cannot be merged in the meantime, a split is handled by moving right
+            lock_state.release()
             self._lock_child(lock_ctx, child_pointer)
-            lock_ctx.release_allowed_parent_locks(lock_level)
             child = self._page_manager.read_page(child_pointer)
-            return child.update(key, value, lock_ctx)
-        finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+        lock_ctx.release_allowed_parent_locks(lock_level + 1)
+        if child.is_leaf():
+            return child.move_right(key, lock_ctx, leaf_lock_type)
+        return child.lock_leaf(key, lock_ctx, leaf_lock_type)
 
     def has_enough_to_lend(self):
-        return len(self.keys) > self._max_keys // 2
+        return len(self.keys) > self._max_keys // 2 or self._fills_half_page_after_removal()
 
     def is_leaf(self):
         return not self.children
@@ -376,75 +451,134 @@ class PersBTreeNode:
         return len(self.keys) >= self._max_keys // 2
 
     def can_release_parents_locks_on_delete(self):
-        return (len(self.keys) > self._max_keys // 2 and
-                len(self.children) > (self._max_keys // 2 + 1))
-
-    def _replace_key_if_needed(self, old: PersKey, new: PersKey):
-        for i in range(len(self.keys)):
-            if self.keys[i] == old:
-                self.keys[i] = new
-                return True
-
-    def _get_new_first(self) -> typing.Optional[PersKey]:
+        return ((len(self.keys) > self._max_keys // 2 and len(self.children) > (self._max_keys // 2 + 1)) or
+                self._fills_half_page_after_removal())
+
+    def can_merge(self, right: 'PersBTreeNode', separator: Key) -> bool:
+        # byte string nodes may not fit into a single page even when both are less than half full
+        if not isinstance(separator, bytes):
+            return True
+        merged_counts = None if self.subtree_counts is None else self.subtree_counts + right.subtree_counts
+        merged = PersBTreeNode(None, self.keys + [separator] + right.keys, self.children + right.children, [],
+                               self._max_keys, None, None, merged_counts)
+        return not merged._is_overflowing()
+
+    def _replace_key_if_needed(self, old: Key, new: typing.Optional[Key]):
+        # a longer byte string separator could overflow the page, the old one is still a valid bound
+        i = self._key_index(old)
+        if i is not None and new is not None and self._has_space_for(2):
+            self.keys[i] = new
+            return True
+
+    def _get_new_first(self) -> typing.Optional[Key]:
         if self.children:
             leftmost_child = self._page_manager.read_page(self.children[0])
-            return leftmost_child.keys[0]
+            if leftmost_child.keys:
+                return leftmost_child.keys[0]
         return None
 
     def _is_at_least_half_full(self):
-        return len(self.keys) >= self._max_keys // 2 and len(self.children) > self._max_keys // 2
+        return ((len(self.keys) >= self._max_keys // 2 and len(self.children) > self._max_keys // 2) or
+                self._fills_half_page())
 
     def _can_release_parents_locks_on_insert(self):
-        return len(self.keys) < self._max_keys
+        return self._has_room_for_key()
+
+    def _has_bytes_keys(self) -> bool:
+        return bool(self.keys) and isinstance(self.keys[0], bytes)
+
+    def _is_variable_size(self) -> bool:
+        return self._has_bytes_keys()
+
+    # byte string keys differ in length, so besides the keys count the page itself may become full
+    def _is_overflowing(self) -> bool:
+        return len(self.keys) > self._max_keys or (self._is_variable_size() and self._size() > BLOCK_SIZE_BYTES)
+
+    def _has_room_for_key(self) -> bool:
+        return len(self.keys) < self._max_keys and self._has_space_for(1)
+
+    def _has_space_for(self, entries: int) -> bool:
+        # a changed byte string key changes the front coding of the following one as well
+        return not self._is_variable_size() or self._size() + entries * MAX_BYTES_KEY_ENTRY_SIZE <= BLOCK_SIZE_BYTES
+
+    def _can_rebalance_through(self, lender: 'PersBTreeNode') -> bool:
+        # lending replaces up to two separators here and the high key of a leaf lender
+        return self._has_space_for(3) and lender._has_space_for(1)
+
+    def _fills_half_page(self) -> bool:
+        return self._is_variable_size() and self._size() >= BLOCK_SIZE_BYTES // 2
+
+    def _fills_half_page_after_removal(self) -> bool:
+        return self._is_variable_size() and self._size() - MAX_BYTES_KEY_ENTRY_SIZE >= BLOCK_SIZE_BYTES // 2
+
+    def _size(self) -> int:
+        return len(self.to_binary())
+
+    def _split_index(self) -> int:
+        if not self._has_bytes_keys():
+            return len(self.keys) // 2
+        # halves of similar size, index node keeps at least one key on both sides of the separator
+        total = sum(len(key) for key in self.keys) + len(self.keys) * MAX_BYTES_KEY_ENTRY_SIZE
+        size = 0
+        mid = 0
+        while size * 2 < total:
+            size += len(self.keys[mid]) + MAX_BYTES_KEY_ENTRY_SIZE
+            mid += 1
+        highest = len(self.keys) - 1 if self.is_leaf() else len(self.keys) - 2
+        return max(1, min(mid, highest))
+
+    def _child_index(self, key: Key) -> int:
+        return bisect.bisect_right(self.keys, key)
+
+    def _key_index(self, key: Key) -> typing.Optional[int]:
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
 
-    def _lock_child(self, lock_ctx: LockContext, child_pointer: PagePointer, permanent=False):
-        child_lock = self._lock_manager.get_lock(child_pointer)
-        child_lock.acquire()
+    def _lock_child(self, lock_ctx: LockContext, child_pointer: PagePointer, permanent=False,
+                    lock_type: LockType = LockType.WRITE):
+        child_lock = self._lock_manager.lock(child_pointer, lock_type)
         return lock_ctx.push(child_lock, permanent)
 
-    def _try_lock_child_or_throw(self, lock_ctx: LockContext, child_pointer: PagePointer):
-        child_lock = self._lock_manager.get_lock(child_pointer)
-        acquired = child_lock.acquire(blocking=False)
-        if acquired:
-            lock_ctx.push(child_lock)
-        else:
-            raise SiblingPointerAlreadyLockedException(f"Child {child_pointer} is already locked by different thread")
+    @property
+    def values(self) -> typing.List[DbRecordPointer]:
+        if self._values is None:
+            self._values = self._packed.values()
+            self._packed = None
+        return self._values
+
+    @values.setter
+    def values(self, values: typing.List[DbRecordPointer]):
+        self._values = values
+        self._packed = None
 
     # TODO: count database capacity
     def to_binary(self) -> bytes:
-        binary_data = io.BytesIO()
-        binary_data.write(int(len(self.keys)).to_bytes(MAX_KEYS_LENGTH_BYTES, INT_ENCODING))
-        for key in self.keys:
-            binary_data.write(key.to_binary())
-
-        binary_data.write(int(len(self.values)).to_bytes(MAX_VALUES_LENGTH_BYTES, INT_ENCODING))
-        for value in self.values:
-            binary_data.write(value.to_binary())
-
-        binary_data.write(int(len(self.children)).to_bytes(MAX_CHILDREN_LENGTH_BYTES, INT_ENCODING))
-        for node_pointer in self.children:
-            binary_data.write(node_pointer.to_binary())
-
-        binary_data.seek(0)
-        return binary_data.read()
+        return pack_node(self.keys, self.values, self.children, self._has_bytes_keys(), self.subtree_counts)
 
     @classmethod
     def from_binary(cls, pointer: PagePointer, data: bytes, max_keys: int, node_manager,
-                    lock_manager) -> 'PersBTreeNode':
-        buff = io.BytesIO(data)
-        len_of_keys = int.from_bytes(buff.read(MAX_KEYS_LENGTH_BYTES), INT_ENCODING)
-        keys = [PersKey.from_binary(buff) for _ in range(len_of_keys)]
-        len_of_values = int.from_bytes(buff.read(MAX_VALUES_LENGTH_BYTES), INT_ENCODING)
-        values = [DbRecordPointer.from_binary(buff) for _ in range(len_of_values)]
-        len_of_children = int.from_bytes(buff.read(MAX_CHILDREN_LENGTH_BYTES), INT_ENCODING)
-        children = [PagePointer.from_binary(buff) for _ in range(len_of_children)]
-        if len_of_children:
-            return PersBTreeNode(pointer, keys, children, values, max_keys, node_manager, lock_manager)
+                    lock_manager, max_leaf_keys: typing.Optional[int] = None) -> 'PersBTreeNode':
+        packed = PackedNode(data)
+        keys = packed.keys()
+        if packed.children_count:
+            node = PersBTreeNode(pointer, keys, packed.children(), None, max_keys, node_manager, lock_manager,
+                                 packed.subtree_counts())
+            node._packed = packed
+            return node
 
         # it's leaf
-        next = PagePointer.from_binary(buff)
-        prev = PagePointer.from_binary(buff)
-        return PersBTreeNodeLeaf(pointer, keys, children, values, max_keys, next, prev, node_manager, lock_manager)
+        next, flags, high_key = packed.leaf_trailer()
+        if not flags & LEAF_HAS_HIGH_KEY_FLAG:
+            high_key = None
+        if packed.compressed:
+            max_keys = max_leaf_keys or max_keys
+        node = PersBTreeNodeLeaf(pointer, keys, [], None, max_keys, next, high_key, node_manager, lock_manager,
+                                 incomplete_split=bool(flags & LEAF_INCOMPLETE_SPLIT_FLAG),
+                                 compressed=packed.compressed)
+        node._packed = packed
+        return node
 
     def __repr__(self):
         return str(self.keys)
@@ -452,105 +586,143 @@ class PersBTreeNode:
 
 class PersBTreeNodeLeaf(PersBTreeNode):
     def __init__(self, pointer: typing.Optional[PagePointer],
-                 keys: typing.List[PersKey],
+                 keys: typing.List[Key],
                  children: typing.List[PagePointer],
                  values: typing.List[DbRecordPointer],
                  max_keys: int,
                  next: typing.Optional[PagePointer],
-                 prev: typing.Optional[PagePointer],
+                 high_key: typing.Optional[Key],
                  page_manager,
-                 lock_manager: LockManager):
+                 lock_manager: LockManager,
+                 incomplete_split: bool = False,
+                 compressed: bool = False):
         super().__init__(pointer, keys, children, values, max_keys, page_manager, lock_manager)
         self.next: typing.Optional[PagePointer] = next
-        self.prev: typing.Optional[PagePointer] = prev
+        # upper bound of the keys, exclusive, the first key of the next leaf
+        self.high_key: typing.Optional[Key] = high_key
+        self.incomplete_split = incomplete_split
+        self.compressed = compressed  # int keys and record pointers stored relative to the first ones of the leaf
 
     def to_binary(self) -> bytes:
-        binary_data = io.BytesIO()
-        binary_data.write(super().to_binary())
-        if self.next:
-            binary_data.write(self.next.to_binary())
-        else:
-            binary_data.write(PagePointer.binary_none())
-        if self.prev:
-            binary_data.write(self.prev.to_binary())
-        else:
-            binary_data.write(PagePointer.binary_none())
-        binary_data.seek(0)
-        return binary_data.read()
-
-    def insert(self, key: PersKey, value: DbRecordPointer, lock_ctx: LockContext) -> 'InsertionResult':
-        lock_level = lock_ctx.get_current_level()
-        try:
-            if self._can_release_parents_locks_on_insert():
-                lock_ctx.release_allowed_parent_locks(lock_level)
-            for i in range(len(self.keys)):
-                if self.keys[i] == key:
-                    raise DuplicateKeyException(f"Duplicate key {key}")
-                if self.keys[i] > key:
-                    self.keys.insert(i, key)
-                    self.values.insert(i, value)
-                    break
-            else:
-                self.keys.append(key)
-                self.values.append(value)
-
-            if len(self.keys) > self._max_keys:
-                if self.prev:
-                    self._try_lock_child_or_throw(lock_ctx, self.prev)
-                if self.next:
-                    self._try_lock_child_or_throw(lock_ctx, self.next)
-
-                mid = len(self.keys) // 2
-                left_keys, right_keys = self.keys[:mid], self.keys[mid:]
-                left_values, right_values = self.values[:mid], self.values[mid:]
-                left_child = PersBTreeNodeLeaf(None, left_keys, [], left_values, self._max_keys, None, None,
-                                               self._page_manager, self._lock_manager)
-                right_child = PersBTreeNodeLeaf(None, right_keys, [], right_values, self._max_keys, None, None,
-                                                self._page_manager, self._lock_manager)
-                left_child = self._page_manager.save_new_page(left_child)
-                right_child = self._page_manager.save_new_page(right_child)
-
-                left_child.next = right_child.pointer
-                left_child.prev = self.prev
-                right_child.prev = left_child.pointer
-                right_child.next = self.next
-                if self.prev:
-                    prev_child = self._page_manager.read_page(self.prev)
-                    assert isinstance(prev_child, PersBTreeNodeLeaf)
-                    prev_child.next = left_child.pointer
-                    self._page_manager.save_page(prev_child)
-                if self.next:
-                    next_child = self._page_manager.read_page(self.next)
-                    assert isinstance(next_child, PersBTreeNodeLeaf)
-                    next_child.prev = right_child.pointer
-                    self._page_manager.save_page(next_child)
-
-                self._page_manager.save_page(left_child)
-                self._page_manager.save_page(right_child)
-
-                parent = PersBTreeNode(self.pointer, [self.keys[mid]], [left_child.pointer, right_child.pointer],
-                                       [], self._max_keys, self._page_manager, self._lock_manager)
-                return InsertionResult(is_new_node=True, updated=parent)
-            self._page_manager.save_page(self)
-            return InsertionResult(is_new_node=False, updated=self)
-        finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
-
-    def delete(self, key: PersKey, lock_ctx: LockContext) -> DeleteResult:
+        flags = LEAF_INCOMPLETE_SPLIT_FLAG if self.incomplete_split else 0
+        if self.high_key is not None:
+            flags |= LEAF_HAS_HIGH_KEY_FLAG
+        if self.compressed:
+            return pack_compressed_leaf(self.keys, self.values) + pack_leaf_trailer(self.next, flags, self.high_key)
+        bytes_keys = self._has_bytes_keys()
+        return (pack_node(self.keys, self.values, self.children, bytes_keys) +
+                pack_leaf_trailer(self.next, flags, self.high_key, bytes_keys))
+
+    def insert(self, key: Key, value: DbRecordPointer) -> 'InsertionResult':
+        # only the leaf itself has to be latched, the new right sibling is linked in the parent afterwards
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            raise DuplicateKeyException(f"Duplicate key {key}")
+        self.keys.insert(i, key)
+        self.values.insert(i, value)
+
+        return self._save_or_split()
+
+    def batch_end(self, keys: typing.List[Key], start: int) -> int:
+        # sorted keys from `start` on belong to this leaf as long as they are below its high key, the first one
+        # was routed here, the following ones may be beyond a high key raised by deletions
+        end = start + 1
+        while end < len(keys) and (self.high_key is None or keys[end] < self.high_key):
+            end += 1
+        return end
+
+    def insert_many(self, items: typing.List[typing.Tuple[Key, DbRecordPointer]]) -> 'InsertionResult':
+        for key, _ in items:
+            if self._key_index(key) is not None:
+                raise DuplicateKeyException(f"Duplicate key {key}")
+        merged = sorted([*zip(self.keys, self.values), *items], key=itemgetter(0))
+        self.keys = [key for key, _ in merged]
+        self.values = [value for _, value in merged]
+        return self._save_or_split()
+
+    def upsert(self, key: Key, value: DbRecordPointer) \
+            -> typing.Tuple['InsertionResult', typing.Optional[DbRecordPointer]]:
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            previous = self.values[i]
+            self.values[i] = value
+            return self._save_or_split(), previous
+        self.keys.insert(i, key)
+        self.values.insert(i, value)
+        return self._save_or_split(), None
+
+    def compare_and_set(self, key: Key, expected: typing.Optional[DbRecordPointer], new: DbRecordPointer) \
+            -> typing.Tuple['InsertionResult', bool]:
+        if self.find(key) != expected:
+            return InsertionResult(is_new_node=False, updated=self), False
+        return self.upsert(key, new)[0], True
+
+    def _save_or_split(self) -> 'InsertionResult':
+        if self._is_overflowing():
+            new_leafs = self._split()
+            return InsertionResult(is_new_node=True, updated=new_leafs[0][1], new_leafs=[
+                (separator, leaf.pointer) for separator, leaf in new_leafs])
+        self._page_manager.save_page(self)
+        return InsertionResult(is_new_node=False, updated=self)
+
+    def _split(self) -> typing.List[typing.Tuple[Key, 'PersBTreeNodeLeaf']]:
+        # the first part stays in place, the other ones are written from the last one, so each is complete once
+        # it becomes reachable, a batch may overflow the leaf by more than a single page
+        parts = self._fitting_parts(self.keys, self.values)
+        separators = [_shortest_separator(left[0][-1], right[0][0]) for left, right in zip(parts, parts[1:])]
+        next_pointer, high_key, incomplete_split = self.next, self.high_key, self.incomplete_split
+        new_leafs = []
+        for (keys, values), separator in reversed(list(zip(parts[1:], separators))):
+            right_child = PersBTreeNodeLeaf(None, keys, [], values, self._max_keys, next_pointer, high_key,
+                                            self._page_manager, self._lock_manager,
+                                            incomplete_split=incomplete_split, compressed=self.compressed)
+            right_child = self._page_manager.save_new_page(right_child)
+            new_leafs.append((separator, right_child))
+            next_pointer, high_key, incomplete_split = right_child.pointer, separator, True
+
+        self.keys, self.values = parts[0]
+        self.next, self.high_key, self.incomplete_split = next_pointer, high_key, incomplete_split
+        self._page_manager.save_page(self)
+        return new_leafs[::-1]
+
+    def _fitting_parts(self, keys: typing.List[Key], values: typing.List[DbRecordPointer]) \
+            -> typing.List[typing.Tuple[typing.List[Key], typing.List[DbRecordPointer]]]:
+        # halves the entries until every part fits into a page with the longest possible high key
+        high_key = bytes(MAX_BYTES_KEY_LENGTH) if self._has_bytes_keys() else None
+        part = PersBTreeNodeLeaf(None, keys, [], values, self._max_keys, None, high_key, None, None,
+                                 compressed=self.compressed)
+        if len(keys) < 2 or not part._is_overflowing():
+            return [(keys, values)]
+        mid = part._split_index()
+        return self._fitting_parts(keys[:mid], values[:mid]) + self._fitting_parts(keys[mid:], values[mid:])
+
+    def move_right(self, key: Key, lock_ctx: LockContext, lock_type: LockType) -> 'PersBTreeNodeLeaf':
+        # the key may have been moved by a split into a right sibling the parent does not point to yet,
+        # separators of an already linked leaf may differ from its high key after deletions, so they win
+        leaf = self
+        lock_state = lock_ctx.last()
+        while leaf.incomplete_split and key >= leaf.high_key:
+            next_lock_state = leaf._lock_child(lock_ctx, leaf.next, lock_type=lock_type)
+            lock_state.release()
+            lock_state = next_lock_state
+            leaf = self._page_manager.read_page(leaf.next)
+        return leaf
+
+    def delete(self, key: Key, lock_ctx: LockContext) -> DeleteResult:
         lock_level = lock_ctx.get_current_level()
         try:
-            if self.can_release_parents_locks_on_delete():
+            parents_released = self.can_release_parents_locks_on_delete()
+            if parents_released:
                 lock_ctx.release_allowed_parent_locks(lock_level)
-            for i in range(len(self.keys)):
-                if self.keys[i] == key:
-                    self.keys.pop(i)
-                    self.values.pop(i)
-                    break
-            else:
+            i = self._key_index(key)
+            if i is None:
                 raise NoSuchKeyException(f'No key {key} found in a tree')
+            self.keys.pop(i)
+            self.values.pop(i)
 
-            if self._is_at_least_half_full():
-                # case when after deletion b+tree condition is maintained in leaf, nothing to do more
+            if parents_released or self._is_at_least_half_full():
+                # case when after deletion b+tree condition is maintained in leaf, nothing to do more,
+                # narrower offsets may leave a compressed leaf less than half full, its parent is not latched anymore
                 self._page_manager.save_page(self)
                 return DeleteResult(new_first=self.keys[0], condition_of_tree_valid=True, leaf=True)
             # case when there is not enough elements in leaf after deletion
@@ -559,38 +731,76 @@ class PersBTreeNodeLeaf(PersBTreeNode):
             # there are still some keys available
             return DeleteResult(new_first=self.keys[0], condition_of_tree_valid=False, leaf=True)
         finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+            lock_ctx.release_self_and_child_locks(lock_level + 1)
+
+    def remove_range(self, lo: Key, hi: Key) -> int:
+        start, end = bisect.bisect_left(self.keys, lo), bisect.bisect_right(self.keys, hi)
+        self.keys = self.keys[:start] + self.keys[end:]
+        self.values = self.values[:start] + self.values[end:]
+        return end - start
+
+    def pop_first(self, count: int) -> typing.List[typing.Tuple[Key, DbRecordPointer]]:
+        popped = list(zip(self.keys[:count], self.values[:count]))
+        self.keys, self.values = self.keys[count:], self.values[count:]
+        return popped
+
+    def find(self, key: Key) -> typing.Optional[DbRecordPointer]:
+        i = self._key_index(key)
+        if i is not None:
+            # a single value is unpacked when the others are not needed yet
+            return self._packed.value(i) if self._values is None else self._values[i]
+
+    def update(self, key: Key, value: DbRecordPointer) -> 'InsertionResult':
+        i = self._key_index(key)
+        if i is None:
+            raise NoSuchKeyException(f'No key {key} found in a tree')
+        self.values[i] = value
+        # a distant block widens all the block offsets of a compressed leaf
+        return self._save_or_split()
 
-    def find(self, key: PersKey, lock_ctx: LockContext) -> typing.Optional[DbRecordPointer]:
-        lock_level = lock_ctx.get_current_level()
-        try:
-            lock_ctx.release_allowed_parent_locks(lock_level)
+    def has_enough_to_lend(self):
+        # a moved key may widen offsets of the whole compressed leaf, so they are only merged when the result fits
+        return not self.compressed and super().has_enough_to_lend()
 
-            for i in range(len(self.keys)):
-                if self.keys[i] == key:
-                    return self.values[i]
-        finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+    def can_release_parents_locks_on_delete(self):
+        return len(self.keys) > self._max_keys // 2 or self._fills_half_page_after_removal()
 
-    def update(self, key: PersKey, value: DbRecordPointer, lock_ctx: LockContext):
-        lock_level = lock_ctx.get_current_level()
-        try:
-            lock_ctx.release_allowed_parent_locks(lock_level)
+    def can_merge(self, right: 'PersBTreeNodeLeaf', separator: typing.Optional[Key] = None) -> bool:
+        if not (self._is_variable_size() or right._is_variable_size()):
+            return True
+        merged = PersBTreeNodeLeaf(None, self.keys + right.keys, [], self.values + right.values, self._max_keys,
+                                   right.next, right.high_key, None, None, compressed=self.compressed)
+        return not merged._is_overflowing()
 
-            for i in range(len(self.keys)):
-                if self.keys[i] == key:
-                    self.values[i] = value
-                    self._page_manager.save_page(self)
-                    return
-            raise NoSuchKeyException(f'No key {key} found in a tree')
-        finally:
-            lock_ctx.release_self_and_child_locks(lock_level)
+    def can_insert_in_place(self) -> bool:
+        return self._can_release_parents_locks_on_insert()
 
-    def can_release_parents_locks_on_delete(self):
-        return len(self.keys) > self._max_keys // 2
+    def can_delete_in_place(self, key: Key) -> bool:
+        # deleting the first key may require replacing separators in ancestors
+        i = self._key_index(key)
+        return self.can_release_parents_locks_on_delete() and i is not None and i > 0
+
+    def _has_bytes_keys(self) -> bool:
+        return super()._has_bytes_keys() or isinstance(self.high_key, bytes)
+
+    def _is_variable_size(self) -> bool:
+        return self.compressed or super()._is_variable_size()
+
+    def _size(self) -> int:
+        if not self.compressed:
+            return super()._size()
+        _, max_block_offset, max_slot = compressed_values_bounds(self.values)
+        max_key_offset = self.keys[-1] - self.keys[0] if self.keys else 0
+        return compressed_leaf_size(len(self.keys), max_key_offset, max_block_offset, max_slot) + LEAF_TRAILER.size
 
     def _is_at_least_half_full(self):
-        return len(self.keys) >= self._max_keys // 2
+        return len(self.keys) >= self._max_keys // 2 or self._fills_half_page()
+
+
+@dataclass
+class RebuildDelta:
+    keys: typing.Set[Key] = field(default_factory=set)
+    ranges: typing.List[typing.Tuple[Key, Key]] = field(default_factory=list)
 
 
 @dataclass
@@ -598,114 +808,1100 @@ class InsertionResult:
     is_new_node: bool
     updated: typing.Optional[PersBTreeNode]
     insufficient_lock_permissions: bool = False
+    new_leafs: typing.List[typing.Tuple[Key, PagePointer]] = field(default_factory=list)  # of a split leaf
 
 
 class PersBTree:
-    ROOT_PAGE = PagePointer(0)
-
-    def __init__(self, index_file_path: str, max_keys: int):
+    ROOT_PAGE = PagePointer(1)  # the first page is the file header
+
+    def __init__(self, index_file_path: str, max_keys: typing.Optional[int] = None, key_type: type = int,
+                 compressed_leafs: bool = False, counted: bool = False, copy_on_write: bool = False,
+                 write_ahead_log: bool = False, bloom_filter_keys: typing.Optional[int] = None,
+                 bloom_filter_false_positives: float = 0.01, cache_pages: int = 0, prefetch_pages: int = 0):
+        # str keys are kept as utf-8 byte strings, which sort the same way as the strings
+        if key_type not in (int, bytes, str):
+            raise ValueError(f"Key type has to be int, bytes or str, got {key_type}")
+        if compressed_leafs and key_type is not int:
+            raise ValueError("Only leafs with int keys can be compressed")
+        page_max_keys = PAGE_MAX_KEYS if key_type is int else BYTES_KEYS_PAGE_MAX_KEYS
+        if counted and key_type is int:
+            page_max_keys = COUNTED_PAGE_MAX_KEYS
+        if max_keys is not None and not 2 <= max_keys <= page_max_keys:
+            raise ValueError(f"Max keys has to be in [2, {page_max_keys}] range, got {max_keys}")
+        if prefetch_pages and not cache_pages:
+            raise ValueError("Pages can be prefetched only into the page cache")
         self._file_handle = None
+        self._log = None
         self._page_manager = None
         self._root = None
         self._index_file_path = index_file_path
-        self._max_keys = max_keys
+        self._key_type = key_type
+        self._max_keys_option = max_keys
+        self._max_keys = max_keys or page_max_keys
+        # dense keys of a compressed leaf take a few bytes each, so it holds many more of them than an index node
+        self._compressed_leafs = compressed_leafs
+        self._max_leaf_keys = max_keys or (COMPRESSED_LEAF_MAX_KEYS if compressed_leafs else page_max_keys)
         self._lock_manager = LockManager()
-
-    def insert(self, key: int, value: DbRecordPointer):
+        # every write of an order-statistic tree changes the counts up to the root, so the writers are serialized,
+        # count queries wait for them to see the counts and leafs consistent, other readers only latch pages
+        self._counted = counted
+        self._counts_lock = RWLock()
+        # writers keep the pages a snapshot sees aside before changing them, snapshots are opened between the writes
+        self._copy_on_write = copy_on_write
+        self._snapshots_lock = RWLock()
+        # pages are written back lazily, every change is in the log first
+        self._write_ahead_log = write_ahead_log
+        # the leftmost leaf is moved or freed only under the exclusive root latch, so it is cached for the readers
+        # of the lowest keys holding the shared one
+        self._min_leaf: typing.Optional[PagePointer] = None
+        # sized for the expected number of keys, missing keys are mostly answered without reading a page
+        self._bloom_filter = BloomFilter(bloom_filter_keys, bloom_filter_false_positives) \
+            if bloom_filter_keys is not None else None
+        # scans read the next leafs ahead and batch lookups the pages on their paths, in the background
+        self._cache_pages = cache_pages
+        self._prefetch_pages = prefetch_pages
+        self._prefetcher: typing.Optional[PagePrefetcher] = None
+        # a rebuild swaps the index file between the operations, it copies the keys changed meanwhile over again
+        self._files_lock = RWLock()
+        self._rebuild_delta: typing.Optional[RebuildDelta] = None
+        self._rebuild_delta_lock = threading.Lock()
+        self._retired_files: typing.List[typing.Tuple[typing.Any, 'PageManager']] = []
+
+    def insert(self, key, value: DbRecordPointer):
+        key = self._node_key(key)
+        self._add_to_filter([key])
+        with self._write() as write:
+            write.callback(self._record_changes, [key])
+            if self._counted:
+                self._check_new_keys([key])
+                self._count_keys([key], 1)
+            self._modify_leaf(key, lambda leaf: (leaf.insert(key, value), None))
+
+    def upsert(self, key, value: DbRecordPointer) -> typing.Optional[DbRecordPointer]:
+        # returns the replaced value, None when the key was inserted
+        key = self._node_key(key)
+        self._add_to_filter([key])
+        with self._write() as write:
+            write.callback(self._record_changes, [key])
+            if self._counted and self._find(key) is None:
+                self._count_keys([key], 1)
+            return self._modify_leaf(key, lambda leaf: leaf.upsert(key, value))
+
+    def compare_and_set(self, key, expected: typing.Optional[DbRecordPointer], new: DbRecordPointer) -> bool:
+        # expected None means the key must not be present yet
+        key = self._node_key(key)
+        self._add_to_filter([key])
+        with self._write() as write:
+            write.callback(self._record_changes, [key])
+            if self._counted:
+                if self._find(key) != expected:
+                    return False
+                if expected is None:
+                    self._count_keys([key], 1)
+            return self._modify_leaf(key, lambda leaf: leaf.compare_and_set(key, expected, new))
+
+    def insert_many(self, items: typing.Iterable[typing.Tuple[typing.Any, DbRecordPointer]]):
+        # sorted items share the descent, all the ones landing in the same leaf are inserted under a single latch
+        items = sorted(((self._node_key(key), value) for key, value in items), key=itemgetter(0))
+        keys = [key for key, _ in items]
+        for key, next_key in zip(keys, keys[1:]):
+            if key == next_key:
+                raise DuplicateKeyException(f"Duplicate key {key}")
+        self._add_to_filter(keys)
+
+        def insert_in_leaf(leaf: PersBTreeNodeLeaf, start: int) -> typing.Tuple[InsertionResult, int]:
+            end = leaf.batch_end(keys, start)
+            if self._counted:
+                # a split of a previous leaf may have moved the keys to the next subtree
+                self._count_keys(keys[start:end], 1)
+            return leaf.insert_many(items[start:end]), end
+
+        with self._write() as write:
+            write.callback(self._record_changes, keys)
+            if self._counted:
+                self._check_new_keys(keys)
+            i = 0
+            while i < len(items):
+                i = self._modify_leaf(keys[i], lambda leaf, start=i: insert_in_leaf(leaf, start))
+
+    def delete(self, key) -> None:
+        key = self._node_key(key)
+        with self._write() as write:
+            write.callback(self._record_changes, [key])
+            if self._counted:
+                if self._find(key) is None:
+                    raise NoSuchKeyException(f'No key {key} found in a tree')
+                self._count_keys([key], -1)
+            self._delete(key)
+
+    def _delete(self, key: Key):
+        if self._delete_from_leaf(key):
+            return
         lock_ctx = LockContext()
         lock_level = 0
-        retry = True
-        while retry:
+        while True:
             try:
                 lock_ctx.clear()
                 lock_ctx.init_new_level()
                 lock_level = lock_ctx.get_current_level()
-                root_lock = self._lock_manager.get_lock(self.ROOT_PAGE)
-                root_lock.acquire()
-                lock_ctx.push(root_lock)
-
-                result = self._root.append(PersKey(key), value, lock_ctx)
-                if result.is_new_node:
-                    self._root = result.record
-                    self._page_manager.save_page(result.record)
-                retry = False
-            except SiblingPointerAlreadyLockedException as e:
-                logging.warning("Aborting insertion operation, will retry..., %s", e)
+                root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE)
+                root_lock_state = lock_ctx.push(root_lock, permanent=key in self._root.keys)
+
+                self._root.delete(key, lock_ctx)
+                if not root_lock_state.is_acquired():
+                    # root latch was released on the way down, so the root has not changed
+                    pass
+                elif len(self._root.keys) in [0, 1] and len(self._root.children) == 1:
+                    # root page stays in place, so the only child is moved into it
+                    child_pointer = self._root.children[0]
+                    new_root = self._page_manager.read_page(child_pointer)
+                    new_root.pointer = self.ROOT_PAGE
+                    self._page_manager.save_page(new_root)
+                    self._root = new_root
+                    self._page_manager.free_page(child_pointer)
+                    self._min_leaf = None
+                elif not self._root.keys and not self._root.children:
+                    self._root = self._new_leaf(self.ROOT_PAGE, [], [], None, None)
+                    self._page_manager.save_page(self._root)
+                    self._min_leaf = None
+                elif self._root.is_leaf():
+                    # a root leaf has no siblings to merge with, it is saved however few keys it has left
+                    self._page_manager.save_page(self._root)
+                return
+            except IncompleteSplitException as e:
+                logging.debug("Aborting deletion operation, will retry after completing the split..., %s", e)
+                split_pointer = e.pointer
             finally:
                 lock_ctx.release_self_and_child_locks(lock_level)
+            self._complete_split(split_pointer)
+
+    def delete_range(self, lo, hi) -> int:
+        # removes the keys of [lo, hi], leafs and subtrees inside the range are freed as a whole, so the cost
+        # depends on the number of pages, returns the number of removed keys
+        lo, hi = self._node_key(lo), self._node_key(hi)
+        if lo > hi:
+            return 0
+        with self._write() as write:
+            write.callback(self._record_range, lo, hi)
+            while True:
+                latches = []
+                try:
+                    return self._delete_range(lo, hi, latches)
+                except IncompleteSplitException as e:
+                    logging.debug("Aborting range deletion, will retry after completing the split..., %s", e)
+                    split_pointer = e.pointer
+                finally:
+                    for latch in reversed(latches):
+                        latch.release()
+                self._complete_split(split_pointer)
+
+    def _delete_range(self, lo: Key, hi: Key, latches: typing.List) -> int:
+        # the paths to both ends of the range are latched top-down, then the subtrees between them are freed
+        # from left to right and the nodes on the paths are cut once, the leaf of `hi` is latched for good only
+        # after the others are freed, so scans moving right through them do not wait for it
+        def latch(pointer: PagePointer) -> PersBTreeNode:
+            latches.append(self._lock_manager.lock(pointer, LockType.WRITE))
+            return self._page_manager.read_page(pointer)
+
+        latches.append(self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE))
+        if self._root.is_leaf():
+            removed = self._root.remove_range(lo, hi)
+            self._page_manager.save_page(self._root)
+            return removed
+
+        # nodes above the one separating the ends of the range, each with the index of the next one
+        path: typing.List[typing.Tuple[PersBTreeNode, int]] = []
+        split_node = self._root
+        while split_node._child_index(lo) == split_node._child_index(hi):
+            i = split_node._child_index(lo)
+            path.append((split_node, i))
+            child = latch(split_node.children[i])
+            if child.is_leaf():
+                if child.incomplete_split:
+                    raise IncompleteSplitException(f"Split of {child.pointer} is not completed", child.pointer)
+                removed = child.remove_range(lo, hi)
+                self._page_manager.save_page(child)
+                self._save_path(path, child)
+                return removed
+            split_node = child
+
+        a, b = split_node._child_index(lo), split_node._child_index(hi)
+        leftmost = all(i == 0 for _, i in path) and a == 0
+        rightmost = all(i == len(node.children) - 1 for node, i in path) and b == len(split_node.children) - 1
+        left_nodes, left_indexes = [split_node], [a]
+        while True:
+            left_nodes.append(latch(left_nodes[-1].children[left_indexes[-1]]))
+            if left_nodes[-1].is_leaf():
+                break
+            left_indexes.append(left_nodes[-1]._child_index(lo))
+            leftmost = leftmost and left_indexes[-1] == 0
+        lo_leaf = left_nodes[-1]
+        right_nodes, right_indexes = [split_node], [b]
+        while len(right_nodes) < len(left_nodes) - 1:
+            right_nodes.append(latch(right_nodes[-1].children[right_indexes[-1]]))
+            right_indexes.append(right_nodes[-1]._child_index(hi))
+            rightmost = rightmost and right_indexes[-1] == len(right_nodes[-1].children) - 1
+        hi_pointer = right_nodes[-1].children[right_indexes[-1]]
+        with self._lock_manager.lock(hi_pointer, LockType.WRITE):
+            hi_leaf = self._page_manager.read_page(hi_pointer)
+        # leafs not linked from their parents yet would be lost by cutting them off
+        for leaf in [lo_leaf, hi_leaf]:
+            if leaf.incomplete_split:
+                raise IncompleteSplitException(f"Split of {leaf.pointer} is not completed", leaf.pointer)
+
+        # in the order of their leafs, below the left path, between the paths and below the right one
+        inside = [left_nodes[k].children[left_indexes[k] + 1:] for k in range(len(left_nodes) - 2, 0, -1)]
+        inside.append(split_node.children[a + 1:b])
+        inside.extend(right_nodes[k].children[:right_indexes[k]] for k in range(1, len(right_nodes)))
+        removed = sum(self._free_subtree(pointer) for pointers in inside for pointer in pointers)
+
+        hi_leaf = latch(hi_pointer)
+        removed += lo_leaf.remove_range(lo, hi) + hi_leaf.remove_range(lo, hi)
+        for node, i in zip(left_nodes[1:-1], left_indexes[1:]):
+            node.keys, node.children = node.keys[:i], node.children[:i + 1]
+            if node.subtree_counts is not None:
+                node.subtree_counts = node.subtree_counts[:i + 1]
+        for node, i in zip(right_nodes[1:], right_indexes[1:]):
+            node.keys, node.children = node.keys[i:], node.children[i:]
+            if node.subtree_counts is not None:
+                node.subtree_counts = node.subtree_counts[i:]
+        split_node.keys = split_node.keys[:a] + split_node.keys[b - 1:]
+        split_node.children = split_node.children[:a + 1] + split_node.children[b:]
+        if split_node.subtree_counts is not None:
+            split_node.subtree_counts = split_node.subtree_counts[:a + 1] + split_node.subtree_counts[b:]
+        lo_leaf.next = hi_leaf.pointer
+        # a longer byte string high key could overflow the page, the old one is still a valid bound
+        high_key = lo_leaf.high_key
+        lo_leaf.high_key = split_node.keys[a]
+        if lo_leaf._is_overflowing():
+            lo_leaf.high_key = high_key
+
+        left_nodes, right_nodes = left_nodes[1:], right_nodes[1:] + [hi_leaf]
+        for nodes, indexes in [(left_nodes, left_indexes[1:]), (right_nodes, [0] * len(right_nodes))]:
+            for node, i, child in reversed(list(zip(nodes, indexes, nodes[1:]))):
+                if node.subtree_counts is not None:
+                    node.subtree_counts[i] = _subtree_count(child)
+        if split_node.subtree_counts is not None:
+            split_node.subtree_counts[a:a + 2] = [_subtree_count(left_nodes[0]), _subtree_count(right_nodes[0])]
+
+        # the emptied ends of the whole tree are dropped, with the nodes above them left with a single child
+        if leftmost and rightmost and not lo_leaf.keys and not hi_leaf.keys and len(split_node.children) == 2:
+            for node in [node for node, _ in path[1:]] + [split_node] + left_nodes + right_nodes:
+                if node.pointer != self.ROOT_PAGE:
+                    self._page_manager.free_page(node.pointer)
+            self._root = self._new_leaf(self.ROOT_PAGE, [], [], None, None)
+            self._page_manager.save_page(self._root)
+            self._min_leaf = None
+            return removed
+        if leftmost and not lo_leaf.keys and len(split_node.children) > 1:
+            split_node.keys.pop(a)
+            split_node._pop_child(a)
+            for node in left_nodes:
+                self._page_manager.free_page(node.pointer)
+            left_nodes = []
+            self._min_leaf = None
+        elif rightmost and not hi_leaf.keys and len(split_node.children) > 1:
+            split_node.keys.pop(a)
+            split_node._pop_child(a + 1)
+            for node in right_nodes:
+                self._page_manager.free_page(node.pointer)
+            right_nodes = []
+            lo_leaf.next, lo_leaf.high_key = None, None
+        elif self._can_merge_cut(left_nodes[0], right_nodes[0], split_node.keys[a]):
+            left, right = left_nodes[0], right_nodes[0]
+            if left.is_leaf():
+                left.keys, left.values = left.keys + right.keys, left.values + right.values
+                left.next, left.high_key = right.next, right.high_key
+            else:
+                left.keys = left.keys + [split_node.keys[a]] + right.keys
+                left.children = left.children + right.children
+                if left.subtree_counts is not None:
+                    left.subtree_counts = left.subtree_counts + right.subtree_counts
+            split_node.keys.pop(a)
+            split_node._move_count(a + 1, a)
+            self._page_manager.free_page(split_node._pop_child(a + 1))
+            right_nodes = right_nodes[1:]
+
+        for node in left_nodes + right_nodes:
+            self._page_manager.save_page(node)
+        self._page_manager.save_page(split_node)
+        self._save_path(path, split_node)
+        # the only child left is always on one of the latched paths
+        self._collapse_root()
+        return removed
+
+    def _free_subtree(self, pointer: PagePointer) -> int:
+        # its parent is latched, so waiting for the latch of each page lets the operations still inside leave it,
+        # returns the number of the freed keys
+        with self._lock_manager.lock(pointer, LockType.WRITE):
+            node = self._page_manager.read_page(pointer)
+            if node.is_leaf():
+                # right siblings not linked from the parent yet are reachable only through the leaf
+                removed = len(node.keys) + (self._free_subtree(node.next) if node.incomplete_split else 0)
+            else:
+                removed = sum(self._free_subtree(child_pointer) for child_pointer in node.children)
+            self._page_manager.free_page(pointer)
+        return removed
+
+    def _can_merge_cut(self, left: PersBTreeNode, right: PersBTreeNode, separator: Key) -> bool:
+        # nodes on the cut paths may be anything but full, unlike in a single deletion
+        if left.is_leaf():
+            return len(left.keys) + len(right.keys) <= left._max_keys and left.can_merge(right)
+        return len(left.keys) + len(right.keys) < left._max_keys and left.can_merge(right, separator)
+
+    def peek_min(self) -> typing.Optional[typing.Tuple[typing.Any, DbRecordPointer]]:
+        # the lowest key with its value, None for an empty tree
+        with self._read():
+            return self._peek_min()
+
+    def _peek_min(self) -> typing.Optional[typing.Tuple[typing.Any, DbRecordPointer]]:
+        lock_ctx = LockContext()
+        lock_ctx.init_new_level()
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
+        try:
+            leaf_lock_state = lock_ctx.push(root_lock)
+            leaf = self._root
+            if not leaf.is_leaf():
+                leaf_lock_state = leaf._lock_child(lock_ctx, self._min_leaf_pointer(), lock_type=LockType.READ)
+                leaf = self._page_manager.read_page(self._min_leaf)
+            while not leaf.keys and leaf.next:
+                # the root latch is held until the end, it keeps the leftmost leaf in place
+                next_lock_state = leaf._lock_child(lock_ctx, leaf.next, lock_type=LockType.READ)
+                leaf_lock_state.release()
+                leaf_lock_state = next_lock_state
+                leaf = self._page_manager.read_page(leaf.next)
+            if leaf.keys:
+                return self._user_key(leaf.keys[0]), leaf.values[0]
+        finally:
+            lock_ctx.release_self_and_child_locks(0)
+
+    def pop_min(self) -> typing.Optional[typing.Tuple[typing.Any, DbRecordPointer]]:
+        popped = self.pop_min_batch(1)
+        return popped[0] if popped else None
+
+    def pop_min_batch(self, n: int) -> typing.List[typing.Tuple[typing.Any, DbRecordPointer]]:
+        # removes up to n lowest keys, returns them in order with their values
+        if n < 1:
+            raise ValueError(f"Number of keys to pop has to be positive, got {n}")
+        with self._write():
+            popped, drained = self._pop_min(n)
+            self._record_changes([key for key, _ in popped])
+            if self._counted and popped:
+                self._count_keys([key for key, _ in popped], -1)
+            if drained:
+                self._drop_drained_min_leafs()
+        return [(self._user_key(key), value) for key, value in popped]
+
+    def _pop_min(self, n: int) -> typing.Tuple[typing.List[typing.Tuple[Key, DbRecordPointer]], bool]:
+        # returns the popped items and whether the leftmost leaf has been drained
+        while True:
+            outcome = self._pop_min_not_root(n)
+            if outcome is not None:
+                return outcome
+            with self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE):
+                if self._root.is_leaf():
+                    popped = self._root.pop_first(n)
+                    self._page_manager.save_page(self._root)
+                    return popped, False
 
-    def delete(self, key: int) -> None:
-        pers_key = PersKey(key)
+    def _pop_min_not_root(self, n: int) \
+            -> typing.Optional[typing.Tuple[typing.List[typing.Tuple[Key, DbRecordPointer]], bool]]:
+        # the keys are taken from the cached leftmost leaf and the ones right of it without descending the tree,
+        # gives up only when the root itself is a leaf
         lock_ctx = LockContext()
-        lock_level = 0
-        retry = True
-        while retry:
+        lock_ctx.init_new_level()
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
+        try:
+            lock_ctx.push(root_lock)
+            if self._root.is_leaf():
+                return None
+            lock_state = self._root._lock_child(lock_ctx, self._min_leaf_pointer())
+            leaf = self._page_manager.read_page(self._min_leaf)
+            popped = []
+            drained = None
+            while True:
+                taken = leaf.pop_first(n - len(popped))
+                if taken:
+                    popped.extend(taken)
+                    self._page_manager.save_page(leaf)
+                if drained is None:
+                    drained = not leaf.keys and leaf.next is not None
+                if len(popped) == n or not leaf.next:
+                    return popped, drained
+                next_lock_state = leaf._lock_child(lock_ctx, leaf.next)
+                lock_state.release()
+                lock_state = next_lock_state
+                leaf = self._page_manager.read_page(leaf.next)
+        finally:
+            lock_ctx.release_self_and_child_locks(0)
+
+    def _min_leaf_pointer(self) -> PagePointer:
+        # called under the shared root latch
+        if self._min_leaf is None:
+            lock_ctx = LockContext()
+            lock_ctx.init_new_level()
             try:
-                lock_ctx.clear()
-                lock_ctx.init_new_level()
-                lock_level = lock_ctx.get_current_level()
-                root_lock = self._lock_manager.get_lock(self.ROOT_PAGE)
-                root_lock.acquire()
-                lock_ctx.push(root_lock, permanent=pers_key in self._root.keys)
-
-                self._root.delete(pers_key, lock_ctx)
-                if len(self._root.keys) in [0, 1] and len(self._root.children) == 1:
-                    first_child = self._page_manager.read_page(self._root.children[0])  # TODO mark node as garbage
-                    self._page_manager.save_page(first_child)
-                    self._root = first_child
-                elif not self._root.keys and not self._root.children:
-                    self._root = PersBTreeNodeLeaf(self.ROOT_PAGE, [], [], [], self._max_keys, None, None,
-                                                   self._page_manager,
-                                                   self._lock_manager)
-                    self._page_manager.save_page(self._root)
-                retry = False
-            except SiblingPointerAlreadyLockedException as e:
-                logging.warning("Aborting insertion operation, will retry..., %s", e)
+                self._min_leaf = self._root.lock_leaf(self._lowest_key(), lock_ctx, LockType.READ).pointer
             finally:
-                lock_ctx.release_self_and_child_locks(lock_level)
+                lock_ctx.release_self_and_child_locks(0)
+        return self._min_leaf
+
+    def _drop_drained_min_leafs(self):
+        # empty leftmost leafs are unlinked from their parents together with the nodes left without children,
+        # so that the next pops do not walk through them
+        path: typing.List[PersBTreeNode] = []
+        latches = []
 
-    def find(self, key: int) -> DbRecordPointer:
+        def latch_leftmost_path():
+            while not path[-1].is_leaf():
+                latches.append(self._lock_manager.lock(path[-1].children[0], LockType.WRITE))
+                path.append(self._page_manager.read_page(path[-1].children[0]))
+
+        try:
+            latches.append(self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE))
+            path.append(self._root)
+            latch_leftmost_path()
+            while path[-1].next and not path[-1].keys and not path[-1].incomplete_split:
+                keeping = [i for i, node in enumerate(path[:-1]) if len(node.children) > 1]
+                if not keeping:
+                    break
+                node = path[keeping[-1]]
+                node.keys.pop(0)
+                node._pop_child(0)
+                self._page_manager.save_page(node)
+                # a freed page may be taken by a split right away, its new right-link must not wait for this latch
+                for dropped in path[keeping[-1] + 1:]:
+                    self._page_manager.free_page(dropped.pointer)
+                    latches.pop().release()
+                self._min_leaf = None
+                del path[keeping[-1] + 1:]
+                latch_leftmost_path()
+            self._collapse_root()
+        finally:
+            for latch in reversed(latches):
+                latch.release()
+
+    def _collapse_root(self):
+        # root page stays in place, so the only child is moved into it, the child has to be latched,
+        # a leaf whose split is not completed yet waits for its separator in the root
+        while not self._root.is_leaf() and len(self._root.children) == 1:
+            child_pointer = self._root.children[0]
+            new_root = self._page_manager.read_page(child_pointer)
+            if new_root.is_leaf() and new_root.incomplete_split:
+                return
+            new_root.pointer = self.ROOT_PAGE
+            self._page_manager.save_page(new_root)
+            self._root = new_root
+            self._page_manager.free_page(child_pointer)
+            self._min_leaf = None
+
+    def _save_path(self, path: typing.List[typing.Tuple[PersBTreeNode, int]], child: PersBTreeNode):
+        # saves the nodes above the changed child, bottom-up with the counts of their changed subtrees
+        for node, i in reversed(path):
+            if node.subtree_counts is not None:
+                node.subtree_counts[i] = _subtree_count(child)
+            self._page_manager.save_page(node)
+            child = node
+
+    def find(self, key) -> DbRecordPointer:
+        key = self._node_key(key)
+        if self._bloom_filter is not None and not self._bloom_filter.might_contain(key):
+            return None
+        with self._read():
+            return self._find(key)
+
+    def _find(self, key: Key) -> typing.Optional[DbRecordPointer]:
         lock_ctx = LockContext()
         lock_ctx.init_new_level()
         lock_level = 0
-        root_lock = self._lock_manager.get_lock(self.ROOT_PAGE)
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
         try:
-            root_lock.acquire()
             lock_ctx.push(root_lock)
-            return self._root.find(PersKey(key), lock_ctx)
+            if self._root.is_leaf():
+                return self._root.find(key)
+            return self._root.lock_leaf(key, lock_ctx, LockType.READ).find(key)
         finally:
             lock_ctx.release_self_and_child_locks(lock_level)
 
-    def update(self, key: int, value: DbRecordPointer):
+    def find_many(self, keys: typing.Iterable) -> typing.List[typing.Optional[DbRecordPointer]]:
+        # values in the order of the given keys, a leaf is descended to once for all the sorted keys it may hold
+        keys = [self._node_key(key) for key in keys]
+        candidates = set(keys)
+        if self._bloom_filter is not None:
+            candidates = {key for key in candidates if self._bloom_filter.might_contain(key)}
+        candidates = sorted(candidates)
+        with self._read():
+            if self._prefetcher is not None and len(candidates) > 1:
+                self._prefetcher.prefetch_keys(candidates)
+            found = self._find_many(candidates)
+        return [found.get(key) for key in keys]
+
+    def _find_many(self, sorted_keys: typing.List[Key]) -> typing.Dict[Key, typing.Optional[DbRecordPointer]]:
+        found = {}
+        i = 0
+        while i < len(sorted_keys):
+            lock_ctx = LockContext()
+            lock_ctx.init_new_level()
+            root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
+            try:
+                lock_ctx.push(root_lock)
+                leaf = self._root
+                if not leaf.is_leaf():
+                    leaf = self._root.lock_leaf(sorted_keys[i], lock_ctx, LockType.READ)
+                end = leaf.batch_end(sorted_keys, i)
+                for key in sorted_keys[i:end]:
+                    found[key] = leaf.find(key)
+                i = end
+            finally:
+                lock_ctx.release_self_and_child_locks(0)
+        return found
+
+    def find_range(self, lo, hi) -> typing.List[typing.Tuple[typing.Any, DbRecordPointer]]:
+        with self._read():
+            result = self._find_range(self._node_key(lo), self._node_key(hi))
+        if self._key_type is str:
+            return [(self._user_key(k), v) for k, v in result]
+        return result
+
+    def _find_range(self, lo: Key, hi: Key) -> typing.List[typing.Tuple[Key, DbRecordPointer]]:
         lock_ctx = LockContext()
         lock_ctx.init_new_level()
         lock_level = 0
-        root_lock = self._lock_manager.get_lock(self.ROOT_PAGE)
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
         try:
-            root_lock.acquire()
-            lock_ctx.push(root_lock)
-            return self._root.update(PersKey(key), value, lock_ctx)
+            leaf_lock_state = lock_ctx.push(root_lock)
+            leaf = self._root
+            if not leaf.is_leaf():
+                leaf = self._root.lock_leaf(lo, lock_ctx, LockType.READ)
+                leaf_lock_state = lock_ctx.last()
+            result = []
+            leafs_read = 0
+            while True:
+                start = bisect.bisect_left(leaf.keys, lo)
+                end = bisect.bisect_right(leaf.keys, hi)
+                result.extend(zip(leaf.keys[start:end], leaf.values[start:end]))
+                if end < len(leaf.keys) or not leaf.next:
+                    return result
+                if self._prefetcher is not None and leafs_read % self._prefetch_pages == 0 and leaf.keys:
+                    self._prefetcher.prefetch_range(leaf.keys[-1], hi, self._prefetch_pages + 1)
+                leafs_read += 1
+                # couple shared latches while moving right, so the scanned leaf cannot be merged away
+                next_lock_state = leaf._lock_child(lock_ctx, leaf.next, lock_type=LockType.READ)
+                leaf_lock_state.release()
+                leaf_lock_state = next_lock_state
+                leaf = self._page_manager.read_page(leaf.next)
         finally:
             lock_ctx.release_self_and_child_locks(lock_level)
 
+    def rank(self, key) -> int:
+        # number of keys lower than the given one
+        key = self._node_key(key)
+        with self._counted_read():
+            return self._rank(key, bisect.bisect_left)
+
+    def count_range(self, lo, hi) -> int:
+        # number of keys find_range returns
+        lo, hi = self._node_key(lo), self._node_key(hi)
+        with self._counted_read():
+            return max(0, self._rank(hi, bisect.bisect_right) - self._rank(lo, bisect.bisect_left))
+
+    def select(self, position: int) -> typing.Tuple[typing.Any, DbRecordPointer]:
+        # key and value at the position in the key order, counted from 0
+        with self._counted_read():
+            node = self._root
+            size = len(node.keys) if node.is_leaf() else sum(node.subtree_counts)
+            if not 0 <= position < size:
+                raise ValueError(f"Position has to be in [0, {size}) range, got {position}")
+            while not node.is_leaf():
+                i = 0
+                while position >= node.subtree_counts[i]:
+                    position -= node.subtree_counts[i]
+                    i += 1
+                node = self._page_manager.read_page(node.children[i])
+            while position >= len(node.keys):
+                position -= len(node.keys)
+                node = self._page_manager.read_page(node.next)
+            return self._user_key(node.keys[position]), node.values[position]
+
+    def _rank(self, key: Key, position_in_leaf: typing.Callable[[typing.List[Key], Key], int]) -> int:
+        rank = 0
+        node = self._root
+        while not node.is_leaf():
+            i = node._child_index(key)
+            rank += sum(node.subtree_counts[:i])
+            node = self._page_manager.read_page(node.children[i])
+        while node.incomplete_split and key >= node.high_key:
+            rank += len(node.keys)
+            node = self._page_manager.read_page(node.next)
+        return rank + position_in_leaf(node.keys, key)
+
+    def update(self, key, value: DbRecordPointer):
+        # only a compressed leaf may need more space for the new value
+        key = self._node_key(key)
+        with self._write(changes_counts=False) as write:
+            write.callback(self._record_changes, [key])
+            self._modify_leaf(key, lambda leaf: (leaf.update(key, value), None))
+
+    def snapshot(self) -> 'PersBTreeSnapshot':
+        # consistent view of the tree as of now, it is read without latches and is not affected by later writes
+        if not self._copy_on_write:
+            raise TreeNotCopyOnWriteException("Tree has been created without copy-on-write")
+        with self._read(), self._snapshots_lock.of(LockType.WRITE):
+            return PersBTreeSnapshot(self._page_manager.open_snapshot(self._root), self._key_type)
+
+    def _write(self, changes_counts: bool = True) -> typing.ContextManager:
+        # writers of an order-statistic tree are serialized
+        write = contextlib.ExitStack()
+        write.enter_context(self._files_lock.of(LockType.READ))
+        if self._copy_on_write:
+            write.enter_context(self._snapshots_lock.of(LockType.READ))
+        if self._counted and changes_counts:
+            write.enter_context(self._counts_lock.of(LockType.WRITE))
+        if self._write_ahead_log:
+            # pages written without latching them, like the counts, are logged before the next writer comes
+            write.callback(self._page_manager.log_writes)
+        return write
+
+    def _add_to_filter(self, keys: typing.List[Key]):
+        # before the leaf is changed, so a reader finding the key in the leaf passes the filter
+        if self._bloom_filter is not None:
+            for key in keys:
+                self._bloom_filter.add(key)
+
+    def _filtered(self, items: typing.Iterable[typing.Tuple[Key, DbRecordPointer]]) \
+            -> typing.Iterator[typing.Tuple[Key, DbRecordPointer]]:
+        for key, value in items:
+            self._bloom_filter.add(key)
+            yield key, value
+
+    def _read(self) -> typing.ContextManager:
+        return self._files_lock.of(LockType.READ)
+
+    def _counted_read(self) -> typing.ContextManager:
+        # no writer is in progress, so the pages are read without latching them
+        if not self._counted:
+            raise TreeNotCountedException("Tree has been created without subtree counts")
+        read = contextlib.ExitStack()
+        read.enter_context(self._files_lock.of(LockType.READ))
+        read.enter_context(self._counts_lock.of(LockType.READ))
+        return read
+
+    def _check_new_keys(self, keys: typing.List[Key]):
+        for key, found in self._find_many(sorted(keys)).items():
+            if found is not None:
+                raise DuplicateKeyException(f"Duplicate key {key}")
+
+    def _count_keys(self, keys: typing.List[Key], delta: int):
+        # counts on the paths of the keys are changed upfront, structure modifications which follow move them along
+        # with the keys, every changed node is written once
+        nodes = {}
+        changed = {}
+        for key in keys:
+            node = self._root
+            while not node.is_leaf():
+                i = node._child_index(key)
+                node.subtree_counts[i] += delta
+                changed[node.pointer] = node
+                child_pointer = node.children[i]
+                if child_pointer not in nodes:
+                    nodes[child_pointer] = self._page_manager.read_page(child_pointer)
+                node = nodes[child_pointer]
+        for node in changed.values():
+            self._page_manager.save_page(node)
+
+    def _modify_leaf(self, key: Key,
+                     operation: typing.Callable[[PersBTreeNodeLeaf], typing.Tuple[InsertionResult, T]]) -> T:
+        # applies the operation to the latched leaf of the key in a single descent, returns its outcome
+        outcome = None
+        while outcome is None:
+            outcome = self._modify_not_root_leaf(key, operation)
+            if outcome is None:
+                outcome = self._modify_root_leaf(operation)
+        result, value = outcome
+        self._insert_separators(result)
+        return value
+
+    def _modify_not_root_leaf(self, key: Key, operation: typing.Callable) -> typing.Optional[tuple]:
+        # inner nodes are latched in shared mode and only the target leaf exclusively, even when it is split,
+        # gives up only when the root itself is a leaf
+        lock_ctx = LockContext()
+        try:
+            leaf = self._lock_leaf_for_write(key, lock_ctx)
+            if leaf is None:
+                return None
+            return operation(leaf)
+        finally:
+            lock_ctx.release_self_and_child_locks(0)
+
+    def _modify_root_leaf(self, operation: typing.Callable) -> typing.Optional[tuple]:
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE)
+        with root_lock:
+            if not self._root.is_leaf():
+                return None
+            result, value = operation(self._root)
+            return self._grow_root_leaf(result), value
+
+    def _grow_root_leaf(self, result: InsertionResult) -> InsertionResult:
+        # the first new leaf is linked at once by the new root, the ones after it get their separators
+        # the same way as split leafs below the root, after the root latch is released
+        if result.is_new_node:
+            separator, right_pointer = result.new_leafs[0]
+            self._root.incomplete_split = False
+            subtree_counts = None
+            if self._counted:
+                subtree_counts = [len(self._root.keys), self._root._chain_count(right_pointer)]
+            self._grow_root(separator, right_pointer, subtree_counts)
+            result.new_leafs = result.new_leafs[1:]
+        return result
+
+    def _insert_separators(self, result: typing.Optional[InsertionResult]):
+        # until its separator is in place a new leaf is reachable through the right-link of the split one
+        if result is not None and result.is_new_node:
+            for separator, right_pointer in result.new_leafs:
+                self._insert_separator(separator, right_pointer)
+
+    def _insert_separator(self, separator: Key, right_pointer: PagePointer):
+        lock_ctx = LockContext()
+        lock_ctx.init_new_level()
+        try:
+            root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE)
+            lock_ctx.push(root_lock)
+            result = self._root.insert_separator(separator, right_pointer, lock_ctx)
+            if result.is_new_node:
+                self._grow_root(result.updated.keys[0], result.updated.children[1], result.updated.subtree_counts)
+        finally:
+            lock_ctx.release_self_and_child_locks(0)
+
+    def _grow_root(self, separator: Key, right_pointer: PagePointer,
+                   subtree_counts: typing.Optional[typing.List[int]]):
+        # root page stays in place, so its left half is moved out to a new page
+        left_child = self._root
+        left_child.pointer = None
+        left_child = self._page_manager.save_new_page(left_child)
+        self._root = PersBTreeNode(self.ROOT_PAGE, [separator], [left_child.pointer, right_pointer], [],
+                                   self._max_keys, self._page_manager, self._lock_manager, subtree_counts)
+        self._page_manager.save_page(self._root)
+
+    def _complete_split(self, pointer: PagePointer):
+        # finishes a split which is still in progress in another thread or was interrupted by a failure
+        with self._lock_manager.lock(pointer, LockType.READ):
+            leaf = self._page_manager.read_page(pointer)
+        if leaf.is_leaf() and leaf.incomplete_split:
+            self._insert_separator(leaf.high_key, leaf.next)
+
+    def _delete_from_leaf(self, key: Key) -> bool:
+        lock_ctx = LockContext()
+        try:
+            leaf = self._lock_leaf_for_write(key, lock_ctx)
+            if leaf is None or not leaf.can_delete_in_place(key):
+                return False
+            leaf.delete(key, lock_ctx)
+            return True
+        finally:
+            lock_ctx.release_self_and_child_locks(0)
+
+    def _lock_leaf_for_write(self, key: Key, lock_ctx: LockContext) -> typing.Optional[PersBTreeNodeLeaf]:
+        lock_ctx.init_new_level()
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
+        lock_ctx.push(root_lock)
+        if self._root.is_leaf():
+            return None
+        return self._root.lock_leaf(key, lock_ctx, LockType.WRITE)
+
+    def bulk_load(self, items: typing.Iterable[typing.Tuple[typing.Any, DbRecordPointer]], fill_factor: float = 0.9,
+                  sort_input: bool = False, sort_buffer_records: int = DEFAULT_SORT_BUFFER_RECORDS):
+        if not 0 < fill_factor <= 1:
+            raise ValueError(f"Fill factor has to be in (0, 1] range, got {fill_factor}")
+        items = ((self._node_key(key), value) for key, value in items)
+        if sort_input:
+            items = external_sort(items, sort_buffer_records, os.path.dirname(os.path.abspath(self._index_file_path)))
+
+        root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.WRITE)
+        with self._write(changes_counts=False) as write, root_lock:
+            if not self._root.is_empty():
+                raise TreeNotEmptyException("Bulk load is possible only into an empty tree")
+            write.callback(self._record_range, self._lowest_key(), self._highest_key())
+            if self._bloom_filter is not None:
+                # rebuilt from the loaded keys, the ones deleted before are dropped from it
+                self._bloom_filter.clear()
+                items = self._filtered(items)
+            level = self._bulk_load_leafs(items, fill_factor)
+            while level is not None:
+                level = self._bulk_load_index_level(level, fill_factor)
+
+    def _bulk_load_leafs(self, items: typing.Iterable[typing.Tuple[Key, DbRecordPointer]],
+                         fill_factor: float) -> typing.Optional[typing.List[typing.Tuple[Key, PagePointer, int]]]:
+        if self._compressed_leafs:
+            chunks = _compressed_leaf_chunks(_checked_sorted_keys(items), fill_factor, self._max_leaf_keys)
+        else:
+            limits = self._chunk_limits(fill_factor, self._max_keys, max(1, self._max_keys // 2),
+                                        NODE_HEADER_SIZE + MAX_BYTES_LEAF_TRAILER_SIZE, VALUE_SIZE)
+            chunks = _balanced_chunks(_checked_sorted_keys(items), *limits)
+
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return None
+        second_chunk = next(chunks, None)
+        if second_chunk is None:
+            # everything fits into a single leaf, which is the root at the same time
+            self._root = self._new_bulk_leaf(self.ROOT_PAGE, first_chunk, None, None)
+            self._page_manager.save_page(self._root)
+            return None
+
+        # leafs are written sequentially at the end of file, so neighbour pointers are known upfront
+        first_pointer = self._page_manager.end_pointer().block_number
+        level = []
+        batch = []
+        pending = [first_chunk, second_chunk]
+        separator = first_chunk[0][0]
+        while pending:
+            chunk = pending.pop(0)
+            if not pending:
+                following = next(chunks, None)
+                if following is not None:
+                    pending.append(following)
+            pointer = PagePointer(first_pointer + len(level))
+            next_pointer = PagePointer(pointer.block_number + 1) if pending else None
+            high_key = _shortest_separator(chunk[-1][0], pending[0][0][0]) if pending else None
+            batch.append(self._new_bulk_leaf(pointer, chunk, next_pointer, high_key))
+            level.append((separator, pointer, len(chunk)))
+            separator = high_key
+            if len(batch) >= BULK_LOAD_WRITE_BATCH_PAGES:
+                self._page_manager.save_page_run(batch)
+                batch = []
+        if batch:
+            self._page_manager.save_page_run(batch)
+        return level
+
+    def _bulk_load_index_level(self, level: typing.List[typing.Tuple[Key, PagePointer, int]],
+                               fill_factor: float) -> typing.Optional[typing.List[typing.Tuple[Key, PagePointer, int]]]:
+        # entries are separators, pointers and the numbers of keys below them
+        child_size = CHILD_SIZE + SUBTREE_COUNT_SIZE if self._counted else CHILD_SIZE
+        limits = self._chunk_limits(fill_factor, self._max_keys + 1, max(2, self._max_keys // 2 + 1),
+                                    NODE_HEADER_SIZE, child_size)
+        _, max_size, _, weight = limits
+        if sum(weight(item) for item in level) <= max_size:
+            self._root = self._new_bulk_index_node(self.ROOT_PAGE, level)
+            self._page_manager.save_page(self._root)
+            return None
+
+        first_pointer = self._page_manager.end_pointer().block_number
+        upper_level = []
+        batch = []
+        for chunk in _balanced_chunks(level, *limits):
+            pointer = PagePointer(first_pointer + len(upper_level))
+            batch.append(self._new_bulk_index_node(pointer, chunk))
+            upper_level.append((chunk[0][0], pointer, sum(count for _, _, count in chunk)))
+            if len(batch) >= BULK_LOAD_WRITE_BATCH_PAGES:
+                self._page_manager.save_page_run(batch)
+                batch = []
+        if batch:
+            self._page_manager.save_page_run(batch)
+        return upper_level
+
+    def _chunk_limits(self, fill_factor: float, max_count: int, min_count: int, page_overhead: int,
+                      element_size: int) -> typing.Tuple[int, int, int, typing.Callable[[tuple], int]]:
+        # capacity, maximum and minimum of a node and the weight of its single entry
+        if self._key_type is int:
+            capacity = max(min_count, min(max_count, int(max_count * fill_factor)))
+            return capacity, max_count, min_count, lambda item: 1
+        # byte string entries weight their size, but at least a share of the page, so the keys count is bounded as well
+        budget = BLOCK_SIZE_BYTES - page_overhead
+        share = -(-budget // max_count)
+        capacity = max(budget // 2, min(budget, int(budget * fill_factor)))
+        return capacity, budget, budget // 2, \
+            lambda item: max(share, BYTES_KEY_HEADER.size + len(item[0]) + element_size)
+
+    def _new_bulk_leaf(self, pointer: PagePointer, chunk: typing.List[typing.Tuple[Key, DbRecordPointer]],
+                       next_pointer: typing.Optional[PagePointer],
+                       high_key: typing.Optional[Key]) -> 'PersBTreeNodeLeaf':
+        return self._new_leaf(pointer, [k for k, _ in chunk], [v for _, v in chunk], next_pointer, high_key)
+
+    def _new_leaf(self, pointer: PagePointer, keys: typing.List[Key], values: typing.List[DbRecordPointer],
+                  next_pointer: typing.Optional[PagePointer], high_key: typing.Optional[Key]) -> 'PersBTreeNodeLeaf':
+        return PersBTreeNodeLeaf(pointer, keys, [], values, self._max_leaf_keys, next_pointer, high_key,
+                                 self._page_manager, self._lock_manager, compressed=self._compressed_leafs)
+
+    def _new_bulk_index_node(self, pointer: PagePointer,
+                             chunk: typing.List[typing.Tuple[Key, PagePointer, int]]) -> PersBTreeNode:
+        subtree_counts = [count for _, _, count in chunk] if self._counted else None
+        return PersBTreeNode(pointer, [k for k, _, _ in chunk[1:]], [p for _, p, _ in chunk], [], self._max_keys,
+                             self._page_manager, self._lock_manager, subtree_counts)
+
+    def shrink(self) -> int:
+        # online, gives free pages at the end of the index file back, returns the number of released pages
+        with self._read():
+            return self._page_manager.truncate_free_pages()
+
+    @classmethod
+    def compact(cls, index_file_path: str, max_keys: typing.Optional[int] = None, fill_factor: float = 0.9,
+                key_type: type = int, compressed_leafs: bool = False, counted: bool = False):
+        # offline, the index is bulk loaded into a densely packed file which replaces the old one,
+        # leafs may be converted from or to the compressed format and subtree counts added or dropped on the way
+        compacted_file_path = index_file_path + '.compacted'
+        if os.path.exists(compacted_file_path):
+            os.remove(compacted_file_path)
+        with cls(index_file_path, max_keys, key_type) as tree, \
+                cls(compacted_file_path, max_keys, key_type, compressed_leafs, counted) as compacted:
+            compacted.bulk_load(tree._items(), fill_factor)
+        os.replace(compacted_file_path, index_file_path)
+
+    def rebuild(self, fill_factor: float = 0.9):
+        # online, the keys are streamed in order into a densely packed new file while the writes go on,
+        # the keys changed meanwhile are copied over again, the last of them with readers and writers held off,
+        # then the new file replaces the old one at once, so the leafs are laid out in the key order again
+        if self._file_handle is None:
+            raise ValueError("Tree of a catalog can not be rebuilt on its own")
+        with self._rebuild_delta_lock:
+            if self._rebuild_delta is not None:
+                raise ValueError(f"Index {self._index_file_path} is already being rebuilt")
+            self._rebuild_delta = RebuildDelta()
+        rebuilt_file_path = self._index_file_path + '.rebuilt'
+        if os.path.exists(rebuilt_file_path):
+            os.remove(rebuilt_file_path)
+        rebuilt = PersBTree(rebuilt_file_path, self._max_keys_option, self._key_type, self._compressed_leafs,
+                            self._counted).__enter__()
+        try:
+            rebuilt.bulk_load(((self._user_key(key), value) for batch in self._scanned_leafs() for key, value in batch),
+                              fill_factor)
+            for _ in range(REBUILD_CATCH_UP_ROUNDS):
+                if len(self._rebuild_delta.keys) <= REBUILD_FINAL_DELTA_KEYS:
+                    break
+                self._copy_rebuild_delta(rebuilt)
+            with self._files_lock.of(LockType.WRITE):
+                self._copy_rebuild_delta(rebuilt)
+                rebuilt.__exit__(None, None, None)
+                rebuilt = None
+                self._swap_file(rebuilt_file_path)
+        finally:
+            with self._rebuild_delta_lock:
+                self._rebuild_delta = None
+            if rebuilt is not None:
+                rebuilt.__exit__(None, None, None)
+                os.remove(rebuilt_file_path)
+
+    def _scanned_leafs(self) -> typing.Iterator[typing.List[typing.Tuple[Key, DbRecordPointer]]]:
+        # a leaf at a time, latched only while its items are copied, the next one is found from the root
+        # by the last copied key, so the writers are not held up by the scan
+        last = None
+        while True:
+            lock_ctx = LockContext()
+            lock_ctx.init_new_level()
+            root_lock = self._lock_manager.lock(self.ROOT_PAGE, LockType.READ)
+            try:
+                leaf_lock_state = lock_ctx.push(root_lock)
+                leaf = self._root
+                if not leaf.is_leaf():
+                    leaf = self._root.lock_leaf(self._lowest_key() if last is None else last, lock_ctx, LockType.READ)
+                    leaf_lock_state = lock_ctx.last()
+                while True:
+                    start = 0 if last is None else bisect.bisect_right(leaf.keys, last)
+                    items = list(zip(leaf.keys[start:], leaf.values[start:]))
+                    if items or not leaf.next:
+                        break
+                    next_lock_state = leaf._lock_child(lock_ctx, leaf.next, lock_type=LockType.READ)
+                    leaf_lock_state.release()
+                    leaf_lock_state = next_lock_state
+                    leaf = self._page_manager.read_page(leaf.next)
+            finally:
+                lock_ctx.release_self_and_child_locks(0)
+            if not items:
+                return
+            yield items
+            last = items[-1][0]
+
+    def _copy_rebuild_delta(self, rebuilt: 'PersBTree'):
+        # the current values of the changed keys are read, so the order of the changes does not matter
+        with self._rebuild_delta_lock:
+            delta, self._rebuild_delta = self._rebuild_delta, RebuildDelta()
+        for lo, hi in delta.ranges:
+            rebuilt.delete_range(self._user_key(lo), self._user_key(hi))
+            rebuilt.insert_many((self._user_key(key), value) for key, value in self._find_range(lo, hi))
+        for key in sorted(delta.keys):
+            value = self._find(key)
+            if value is not None:
+                rebuilt.upsert(self._user_key(key), value)
+            elif rebuilt.find(self._user_key(key)) is not None:
+                rebuilt.delete(self._user_key(key))
+
+    def _swap_file(self, rebuilt_file_path: str):
+        # the readers which got the old pages before are done, the old file is kept open only for the snapshots
+        from apps.broker.index.page_manager import PageManager
+
+        with open(rebuilt_file_path, 'rb') as rebuilt_file:
+            os.fsync(rebuilt_file.fileno())
+        if self._log is not None:
+            self._page_manager.checkpoint()
+        os.replace(rebuilt_file_path, self._index_file_path)
+        self._retired_files.append((self._file_handle, self._page_manager))
+        self._file_handle = open(self._index_file_path, 'r+b')
+        self._page_manager = PageManager(self._file_handle, self._max_keys, self._lock_manager, self._max_leaf_keys,
+                                         self._log, cache_pages=self._cache_pages)
+        self._root = self._get_or_create_root()
+        self._min_leaf = None
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = PagePrefetcher(self._page_manager, self.ROOT_PAGE)
+
+    def _record_changes(self, keys: typing.Iterable[Key]):
+        # after the change, while the writer still holds off the swap, so a copy made after that sees it
+        if self._rebuild_delta is not None:
+            with self._rebuild_delta_lock:
+                if self._rebuild_delta is not None:
+                    self._rebuild_delta.keys.update(keys)
+
+    def _record_range(self, lo: Key, hi: Key):
+        if self._rebuild_delta is not None:
+            with self._rebuild_delta_lock:
+                if self._rebuild_delta is not None:
+                    self._rebuild_delta.ranges.append((lo, hi))
+
+    def _lowest_key(self) -> Key:
+        return b'' if self._key_type is not int else -1
+
+    def _highest_key(self) -> Key:
+        return b'\xff' * MAX_BYTES_KEY_LENGTH if self._key_type is not int else 2 ** (8 * PAGE_KEY_BYTES) - 1
+
+    def _items(self) -> typing.Iterator[typing.Tuple[typing.Any, DbRecordPointer]]:
+        curr_node = self._root
+        while curr_node.children:
+            curr_node = self._page_manager.read_page(curr_node.children[0])
+        while True:
+            for key, value in zip(curr_node.keys, curr_node.values):
+                yield self._user_key(key), value
+            if not curr_node.next:
+                return
+            curr_node = self._page_manager.read_page(curr_node.next)
+
     def get_leafs(self) -> typing.List[PersKey]:
         sorted_keys = []
         curr_node = self._root
         while curr_node.children:
             curr_node = self._page_manager.read_page(curr_node.children[0])
         assert isinstance(curr_node, PersBTreeNodeLeaf)
-        while curr_node.keys:
-            sorted_keys.extend(curr_node.keys)
+        while True:
+            sorted_keys.extend(PersKey(self._user_key(key)) for key in curr_node.keys)
             if curr_node.next:
                 curr_node = self._page_manager.read_page(curr_node.next)
             else:
                 break
         return sorted_keys
 
+    def _node_key(self, key) -> Key:
+        if self._key_type is str:
+            key = key.encode(STR_ENCODING)
+        if self._key_type is not int and len(key) > MAX_BYTES_KEY_LENGTH:
+            raise ValueError(f"Key {key} is longer than {MAX_BYTES_KEY_LENGTH} bytes")
+        return key
+
+    def _user_key(self, key: Key):
+        return key.decode(STR_ENCODING) if self._key_type is str else key
+
     def _get_or_create_root(self):
-        root = self._page_manager.read_page_or_get_empty(PagePointer(0))
+        root = self._page_manager.read_page_or_get_empty(self.ROOT_PAGE)
         if root.is_empty():
-            root = self._page_manager.save_new_page(root)
+            root = self._new_leaf(self.ROOT_PAGE, [], [], None, None)
+            self._page_manager.save_page(root)
         return root
 
     def dfs(self) -> typing.List[int]:
@@ -716,7 +1912,7 @@ class PersBTree:
     def _dfs_helper(self, node: PersBTreeNode, container: typing.List):
         if not node:
             return []
-        container.extend([pers_key.key for pers_key in node.keys])
+        container.extend(node.keys)
         for pointer in node.children:
             child_node = self._page_manager.read_page(pointer)
             self._dfs_helper(child_node, container)
@@ -732,14 +1928,227 @@ class PersBTree:
         from apps.broker.index.page_manager import PageManager
 
         self._file_handle = self._get_or_create_index_file(self._index_file_path)
-        self._page_manager = PageManager(self._file_handle, self._max_keys)
+        if self._write_ahead_log:
+            self._log = WriteAheadLog(self._index_file_path + '.wal')
+        self._page_manager = PageManager(self._file_handle, self._max_keys, self._lock_manager, self._max_leaf_keys,
+                                         self._log, cache_pages=self._cache_pages)
         self._root = self._get_or_create_root()
+        if not self._root.is_leaf() and self._counted != (self._root.subtree_counts is not None):
+            if self._counted:
+                raise ValueError(f"Index {self._index_file_path} has no subtree counts, it has to be compacted first")
+            # counts are kept up to date by every writer once the tree has them, they take room in index nodes
+            self._counted = True
+            if self._key_type is int:
+                self._max_keys = min(self._max_keys, COUNTED_PAGE_MAX_KEYS)
+                if not self._compressed_leafs:
+                    self._max_leaf_keys = self._max_keys
+            self._page_manager = PageManager(self._file_handle, self._max_keys, self._lock_manager,
+                                             self._max_leaf_keys, self._log, cache_pages=self._cache_pages)
+            self._root = self._get_or_create_root()
+        if self._log is not None:
+            self._page_manager.log_writes()
+        if self._bloom_filter is not None:
+            self._load_bloom_filter()
+        if self._prefetch_pages:
+            self._prefetcher = PagePrefetcher(self._page_manager, self.ROOT_PAGE)
         return self
 
+    def _load_bloom_filter(self):
+        # a filter saved on close is taken as it is, otherwise it is rebuilt from the keys in the tree
+        file_path = self._index_file_path + '.bloom'
+        if self._bloom_filter.load(file_path):
+            self._bloom_filter.mark_dirty(file_path)
+            return
+        for key, _ in self._items():
+            self._bloom_filter.add(self._node_key(key))
+        self._bloom_filter.save(file_path, clean=False)
+
+    def _open_in(self, page_manager: 'PageManager', lock_manager: LockManager,
+                 root_page: typing.Optional[PagePointer]) -> PagePointer:
+        # a tree of a catalog, the file, pages and latches are shared with the other trees in it,
+        # the root page is kept in place by the splits, so it is the one the catalog points to
+        self._page_manager = page_manager
+        self._lock_manager = lock_manager
+        if root_page is None:
+            root_page = page_manager.save_new_page(self._new_leaf(None, [], [], None, None)).pointer
+        self.ROOT_PAGE = root_page
+        self._root = page_manager.read_page(root_page)
+        return root_page
+
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        for file_handle, page_manager in self._retired_files:
+            page_manager.close_snapshots()
+            file_handle.close()
+        self._retired_files.clear()
+        self._page_manager.close_snapshots()
+        if self._bloom_filter is not None:
+            self._bloom_filter.save(self._index_file_path + '.bloom', clean=True)
+        if self._log is not None:
+            self._page_manager.checkpoint()
+            self._log.close()
         self._file_handle.close()
 
 
+class PersBTreeSnapshot:
+    # pages are read as they were when the snapshot was opened, incomplete splits are followed by the right-links
+    def __init__(self, pages: 'PageSnapshot', key_type: type):
+        self._pages = pages
+        self._key_type = key_type
+
+    def find(self, key) -> typing.Optional[DbRecordPointer]:
+        key = self._node_key(key)
+        return self._leaf(key).find(key)
+
+    def find_range(self, lo, hi) -> typing.List[typing.Tuple[typing.Any, DbRecordPointer]]:
+        lo, hi = self._node_key(lo), self._node_key(hi)
+        result = []
+        leaf = self._leaf(lo)
+        while True:
+            start = bisect.bisect_left(leaf.keys, lo)
+            end = bisect.bisect_right(leaf.keys, hi)
+            result.extend((self._user_key(k), v) for k, v in zip(leaf.keys[start:end], leaf.values[start:end]))
+            if end < len(leaf.keys) or not leaf.next:
+                return result
+            leaf = self._pages.read_page(leaf.next)
+
+    def items(self) -> typing.Iterator[typing.Tuple[typing.Any, DbRecordPointer]]:
+        node = self._pages.read_page(self._pages.root_pointer)
+        while not node.is_leaf():
+            node = self._pages.read_page(node.children[0])
+        while True:
+            for key, value in zip(node.keys, node.values):
+                yield self._user_key(key), value
+            if not node.next:
+                return
+            node = self._pages.read_page(node.next)
+
+    def close(self):
+        # page copies kept only for this snapshot are freed
+        self._pages.close()
+
+    def _leaf(self, key: Key) -> PersBTreeNodeLeaf:
+        node = self._pages.read_page(self._pages.root_pointer)
+        while not node.is_leaf():
+            node = self._pages.read_page(node.children[node._child_index(key)])
+        while node.incomplete_split and key >= node.high_key:
+            node = self._pages.read_page(node.next)
+        return node
+
+    def _node_key(self, key) -> Key:
+        return key.encode(STR_ENCODING) if self._key_type is str else key
+
+    def _user_key(self, key: Key):
+        return key.decode(STR_ENCODING) if self._key_type is str else key
+
+    def __enter__(self) -> 'PersBTreeSnapshot':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _checked_sorted_keys(items: typing.Iterable[typing.Tuple[Key, DbRecordPointer]]) \
+        -> typing.Iterator[typing.Tuple[Key, DbRecordPointer]]:
+    prev_key = None
+    for key, value in items:
+        if prev_key is not None:
+            if key == prev_key:
+                raise DuplicateKeyException(f"Duplicate key {key}")
+            if key < prev_key:
+                raise ValueError(f"Bulk load input is not sorted, {key} after {prev_key}")
+        prev_key = key
+        yield key, value
+
+
+def _balanced_chunks(items: typing.Iterable, capacity: int, max_size: int, min_size: int,
+                     weight: typing.Callable[[typing.Any], int] = lambda item: 1) -> typing.Iterator[list]:
+    # cuts items into chunks weighting up to `capacity`, the last two chunks are rebalanced when the last one
+    # would underflow
+    chunk = []
+    chunk_size = 0
+    pending = None
+    for item in items:
+        item_size = weight(item)
+        if chunk and chunk_size + item_size > capacity:
+            if pending is not None:
+                yield pending
+            pending, chunk, chunk_size = chunk, [], 0
+        chunk.append(item)
+        chunk_size += item_size
+    if pending is None:
+        if chunk:
+            yield chunk
+        return
+    if chunk_size >= min_size:
+        yield pending
+        yield chunk
+    else:
+        merged = pending + chunk
+        sizes = [weight(item) for item in merged]
+        total = sum(sizes)
+        if total <= max_size:
+            yield merged
+        else:
+            half = 0
+            half_size = 0
+            while half_size * 2 < total:
+                half_size += sizes[half]
+                half += 1
+            yield merged[:half]
+            yield merged[half:]
+
+
+def _compressed_leaf_chunks(items: typing.Iterable[typing.Tuple[int, DbRecordPointer]], fill_factor: float,
+                            max_count: int) -> typing.Iterator[list]:
+    # widths of a compressed leaf depend on all its entries, so the size is tracked while the chunk grows,
+    # the last chunk may stay less than half full like any compressed leaf
+    capacity = int((BLOCK_SIZE_BYTES - LEAF_TRAILER.size) * fill_factor)
+    chunk = []
+    min_block = max_block = max_slot = 0
+    for key, value in items:
+        if chunk:
+            min_block, max_block = min(min_block, value.block), max(max_block, value.block)
+            max_slot = max(max_slot, value.slot)
+            size = compressed_leaf_size(len(chunk) + 1, key - chunk[0][0], max_block - min_block, max_slot)
+            if len(chunk) >= max_count or size > capacity:
+                yield chunk
+                chunk = []
+        if not chunk:
+            min_block = max_block = value.block
+            max_slot = value.slot
+        chunk.append((key, value))
+    if chunk:
+        yield chunk
+
+
+def _subtree_count(node: PersBTreeNode) -> int:
+    return len(node.keys) if node.is_leaf() else sum(node.subtree_counts)
+
+
+def _shortest_separator(left: Key, right: Key) -> Key:
+    # suffix truncation, the shortest prefix of the right key still greater than the left one
+    if not isinstance(right, bytes):
+        return right
+    return right[:common_prefix_length(left, right) + 1]
+
+
+class TreeNotEmptyException(RuntimeError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+class TreeNotCopyOnWriteException(RuntimeError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
+class TreeNotCountedException(RuntimeError):
+    def __init__(self, msg: str):
+        super().__init__(msg)
+
+
 class DuplicateKeyException(RuntimeError):
     def __init__(self, msg):
         super().__init__(msg)
@@ -750,6 +2159,7 @@ class NoSuchKeyException(Exception):
         super().__init__(msg)
 
 
-class SiblingPointerAlreadyLockedException(Exception):
-    def __init__(self, msg: str):
+class IncompleteSplitException(Exception):
+    def __init__(self, msg: str, pointer: PagePointer):
         super().__init__(msg)
+        self.pointer = pointer
@@ -1,6 +1,7 @@
 import io
 from dataclasses import dataclass
 
+BLOCK_SIZE_BYTES = 4096
 PAGE_POINTER_BLOCK_NUMBER_BYTES = 4  # max 4294967296 pages in a tree
 PAGE_KEY_BYTES = 6  # max 2^48 elements
 INT_ENCODING = 'big'
@@ -0,0 +1,65 @@
+import bisect
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.broker.index.node_codec import PackedNode
+from apps.broker.index.persistent_data import PagePointer
+from apps.broker.utils import private
+
+PREFETCH_THREADS = 4
+
+# keys and children of an index node with what the walk carries to it, to the children the walk goes on to
+Route = typing.Callable[[typing.List, typing.List[PagePointer], typing.Any],
+                        typing.List[typing.Tuple[PagePointer, typing.Any]]]
+
+
+@private
+class PagePrefetcher:
+    # walks down the tree in the background a level at a time, the pages of a level are read in parallel
+    # into the page cache, so the reader descending after it finds them there, a walk reads the pages
+    # without latches, it may go astray because of a concurrent split, which only costs a useless read
+    def __init__(self, page_manager: 'PageManager', root_page: PagePointer, threads: int = PREFETCH_THREADS):
+        self._page_manager = page_manager
+        self._root_page = root_page
+        self._reads = ThreadPoolExecutor(threads, thread_name_prefix='prefetch-read')
+        self._walks = ThreadPoolExecutor(1, thread_name_prefix='prefetch-walk')
+
+    def prefetch_keys(self, sorted_keys: typing.List):
+        # the pages a batch lookup visits, every index node passes the keys on to the children they fall into
+        def route(keys: typing.List, children: typing.List[PagePointer], batch: typing.List) \
+                -> typing.List[typing.Tuple[PagePointer, typing.List]]:
+            routed = {}
+            for key in batch:
+                routed.setdefault(bisect.bisect_right(keys, key), []).append(key)
+            return [(children[i], routed[i]) for i in sorted(routed) if i < len(children)]
+
+        self._walks.submit(self._walk, route, sorted_keys, None)
+
+    def prefetch_range(self, lo, hi, leafs: int):
+        # the first leafs holding keys from the range, together with the index nodes above them
+        def route(keys: typing.List, children: typing.List[PagePointer], _) \
+                -> typing.List[typing.Tuple[PagePointer, None]]:
+            return [(child, None) for child in
+                    children[bisect.bisect_right(keys, lo):bisect.bisect_right(keys, hi) + 1]]
+
+        self._walks.submit(self._walk, route, None, leafs)
+
+    def _walk(self, route: Route, payload: typing.Any, limit: typing.Optional[int]):
+        level = [(self._root_page, payload)]
+        while level:
+            pages = self._reads.map(self._page_manager.read_ahead, [pointer for pointer, _ in level])
+            next_level = []
+            for (_, payload), data in zip(level, pages):
+                if limit is not None and len(next_level) >= limit:
+                    break
+                if not data:
+                    continue
+                node = PackedNode(data)
+                if node.children_count:
+                    next_level.extend(route(node.keys(), node.children(), payload))
+            level = next_level[:limit]
+
+    def close(self):
+        # waits for the reads in progress, the file is closed after that
+        self._walks.shutdown(wait=True, cancel_futures=True)
+        self._reads.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,136 @@
+import struct
+import threading
+import typing
+
+from apps.broker.index.lock_manager import LockManager
+from apps.broker.index.persistent_btree import PersBTree
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PagePointer
+from apps.broker.index.write_ahead_log import WriteAheadLog
+from apps.broker.storage.storage_engine import STR_ENCODING
+
+CATALOG_MAGIC = b'TCAT'
+CATALOG_HEADER = struct.Struct('>4siH')  # magic, next catalog page, entries count, followed by the entries
+CATALOG_NAME_LENGTH = struct.Struct('>B')
+CATALOG_ROOT = struct.Struct('>i')
+MAX_TREE_NAME_LENGTH = 255
+DEFAULT_CACHE_PAGES = 4096  # 16 MiB
+NONE_PAGE = -1
+
+
+class PersBTreeCatalog:
+    # named trees in a single file, they share its page cache, free list and latches, so the memory taken by
+    # the cached pages is bounded for all of them together, catalog pages map the names to the root pages
+    CATALOG_PAGE = PagePointer(1)  # the first page is the file header
+
+    def __init__(self, index_file_path: str, max_keys: typing.Optional[int] = None, key_type: type = int,
+                 cache_pages: int = DEFAULT_CACHE_PAGES, write_ahead_log: bool = False):
+        if cache_pages < 0:
+            raise ValueError(f"Cache pages count can not be negative, got {cache_pages}")
+        self._index_file_path = index_file_path
+        self._max_keys = max_keys
+        self._key_type = key_type
+        self._cache_pages = cache_pages
+        self._write_ahead_log = write_ahead_log
+        # pages are read the same way for all the trees, so they are all created with the same options
+        self._new_tree()
+        self._file_handle = None
+        self._log = None
+        self._page_manager = None
+        self._lock_manager = LockManager()
+        self._lock = threading.Lock()
+        self._roots: typing.Dict[str, PagePointer] = {}
+        self._catalog_pages: typing.List[PagePointer] = []
+        self._trees: typing.Dict[str, PersBTree] = {}
+
+    def tree(self, name: str) -> PersBTree:
+        # created on the first call, the tree stays open until the catalog is closed
+        encoded = name.encode(STR_ENCODING)
+        if not 0 < len(encoded) <= MAX_TREE_NAME_LENGTH:
+            raise ValueError(f"Tree name has to take [1, {MAX_TREE_NAME_LENGTH}] bytes, got {name}")
+        with self._lock:
+            tree = self._trees.get(name)
+            if tree is not None:
+                return tree
+            tree = self._new_tree()
+            root_page = tree._open_in(self._page_manager, self._lock_manager, self._roots.get(name))
+            if name not in self._roots:
+                self._roots[name] = root_page
+                self._save_catalog()
+                if self._log is not None:
+                    self._page_manager.log_writes()
+            self._trees[name] = tree
+            return tree
+
+    def names(self) -> typing.List[str]:
+        with self._lock:
+            return sorted(self._roots)
+
+    def _new_tree(self) -> PersBTree:
+        return PersBTree(self._index_file_path, self._max_keys, self._key_type,
+                         write_ahead_log=self._write_ahead_log)
+
+    def _save_catalog(self):
+        # the entries are written again as a whole, catalog pages are added at the end of the chain when needed
+        pages = [[]]
+        size = CATALOG_HEADER.size
+        for name, root in self._roots.items():
+            entry = CATALOG_NAME_LENGTH.pack(len(name.encode(STR_ENCODING))) + name.encode(STR_ENCODING) + \
+                CATALOG_ROOT.pack(root.block_number)
+            if size + len(entry) > BLOCK_SIZE_BYTES:
+                pages.append([])
+                size = CATALOG_HEADER.size
+            pages[-1].append(entry)
+            size += len(entry)
+        while len(self._catalog_pages) < len(pages):
+            self._catalog_pages.append(self._page_manager.save_new_block(b''))
+        for i, entries in enumerate(pages):
+            next_page = self._catalog_pages[i + 1].block_number if i + 1 < len(pages) else NONE_PAGE
+            self._page_manager.save_block(self._catalog_pages[i],
+                                          CATALOG_HEADER.pack(CATALOG_MAGIC, next_page, len(entries)) +
+                                          b''.join(entries))
+
+    def _load_catalog(self):
+        data = self._page_manager.read_block(self.CATALOG_PAGE)
+        if not data:
+            self._catalog_pages = [self.CATALOG_PAGE]
+            self._save_catalog()
+            return
+        pointer = self.CATALOG_PAGE
+        while pointer is not None:
+            magic, next_page, entries_count = CATALOG_HEADER.unpack_from(data)
+            if magic != CATALOG_MAGIC:
+                raise ValueError(f"Index {self._index_file_path} is not a catalog of trees")
+            self._catalog_pages.append(pointer)
+            offset = CATALOG_HEADER.size
+            for _ in range(entries_count):
+                length, = CATALOG_NAME_LENGTH.unpack_from(data, offset)
+                offset += CATALOG_NAME_LENGTH.size
+                name = data[offset:offset + length].decode(STR_ENCODING)
+                offset += length
+                self._roots[name] = PagePointer(CATALOG_ROOT.unpack_from(data, offset)[0])
+                offset += CATALOG_ROOT.size
+            pointer = PagePointer(next_page) if next_page != NONE_PAGE else None
+            if pointer is not None:
+                data = self._page_manager.read_block(pointer)
+
+    def __enter__(self) -> 'PersBTreeCatalog':
+        from apps.broker.index.page_manager import PageManager
+
+        tree = self._new_tree()
+        self._file_handle = PersBTree._get_or_create_index_file(self._index_file_path)
+        if self._write_ahead_log:
+            self._log = WriteAheadLog(self._index_file_path + '.wal')
+        self._page_manager = PageManager(self._file_handle, tree._max_keys, self._lock_manager, tree._max_leaf_keys,
+                                         self._log, cache_pages=self._cache_pages)
+        self._load_catalog()
+        if self._log is not None:
+            self._page_manager.log_writes()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._page_manager.close_snapshots()
+        if self._log is not None:
+            self._page_manager.checkpoint()
+            self._log.close()
+        self._file_handle.close()
+        self._trees.clear()
@@ -0,0 +1,56 @@
+import os
+import struct
+import typing
+import zlib
+
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PagePointer
+from apps.broker.utils import private
+
+RECORD_HEADER = struct.Struct('>II')  # payload length, crc32 of the payload
+PAGE_HEADER = struct.Struct('>i')  # block number
+
+PageImage = typing.Tuple[PagePointer, bytes]
+
+
+@private
+class WriteAheadLog:
+    # a record holds full images of the pages changed together, it is replayed as a whole or not at all
+    def __init__(self, file_path: str):
+        self._file = open(file_path, 'ab+')
+        self._size = self._file.seek(0, os.SEEK_END)
+
+    def append(self, pages: typing.List[PageImage]):
+        payload = b''.join(PAGE_HEADER.pack(pointer.block_number) + data for pointer, data in pages)
+        self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._size += RECORD_HEADER.size + len(payload)
+        # a process crash keeps what the os got, a torn record at the end is skipped on recovery
+        self._file.flush()
+
+    def records(self) -> typing.Iterator[typing.List[PageImage]]:
+        self._file.seek(0)
+        page_size = PAGE_HEADER.size + BLOCK_SIZE_BYTES
+        while True:
+            header = self._file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, checksum = RECORD_HEADER.unpack(header)
+            payload = self._file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                return
+            yield [(PagePointer(PAGE_HEADER.unpack_from(payload, i)[0]),
+                    payload[i + PAGE_HEADER.size:i + page_size]) for i in range(0, length, page_size)]
+
+    def size(self) -> int:
+        return self._size
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def truncate(self):
+        self._file.truncate(0)
+        self._size = 0
+        self.sync()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,99 @@
+import os
+import threading
+import typing
+
+from apps.broker.concurrent.utils import LockType, RWLock
+from apps.broker.index.node_codec import MAX_BYTES_KEY_LENGTH
+from apps.broker.index.persistent_btree import PersBTree
+from apps.broker.storage.storage_engine import STR_ENCODING, DbEngine, DbRecord, DbRecordPointer
+from apps.broker.utils import public
+
+KEY_SEPARATOR = ':'
+
+
+@public
+class KeyedStore:
+    # records are appended to the heap file and their keys are indexed by a tree, a later record of a key
+    # replaces the earlier one in the index, the heap is the source of truth, so the index is rebuilt
+    # from a scan of it when the store was not closed cleanly
+    def __init__(self, heap_file_path: str, index_file_path: typing.Optional[str] = None,
+                 max_keys: typing.Optional[int] = None):
+        self._engine = DbEngine(heap_file_path)
+        self._index_file_path = index_file_path or heap_file_path + '.index'
+        self._max_keys = max_keys
+        self._index: typing.Optional[PersBTree] = None
+        self._appends_lock = threading.Lock()
+        self._index_lock = RWLock()  # taken exclusively only to replace the index
+
+    def append_record(self, record: DbRecord) -> DbRecordPointer:
+        return self.append_records([record])[0]
+
+    def append_records(self, records: typing.List[DbRecord]) -> typing.List[DbRecordPointer]:
+        # the records are written to the heap at once, then their keys are indexed in a single batch,
+        # a record can be found by its key once its batch is done
+        for record in records:
+            self._check_key(record.key)
+        with self._appends_lock, self._index_lock.of(LockType.READ):
+            pointers = self._engine.append_records(records)
+            latest = dict(zip((record.key for record in records), pointers))
+            found = self._index.find_many(latest)
+            self._index.insert_many([(key, pointer) for (key, pointer), old in zip(latest.items(), found)
+                                     if old is None])
+            for (key, pointer), old in zip(latest.items(), found):
+                if old is not None:
+                    self._index.update(key, pointer)
+            return pointers
+
+    def get(self, key: str) -> typing.Optional[DbRecord]:
+        with self._index_lock.of(LockType.READ):
+            pointer = self._index.find(key)
+        return self._engine.read_record(pointer) if pointer is not None else None
+
+    def exists(self, key: str) -> bool:
+        # answered by the index alone
+        with self._index_lock.of(LockType.READ):
+            return self._index.find(key) is not None
+
+    def range(self, lo: str, hi: str) -> typing.List[DbRecord]:
+        # records of the keys in [lo, hi] in the key order
+        with self._index_lock.of(LockType.READ):
+            pointers = [pointer for _, pointer in self._index.find_range(lo, hi)]
+        return self._engine.read_records(pointers)
+
+    def rebuild_index(self):
+        with self._index_lock.of(LockType.WRITE):
+            self._index.__exit__(None, None, None)
+            os.remove(self._index_file_path)
+            self._index = self._open_index(rebuild=True)
+
+    def _open_index(self, rebuild: bool) -> PersBTree:
+        index = PersBTree(self._index_file_path, self._max_keys, str).__enter__()
+        if rebuild:
+            latest = {}
+            for pointer, record in self._engine.scan_records():
+                latest[record.key] = pointer
+            index.bulk_load(sorted(latest.items()))
+        return index
+
+    @staticmethod
+    def _check_key(key: str):
+        # the key is read back from the heap up to the separator
+        if KEY_SEPARATOR in key:
+            raise ValueError(f"Key {key} can not contain '{KEY_SEPARATOR}'")
+        if len(key.encode(STR_ENCODING)) > MAX_BYTES_KEY_LENGTH:
+            raise ValueError(f"Key {key} is longer than {MAX_BYTES_KEY_LENGTH} bytes")
+
+    def __enter__(self) -> 'KeyedStore':
+        # the marker is removed on close, a crash leaves the index behind the heap, so it is rebuilt
+        dirty_marker_path = self._index_file_path + '.dirty'
+        rebuild = os.path.exists(dirty_marker_path) or not os.path.exists(self._index_file_path)
+        if os.path.exists(self._index_file_path) and rebuild:
+            os.remove(self._index_file_path)
+        with open(dirty_marker_path, 'w'):
+            pass
+        self._index = self._open_index(rebuild)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._index.__exit__(exc_type, exc_val, exc_tb)
+        os.remove(self._index_file_path + '.dirty')
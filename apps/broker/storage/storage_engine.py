@@ -2,7 +2,7 @@ import io
 import os
 
 from dataclasses import dataclass
-from typing import List
+from typing import Iterable, Iterator, List, Tuple
 
 from apps.broker.utils import public, private, package_private
 
@@ -136,6 +136,9 @@ class DbBlock:
                 ))
         return cls(block_number, slot_pointers, binary_block)
 
+    def slots_count(self) -> int:
+        return len(self._slot_pointers)
+
     @staticmethod
     def data_fits_empty_block(data: bytes):
         return len(data) <= BLOCK_MAX_DATA_SIZE
@@ -169,10 +172,13 @@ class HeapFile:
         if self._data_blocks == 0:
             data_to_save = bytearray(DB_FILE_HEADER_SIZE_BYTES)
             data_to_save.extend(working_block.to_binary())
+            self._file.seek(0)
         else:
             data_to_save = working_block.to_binary()
             self._file.seek(DB_FILE_HEADER_SIZE_BYTES + working_block.block_number * BLOCK_SIZE_BYTES)
         self._file.write(data_to_save)
+        # the header is written once, when a few blocks are saved through the same heap file
+        self._data_blocks = max(self._data_blocks, working_block.block_number + 1)
 
     def number_of_data_blocks(self) -> int:
         last_offset = self._file.seek(0, os.SEEK_END)
@@ -215,6 +221,26 @@ class DbEngine:
                 heap_file.save(working_block)
             return index
 
+    def append_records(self, records: List[DbRecord]) -> List[DbRecordPointer]:
+        # the working block is read and written once for all the records landing in it
+        binary_records = [record.to_binary() for record in records]
+        for binary_data in binary_records:
+            if not DbBlock.data_fits_empty_block(binary_data):
+                raise DataToLargeException(f'Maximum data size is {BLOCK_MAX_DATA_SIZE}')
+
+        with open(self._db_file_path, 'r+b') as file:
+            heap_file = HeapFile(file)
+            working_block = heap_file.get_working_block()
+            indexes = []
+            for binary_data in binary_records:
+                if not working_block.has_space_for_data(binary_data):
+                    heap_file.save(working_block)
+                    working_block = DbBlock.empty(working_block.block_number + 1)
+                indexes.append(working_block.add_slot(binary_data))
+            if indexes:
+                heap_file.save(working_block)
+            return indexes
+
     def read_record(self, index: DbRecordPointer) -> DbRecord:
         with open(self._db_file_path, 'rb') as file:
             heap_file = HeapFile(file)
@@ -222,6 +248,28 @@ class DbEngine:
             binary_data = working_block.get_data(index.slot)
             return DbRecord.from_binary(binary_data)
 
+    def read_records(self, indexes: Iterable[DbRecordPointer]) -> List[DbRecord]:
+        # every block is read once, however many of the records it holds
+        blocks = {}
+        records = []
+        with open(self._db_file_path, 'rb') as file:
+            heap_file = HeapFile(file)
+            for index in indexes:
+                block = blocks.get(index.block)
+                if block is None:
+                    block = blocks[index.block] = heap_file.get_block(index)
+                records.append(DbRecord.from_binary(block.get_data(index.slot)))
+        return records
+
+    def scan_records(self) -> Iterator[Tuple[DbRecordPointer, DbRecord]]:
+        # in the order they were appended in
+        with open(self._db_file_path, 'rb') as file:
+            heap_file = HeapFile(file)
+            for block_number in range(heap_file.number_of_data_blocks()):
+                block = heap_file.get_block(DbRecordPointer(block_number, 0))
+                for slot in range(block.slots_count()):
+                    yield DbRecordPointer(block_number, slot), DbRecord.from_binary(block.get_data(slot))
+
     @staticmethod
     def _create_heap_file(file_path):
         with open(file_path, 'a+') as _:
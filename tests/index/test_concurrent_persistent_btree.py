@@ -148,6 +148,42 @@ class TestBTree(unittest.TestCase):
             for k in elements_updated:
                 self.assertEqual(tree.find(k), DbRecordPointer((k + 1) % max_pointer_block, (k + 1) % max_pointer_slot))
 
+    def test_should_find_and_scan_concurrently_with_writers(self):
+        with PersBTree(self.file_path, 5) as tree:
+            # given
+            thread_count = 12
+            executor = ThreadPoolExecutor(max_workers=thread_count, thread_name_prefix="test-concurrent-scan")
+            arr_len = 8000
+            stable = [i for i in range(0, arr_len, 2)]
+            inserted = [i for i in range(1, arr_len, 2)]
+            random.shuffle(stable)
+            random.shuffle(inserted)
+            for k in stable:
+                tree.insert(k, DbRecordPointer(k % 1000, 0))
+
+            def threaded_insert(chunk):
+                for k in chunk:
+                    tree.insert(k, DbRecordPointer(k % 1000, 0))
+
+            def threaded_find(chunk):
+                for k in chunk:
+                    assert tree.find(k) == DbRecordPointer(k % 1000, 0)
+
+            def threaded_scan(_):
+                for lo in range(0, arr_len, 500):
+                    scanned = [k for k, _ in tree.find_range(lo, lo + 499)]
+                    assert scanned == sorted(scanned)
+                    assert set(range(lo, lo + 500, 2)).issubset(scanned)
+
+            futures = [executor.submit(threaded_insert, c) for c in self._divide_into_chunks(inserted, 4)]
+            futures += [executor.submit(threaded_find, c) for c in self._divide_into_chunks(stable, 4)]
+            futures += [executor.submit(threaded_scan, i) for i in range(4)]
+            for f in futures:
+                f.result()
+
+            # then
+            self.assertEqual([k for k, _ in tree.find_range(0, arr_len)], list(range(arr_len)))
+
     @staticmethod
     def _divide_into_chunks(array, chunks_count) -> typing.List[typing.List[int]]:
         return [array[i::chunks_count] for i in range(chunks_count)]
@@ -0,0 +1,61 @@
+import os
+import random
+import unittest
+
+from apps.broker.index.hash_index import PersHashIndex
+from apps.broker.index.persistent_btree import DuplicateKeyException, NoSuchKeyException
+from apps.broker.storage.storage_engine import DbRecordPointer
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestPersHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.file_path = ensure_file_not_exists_in_current_dir('hash_index')
+
+    def tearDown(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def test_should_split_buckets_and_find_all_keys(self):
+        with PersHashIndex(self.file_path, 4) as index:
+            # given
+            keys = [i for i in range(1000)]
+            random.shuffle(keys)
+
+            # when
+            for k in keys:
+                index.insert(k, DbRecordPointer(k, 0))
+            for k in keys[:200]:
+                index.delete(k)
+            for k in keys[200:300]:
+                index.update(k, DbRecordPointer(k, 1))
+
+            # then
+            self.assertGreaterEqual(len(set(index._directory)), 1000 // 4)
+            for k in keys[:200]:
+                self.assertIsNone(index.find(k))
+            for k in keys[200:300]:
+                self.assertEqual(index.find(k), DbRecordPointer(k, 1))
+            for k in keys[300:]:
+                self.assertEqual(index.find(k), DbRecordPointer(k, 0))
+
+        # and
+        with PersHashIndex(self.file_path, 4) as index:
+            for k in keys[300:]:
+                self.assertEqual(index.find(k), DbRecordPointer(k, 0))
+
+    def test_should_reject_duplicated_and_missing_keys(self):
+        with PersHashIndex(self.file_path) as index:
+            # given
+            index.insert(5, DbRecordPointer(5, 0))
+
+            # then
+            with self.assertRaises(DuplicateKeyException):
+                index.insert(5, DbRecordPointer(5, 1))
+            with self.assertRaises(NoSuchKeyException):
+                index.delete(6)
+            with self.assertRaises(NoSuchKeyException):
+                index.update(6, DbRecordPointer(6, 0))
+            with self.assertRaises(ValueError):
+                index.find(-1)
+            self.assertEqual(index.find(5), DbRecordPointer(5, 0))
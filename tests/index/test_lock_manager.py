@@ -0,0 +1,46 @@
+import threading
+import unittest
+
+from apps.broker.concurrent.utils import LockType
+from apps.broker.index.lock_manager import LockManager
+from apps.broker.index.persistent_data import PagePointer
+
+
+class TestLockManager(unittest.TestCase):
+    def test_should_evict_released_latches(self):
+        # given
+        lock_manager = LockManager()
+        latches = [lock_manager.lock(PagePointer(i), LockType.READ) for i in range(100)]
+        second_reader = lock_manager.lock(PagePointer(0), LockType.READ)
+
+        # when
+        for latch in latches:
+            latch.release()
+
+        # then
+        self.assertEqual(lock_manager.latches_count(), 1)
+        second_reader.release()
+        self.assertEqual(lock_manager.latches_count(), 0)
+
+    def test_should_keep_latch_while_other_thread_waits(self):
+        # given
+        lock_manager = LockManager()
+        writer = lock_manager.lock(PagePointer(1), LockType.WRITE)
+        acquired = threading.Event()
+
+        def wait_for_latch():
+            with lock_manager.lock(PagePointer(1), LockType.WRITE):
+                acquired.set()
+
+        thread = threading.Thread(target=wait_for_latch)
+        thread.start()
+
+        # when
+        self.assertFalse(acquired.wait(0.1))
+        self.assertIsNone(lock_manager.lock(PagePointer(1), LockType.READ, blocking=False))
+        writer.release()
+        thread.join()
+
+        # then
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(lock_manager.latches_count(), 0)
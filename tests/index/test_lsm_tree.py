@@ -0,0 +1,61 @@
+import os
+import random
+import shutil
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.broker.index.lsm_tree import LSMTree
+from apps.broker.storage.storage_engine import DbRecordPointer
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestLSMTree(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = ensure_file_not_exists_in_current_dir('lsm')
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_should_find_newest_values_across_flushed_and_compacted_runs(self):
+        with LSMTree(self.dir_path, 50) as index:
+            # given
+            keys = [i for i in range(3000)]
+            random.shuffle(keys)
+
+            # when
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for f in [executor.submit(lambda chunk: [index.insert(k, DbRecordPointer(k, 0)) for k in chunk],
+                                          keys[i::4]) for i in range(4)]:
+                    f.result()
+            for k in range(0, 3000, 3):
+                index.delete(k)
+            for k in range(1, 3000, 3):
+                index.insert(k, DbRecordPointer(k, 1))
+
+            # then
+            self.assertGreater(len(index._levels), 1)
+            self.assertIsNone(index.find(300))
+            self.assertEqual(index.find(301), DbRecordPointer(301, 1))
+            self.assertEqual(index.find(302), DbRecordPointer(302, 0))
+            self.assertEqual(index.find_range(5, 10), [(5, DbRecordPointer(5, 0)), (7, DbRecordPointer(7, 1)),
+                                                       (8, DbRecordPointer(8, 0)), (10, DbRecordPointer(10, 1))])
+
+        # and
+        with LSMTree(self.dir_path, 50) as index:
+            self.assertEqual([k for k, _ in index.items()], [k for k in range(3000) if k % 3])
+
+    def test_should_recover_memtable_from_its_log(self):
+        # given
+        index = LSMTree(self.dir_path).__enter__()
+        index.insert(1, DbRecordPointer(1, 0))
+        index.insert(2, DbRecordPointer(2, 0))
+        index.delete(1)
+
+        # when
+        with open(os.path.join(self.dir_path, os.listdir(self.dir_path)[0]), 'ab') as log:
+            log.write(b'\x00\x00\x00')  # torn entry
+
+        # then
+        with LSMTree(self.dir_path) as recovered:
+            self.assertEqual(recovered.items(), [(2, DbRecordPointer(2, 0))])
@@ -0,0 +1,123 @@
+import unittest
+
+from apps.broker.index.node_codec import PackedNode, max_counted_keys_for_page, max_keys_for_page, \
+    pack_compressed_leaf, pack_leaf_trailer, pack_node
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PagePointer, PersKey
+from apps.broker.storage.storage_engine import DbRecordPointer
+
+
+class TestNodeCodec(unittest.TestCase):
+    def test_should_pack_elements_in_the_same_layout_as_single_elements(self):
+        # given
+        keys = [1, 2 ** 40 + 5, 2 ** 48 - 1]
+        values = [DbRecordPointer(0, 1), DbRecordPointer(2 ** 20 + 3, 7), DbRecordPointer(2 ** 24 - 1, 2 ** 16 - 1)]
+        children = [PagePointer(1), PagePointer(2 ** 31 - 1)]
+
+        # when
+        binary = pack_node(keys, values, children)
+
+        # then
+        expected = (bytes([0, 3]) + b''.join(PersKey(k).to_binary() for k in keys) +
+                    bytes([0, 3]) + b''.join(v.to_binary() for v in values) +
+                    bytes([0, 2]) + b''.join(c.to_binary() for c in children))
+        self.assertEqual(binary, expected)
+
+    def test_should_unpack_packed_node(self):
+        # given
+        keys = [k * 2 ** 33 + k for k in range(10)]
+        values = [DbRecordPointer(k * 2 ** 17, k) for k in range(10)]
+        binary = pack_node(keys, values, []) + pack_leaf_trailer(None, 0b10, 2 ** 47)
+
+        # when
+        packed = PackedNode(binary)
+
+        # then
+        self.assertEqual(packed.keys(), keys)
+        self.assertEqual(packed.values(), values)
+        self.assertEqual(packed.children(), [])
+        self.assertEqual(packed.leaf_trailer(), (None, 0b10, 2 ** 47))
+
+    def test_should_fit_full_nodes_into_page(self):
+        # given
+        max_keys = max_keys_for_page(BLOCK_SIZE_BYTES)
+        keys = [2 ** 48 - 1] * max_keys
+
+        # when
+        leaf = pack_node(keys, [DbRecordPointer(2 ** 24 - 1, 2 ** 16 - 1)] * max_keys, []) + \
+            pack_leaf_trailer(PagePointer(1), 0b11, 2 ** 48 - 1)
+        index_node = pack_node(keys, [], [PagePointer(2 ** 31 - 1)] * (max_keys + 1))
+        too_big_leaf = pack_node(keys + [1], [DbRecordPointer(1, 1)] * (max_keys + 1), []) + \
+            pack_leaf_trailer(PagePointer(1), 0b11, 1)
+
+        # then
+        self.assertGreater(max_keys, 255)
+        self.assertLessEqual(len(leaf), BLOCK_SIZE_BYTES)
+        self.assertLessEqual(len(index_node), BLOCK_SIZE_BYTES)
+        self.assertGreater(len(too_big_leaf), BLOCK_SIZE_BYTES)
+
+    def test_should_front_code_byte_string_keys(self):
+        # given
+        keys = [b'user/1', b'user/10', b'user/2', b'video']
+        values = [DbRecordPointer(k, 0) for k in range(4)]
+
+        # when
+        binary = pack_node(keys, values, [], bytes_keys=True) + \
+            pack_leaf_trailer(PagePointer(3), 0b10, b'w', bytes_keys=True)
+        packed = PackedNode(binary)
+
+        # then
+        self.assertTrue(packed.bytes_keys)
+        self.assertEqual(packed.keys(), keys)
+        self.assertEqual(packed.values(), values)
+        self.assertEqual(packed.leaf_trailer(), (PagePointer(3), 0b10, b'w'))
+        self.assertIn(bytes([6, 1]) + b'0', binary)  # only the suffix of b'user/10' is stored
+
+    def test_should_pack_compressed_leaf_relative_to_its_first_key_and_block(self):
+        # given
+        keys = [2 ** 40 + k for k in range(0, 300, 3)]
+        values = [DbRecordPointer(2 ** 20 + k // 10, k % 10) for k in range(100)]
+
+        # when
+        binary = pack_compressed_leaf(keys, values) + pack_leaf_trailer(None, 0, 2 ** 41)
+        packed = PackedNode(binary)
+
+        # then
+        self.assertTrue(packed.compressed)
+        self.assertEqual(packed.keys(), keys)
+        self.assertEqual(packed.values(), values)
+        self.assertEqual(packed.value(57), values[57])
+        self.assertEqual(packed.children(), [])
+        self.assertEqual(packed.leaf_trailer(), (None, 0, 2 ** 41))
+        self.assertLess(len(binary), len(pack_node(keys, values, [])) // 2)
+
+    def test_should_pack_subtree_counts_after_children(self):
+        # given
+        max_keys = max_counted_keys_for_page(BLOCK_SIZE_BYTES)
+        keys = [2 ** 48 - 1] * max_keys
+        children = [PagePointer(2 ** 31 - 1)] * (max_keys + 1)
+        counts = [2 ** 32 - 1] * (max_keys + 1)
+
+        # when
+        binary = pack_node(keys, [], children, subtree_counts=counts)
+        packed = PackedNode(binary)
+
+        # then
+        self.assertEqual(packed.keys(), keys)
+        self.assertEqual(packed.children(), children)
+        self.assertEqual(packed.subtree_counts(), counts)
+        self.assertIsNone(PackedNode(pack_node(keys, [], children)).subtree_counts())
+        self.assertLessEqual(len(binary), BLOCK_SIZE_BYTES)
+
+    def test_should_find_key_index_without_unpacking_keys(self):
+        # given
+        keys = [k * 2 ** 32 + k for k in range(0, 300, 3)]
+        packed = PackedNode(pack_node(keys, [DbRecordPointer(k, 0) for k in range(100)], []))
+
+        # when
+        found = [packed.key_index(k) for k in keys]
+
+        # then
+        self.assertEqual(found, list(range(100)))
+        self.assertIsNone(packed.key_index(1))
+        self.assertIsNone(packed.key_index(2 ** 48 - 1))
+        self.assertIsNone(PackedNode(pack_node([], [], [])).key_index(0))
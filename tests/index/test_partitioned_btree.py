@@ -0,0 +1,60 @@
+import os
+import random
+import shutil
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.broker.index.partitioned_btree import PartitionedPersBTree
+from apps.broker.storage.storage_engine import DbRecordPointer
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestPartitionedPersBTree(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = ensure_file_not_exists_in_current_dir('forest')
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_should_spread_keys_over_partitions_and_merge_them_in_order(self):
+        with PartitionedPersBTree(self.dir_path, 4, 5) as index:
+            # given
+            keys = [i for i in range(2000)]
+            random.shuffle(keys)
+
+            # when
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for f in [executor.submit(lambda chunk: [index.insert(k, DbRecordPointer(k, 0)) for k in chunk],
+                                          keys[i::4]) for i in range(4)]:
+                    f.result()
+            index.delete(7)
+            index.update(8, DbRecordPointer(8, 1))
+
+            # then
+            self.assertTrue(all(len(tree.find_range(0, 2000)) > 300 for tree in index._trees))
+            self.assertEqual(index.find(8), DbRecordPointer(8, 1))
+            self.assertIsNone(index.find(7))
+            self.assertEqual(index.find_many([9, 7, 1999]), [DbRecordPointer(9, 0), None, DbRecordPointer(1999, 0)])
+            self.assertEqual([k for k, _ in index.find_range(5, 10)], [5, 6, 8, 9, 10])
+            self.assertEqual([k for k, _ in index.items()], [k for k in range(2000) if k != 7])
+
+        # and
+        with PartitionedPersBTree(self.dir_path, 4, 5) as index:
+            self.assertEqual(index.find(1000), DbRecordPointer(1000, 0))
+        with self.assertRaises(ValueError):
+            with PartitionedPersBTree(self.dir_path, 3, 5):
+                pass
+
+    def test_should_partition_string_keys_the_same_way_in_every_process(self):
+        with PartitionedPersBTree(self.dir_path, 3, key_type=str) as index:
+            # given
+            keys = [f'user/{i}' for i in range(300)]
+
+            # when
+            index.insert_many((k, DbRecordPointer(i, 0)) for i, k in enumerate(keys))
+
+            # then
+            self.assertEqual([k for k, _ in index.items()], sorted(keys))
+            self.assertEqual(index._partition('user/1'), 2)
+            self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'partition-2')))
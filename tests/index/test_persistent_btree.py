@@ -1,8 +1,10 @@
 import os
 import random
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from apps.broker.index.persistent_btree import PersBTree, PersBTreeNode, PersBTreeNodeLeaf, PagePointer, PersKey
+from apps.broker.index.persistent_btree import PersBTree, PersBTreeNode, PersBTreeNodeLeaf, PagePointer, \
+    TreeNotCopyOnWriteException, TreeNotEmptyException, DuplicateKeyException
 from apps.broker.storage.storage_engine import DbRecordPointer
 from tests.test_utils import ensure_file_not_exists_in_current_dir
 
@@ -18,24 +20,25 @@ class TestBTree(unittest.TestCase):
     def test_should_properly_serialize_leaf_node(self):
         # given
         pointer = PagePointer(0)
-        leaf = PersBTreeNodeLeaf(pointer, [PersKey(1), PersKey(2)], [], [DbRecordPointer(1, 1), DbRecordPointer(2, 2)], 3,
-                                 PagePointer(1), PagePointer(2), None, None)
+        leaf = PersBTreeNodeLeaf(pointer, [1, 2], [], [DbRecordPointer(1, 1), DbRecordPointer(2, 2)], 3,
+                                 PagePointer(1), 5, None, None, incomplete_split=True)
 
         # when
         binary = leaf.to_binary()
 
         # then
         deserialized = PersBTreeNodeLeaf.from_binary(pointer, binary, 3, None, None)
-        self.assertEqual(deserialized.keys, [PersKey(1), PersKey(2)])
+        self.assertEqual(deserialized.keys, [1, 2])
         self.assertEqual(deserialized.values, [DbRecordPointer(1, 1), DbRecordPointer(2, 2)])
         self.assertEqual(deserialized.children, [])
         self.assertEqual(deserialized.next, PagePointer(1))
-        self.assertEqual(deserialized.prev, PagePointer(2))
+        self.assertEqual(deserialized.high_key, 5)
+        self.assertTrue(deserialized.incomplete_split)
 
     def test_should_properly_serialize_index_node(self):
         # given
         pointer = PagePointer(0)
-        node = PersBTreeNode(pointer, [PersKey(1), PersKey(2)], [PagePointer(1), PagePointer(2)], [],
+        node = PersBTreeNode(pointer, [1, 2], [PagePointer(1), PagePointer(2)], [],
                              3, None, None)
 
         # when
@@ -43,7 +46,7 @@ class TestBTree(unittest.TestCase):
 
         # then
         deserialized = PersBTreeNodeLeaf.from_binary(pointer, binary, 3, None, None)
-        self.assertEqual(deserialized.keys, [PersKey(1), PersKey(2)])
+        self.assertEqual(deserialized.keys, [1, 2])
         self.assertEqual(deserialized.values, [])
         self.assertEqual(deserialized.children, [PagePointer(1), PagePointer(2)])
 
@@ -529,3 +532,520 @@ class TestBTree(unittest.TestCase):
                     self.assertEqual(tree.find(k), DbRecordPointer(k + 1, k + 1))
                 else:
                     self.assertEqual(tree.find(k), DbRecordPointer(k, k))
+
+    def test_should_bulk_load_sorted_input(self):
+        with PersBTree(self.file_path, 5) as tree:
+            # given
+            keys = [i * 2 for i in range(5000)]
+
+            # when
+            tree.bulk_load((k, DbRecordPointer(k, k % 100)) for k in keys)
+
+            # then
+            self.assertEqual([t.key for t in tree.get_leafs()], keys)
+            for k in keys:
+                self.assertEqual(tree.find(k), DbRecordPointer(k, k % 100))
+            self.assertIsNone(tree.find(1))
+
+            # and tree is still maintainable after loading
+            for k in keys[:2500]:
+                tree.delete(k)
+            for k in range(1, 2001, 2):
+                tree.insert(k, DbRecordPointer(k, 0))
+            self.assertEqual([t.key for t in tree.get_leafs()], sorted(keys[2500:] + list(range(1, 2001, 2))))
+
+    def test_should_bulk_load_unsorted_input_with_external_sort(self):
+        with PersBTree(self.file_path, 4) as tree:
+            # given
+            keys = [i for i in range(3000)]
+            random.shuffle(keys)
+
+            # when
+            tree.bulk_load(((k, DbRecordPointer(k, 0)) for k in keys), fill_factor=0.75, sort_input=True,
+                           sort_buffer_records=128)
+
+            # then
+            self.assertEqual([t.key for t in tree.get_leafs()], sorted(keys))
+            for k in keys:
+                self.assertEqual(tree.find(k), DbRecordPointer(k, 0))
+
+    def test_should_bulk_load_into_single_root_leaf(self):
+        with PersBTree(self.file_path, 5) as tree:
+            # when
+            tree.bulk_load([(1, DbRecordPointer(1, 1)), (2, DbRecordPointer(2, 2)), (3, DbRecordPointer(3, 3))])
+
+            # then
+            self.assertEqual(tree.dfs(), [1, 2, 3])
+            self.assertEqual(tree.find(2), DbRecordPointer(2, 2))
+
+    def test_should_not_bulk_load_into_not_empty_tree(self):
+        with PersBTree(self.file_path, 5) as tree:
+            # given
+            tree.insert(1, DbRecordPointer(1, 1))
+
+            # expect
+            with self.assertRaises(TreeNotEmptyException):
+                tree.bulk_load([(2, DbRecordPointer(2, 2))])
+
+    def test_should_not_bulk_load_not_sorted_input(self):
+        with PersBTree(self.file_path, 5) as tree:
+            # expect
+            with self.assertRaises(ValueError):
+                tree.bulk_load([(2, DbRecordPointer(2, 2)), (1, DbRecordPointer(1, 1))])
+            with self.assertRaises(DuplicateKeyException):
+                tree.bulk_load([(1, DbRecordPointer(1, 1)), (1, DbRecordPointer(1, 1))])
+
+    def test_should_derive_fanout_from_page_size(self):
+        with PersBTree(self.file_path) as tree:
+            # given
+            keys = [i for i in range(1000)]
+            random.shuffle(keys)
+
+            # when
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+
+            # then
+            children = [tree._page_manager.read_page(c) for c in tree._root.children]
+            self.assertFalse(tree._root.is_leaf())
+            self.assertTrue(all(child.is_leaf() for child in children))
+            self.assertEqual([tree.find(k) for k in range(1000)], [DbRecordPointer(k, 0) for k in range(1000)])
+            with self.assertRaises(ValueError):
+                PersBTree(self.file_path, 100000)
+
+    def test_should_find_keys_in_range(self):
+        with PersBTree(self.file_path, 4) as tree:
+            # given
+            keys = [i for i in range(0, 1000, 3)]
+            random.shuffle(keys)
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+
+            # when
+            result = tree.find_range(100, 200)
+
+            # then
+            self.assertEqual(result, [(k, DbRecordPointer(k, 0)) for k in range(102, 201, 3)])
+            self.assertEqual(tree.find_range(2000, 3000), [])
+            self.assertEqual(len(tree.find_range(0, 999)), len(keys))
+
+    def test_should_insert_and_find_batches_of_keys(self):
+        with PersBTree(self.file_path, 4) as tree:
+            # given
+            keys = [i for i in range(600)]
+            random.shuffle(keys)
+            tree.insert_many((k, DbRecordPointer(k, 0)) for k in keys[:300])
+
+            # when
+            tree.insert_many((k, DbRecordPointer(k, 0)) for k in keys[300:])
+            found = tree.find_many(keys + [600, keys[0]])
+
+            # then
+            self.assertEqual(found, [DbRecordPointer(k, 0) for k in keys] + [None, DbRecordPointer(keys[0], 0)])
+            self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys))
+            with self.assertRaises(DuplicateKeyException):
+                tree.insert_many([(600, DbRecordPointer(1, 0)), (keys[0], DbRecordPointer(1, 0))])
+            with self.assertRaises(DuplicateKeyException):
+                tree.insert_many([(601, DbRecordPointer(1, 0)), (601, DbRecordPointer(2, 0))])
+            self.assertIsNone(tree.find(601))
+
+    def test_should_upsert_and_compare_and_set_values(self):
+        with PersBTree(self.file_path, 3) as tree:
+            # given
+            for k in range(0, 40, 2):
+                tree.insert(k, DbRecordPointer(k, 0))
+
+            # when
+            replaced = [tree.upsert(k, DbRecordPointer(k, 1)) for k in range(40)]
+            set_when_absent = tree.compare_and_set(40, None, DbRecordPointer(40, 1))
+            set_when_present = tree.compare_and_set(40, None, DbRecordPointer(40, 2))
+            set_when_matching = tree.compare_and_set(3, DbRecordPointer(3, 1), DbRecordPointer(3, 2))
+            set_when_stale = tree.compare_and_set(5, DbRecordPointer(5, 0), DbRecordPointer(5, 2))
+
+            # then
+            self.assertEqual(replaced, [DbRecordPointer(k, 0) if k % 2 == 0 else None for k in range(40)])
+            self.assertEqual([set_when_absent, set_when_present, set_when_matching, set_when_stale],
+                             [True, False, True, False])
+            self.assertEqual(tree.find_many([3, 5, 40]),
+                             [DbRecordPointer(3, 2), DbRecordPointer(5, 1), DbRecordPointer(40, 1)])
+            self.assertEqual([k.key for k in tree.get_leafs()], list(range(41)))
+
+    def test_should_count_keys_in_ranges(self):
+        with PersBTree(self.file_path, 3, counted=True) as tree:
+            # given
+            keys = [i for i in range(0, 1000, 2)]
+            random.shuffle(keys)
+            tree.insert_many((k, DbRecordPointer(k, 0)) for k in keys[:250])
+            for k in keys[250:]:
+                tree.insert(k, DbRecordPointer(k, 0))
+            for k in keys[:100]:
+                tree.delete(k)
+            remaining = sorted(keys[100:])
+
+            # when
+            counts = [tree.count_range(lo, lo + 99) for lo in range(0, 1000, 100)]
+            ranks = [tree.rank(k) for k in (-1, remaining[10], remaining[10] + 1, 1000)]
+            selected = [tree.select(i) for i in (0, 200, len(remaining) - 1)]
+
+            # then
+            self.assertEqual(counts, [len([k for k in remaining if lo <= k <= lo + 99]) for lo in range(0, 1000, 100)])
+            self.assertEqual(ranks, [0, 10, 11, len(remaining)])
+            self.assertEqual(selected, [(k, DbRecordPointer(k, 0)) for k in (remaining[0], remaining[200],
+                                                                                remaining[-1])])
+            with self.assertRaises(ValueError):
+                tree.select(len(remaining))
+        with PersBTree(self.file_path, 3) as tree:
+            tree.delete(remaining[0])
+            self.assertEqual(tree.count_range(0, 1000), len(remaining) - 1)
+
+    def test_should_delete_ranges_of_keys(self):
+        with PersBTree(self.file_path, 3, counted=True) as tree:
+            # given
+            keys = [i for i in range(0, 2000, 2)]
+            random.shuffle(keys)
+            tree.insert_many((k, DbRecordPointer(k, 0)) for k in keys)
+            free_pages = tree._page_manager.free_pages_count()
+
+            # when
+            removed = [tree.delete_range(lo, hi) for lo, hi in [(501, 1299), (-1, 99), (1901, 5000), (7, 3)]]
+            remaining = [k for k in range(100, 1901, 2) if not 501 <= k <= 1299]
+
+            # then
+            self.assertEqual(removed, [399, 50, 49, 0])
+            self.assertEqual([k.key for k in tree.get_leafs()], remaining)
+            self.assertEqual(tree.count_range(0, 2000), len(remaining))
+            self.assertEqual(tree.rank(1300), remaining.index(1300))
+            self.assertGreater(tree._page_manager.free_pages_count(), free_pages + 250)
+            for k in range(501, 1300):
+                tree.insert(k, DbRecordPointer(k, 1))
+            self.assertEqual(tree.count_range(0, 2000), len(remaining) + 799)
+            self.assertEqual(tree.delete_range(0, 2000), len(remaining) + 799)
+            self.assertEqual(tree.get_leafs(), [])
+
+    def test_should_pop_lowest_keys(self):
+        with PersBTree(self.file_path, 3, counted=True) as tree:
+            # given
+            keys = [i for i in range(0, 600, 3)]
+            random.shuffle(keys)
+            tree.insert_many((k, DbRecordPointer(k, 0)) for k in keys)
+            free_pages = tree._page_manager.free_pages_count()
+
+            # when
+            first = tree.pop_min()
+            batch = tree.pop_min_batch(50)
+            tree.insert(1, DbRecordPointer(1, 1))
+            lowest = tree.peek_min()
+            rest = [tree.pop_min() for _ in range(150)]
+
+            # then
+            self.assertEqual(first, (0, DbRecordPointer(0, 0)))
+            self.assertEqual([k for k, _ in batch], list(range(3, 153, 3)))
+            self.assertEqual(lowest, (1, DbRecordPointer(1, 1)))
+            self.assertEqual([k for k, _ in rest], [1] + list(range(153, 600, 3)))
+            self.assertIsNone(tree.pop_min())
+            self.assertIsNone(tree.peek_min())
+            self.assertEqual(tree.pop_min_batch(10), [])
+            self.assertGreater(tree._page_manager.free_pages_count(), free_pages + 50)
+            with self.assertRaises(ValueError):
+                tree.pop_min_batch(0)
+
+    def test_should_read_snapshot_unchanged_by_later_writes(self):
+        with PersBTree(self.file_path, 3, copy_on_write=True) as tree:
+            # given
+            keys = [i for i in range(0, 600, 2)]
+            random.shuffle(keys)
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+            snapshot = tree.snapshot()
+
+            # when
+            for k in range(1, 600, 4):
+                tree.insert(k, DbRecordPointer(k, 1))
+            for k in keys[:100]:
+                tree.delete(k)
+            tree.delete_range(200, 400)
+            tree.update(501, DbRecordPointer(501, 2))
+            newer_snapshot = tree.snapshot()
+            tree.pop_min_batch(20)
+
+            # then
+            self.assertEqual(list(snapshot.items()), [(k, DbRecordPointer(k, 0)) for k in range(0, 600, 2)])
+            self.assertEqual(snapshot.find_range(199, 205), [(k, DbRecordPointer(k, 0)) for k in range(200, 206, 2)])
+            self.assertEqual(snapshot.find(500), DbRecordPointer(500, 0))
+            self.assertIsNone(snapshot.find(501))
+            self.assertEqual(newer_snapshot.find(501), DbRecordPointer(501, 2))
+            self.assertEqual(newer_snapshot.find(1), DbRecordPointer(1, 1))
+            self.assertEqual(newer_snapshot.find_range(200, 400), [])
+            self.assertGreater(tree._page_manager.snapshot_pages_count(), 0)
+
+            # and
+            snapshot.close()
+            newer_snapshot.close()
+            self.assertEqual(tree._page_manager.snapshot_pages_count(), 0)
+            with self.assertRaises(ValueError):
+                snapshot.find(0)
+        with PersBTree(self.file_path, 3) as tree, self.assertRaises(TreeNotCopyOnWriteException):
+            tree.snapshot()
+
+    def test_should_recover_logged_changes_not_written_back(self):
+        # given
+        keys = [i for i in range(1000)]
+        random.shuffle(keys)
+        tree = PersBTree(self.file_path, 3, write_ahead_log=True).__enter__()
+        for k in keys:
+            tree.insert(k, DbRecordPointer(k, 0))
+        for k in keys[:300]:
+            tree.delete(k)
+
+        # when
+        tree._log.close()
+        tree._file_handle.close()  # crash, pages are not written back
+
+        # then
+        try:
+            with PersBTree(self.file_path, 3, write_ahead_log=True) as tree:
+                self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys[300:]))
+                for k in keys[300:]:
+                    self.assertEqual(tree.find(k), DbRecordPointer(k, 0))
+            self.assertEqual(os.path.getsize(self.file_path + '.wal'), 0)
+            with PersBTree(self.file_path, 3) as tree:
+                self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys[300:]))
+        finally:
+            os.remove(self.file_path + '.wal')
+
+    def test_should_answer_missing_keys_from_bloom_filter_without_reading_pages(self):
+        try:
+            with PersBTree(self.file_path, 3, bloom_filter_keys=1000) as tree:
+                # given
+                for k in range(0, 2000, 2):
+                    tree.insert(k, DbRecordPointer(k, 0))
+                reads = []
+                read_page = tree._page_manager.read_page
+                tree._page_manager.read_page = lambda pointer: reads.append(pointer) or read_page(pointer)
+
+                # when
+                missing = [tree.find(k) for k in range(1, 2000, 2)]
+
+                # then
+                self.assertEqual(missing, [None] * 1000)
+                self.assertLess(len(reads), 100)
+                self.assertEqual(tree.find_many([4, 5, 6]), [DbRecordPointer(4, 0), None, DbRecordPointer(6, 0)])
+
+            # and
+            with PersBTree(self.file_path, 3, bloom_filter_keys=1000) as tree:
+                self.assertEqual(tree.find(1998), DbRecordPointer(1998, 0))
+                tree.insert(1999, DbRecordPointer(1999, 0))
+                tree._file_handle.close()  # crash, the filter saved on open lacks the new key
+            with PersBTree(self.file_path, 3, bloom_filter_keys=1000) as tree:
+                self.assertEqual(tree.find(1999), DbRecordPointer(1999, 0))
+        finally:
+            os.remove(self.file_path + '.bloom')
+
+    def test_should_prefetch_pages_of_scans_and_batch_lookups_into_cache(self):
+        with PersBTree(self.file_path, 3, cache_pages=5000, prefetch_pages=8) as tree:
+            # given
+            keys = [i for i in range(2000)]
+            random.shuffle(keys)
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+            tree._page_manager._cache.clear()
+            prefetched = []
+            read_ahead = tree._page_manager.read_ahead
+            tree._page_manager.read_ahead = lambda pointer: prefetched.append(pointer) or read_ahead(pointer)
+
+            # when
+            found = tree.find_range(100, 1900)
+            found_many = tree.find_many([5, 1500, 2500, 700])
+            tree.delete(1000)
+            tree._prefetcher._walks.submit(lambda: None).result()  # walks run one after another
+
+            # then
+            self.assertEqual(found, [(k, DbRecordPointer(k, 0)) for k in range(100, 1901)])
+            self.assertEqual(found_many, [DbRecordPointer(5, 0), DbRecordPointer(1500, 0), None,
+                                          DbRecordPointer(700, 0)])
+            self.assertGreater(len(prefetched), 100)
+            self.assertIsNone(tree.find(1000))
+            self.assertEqual(len(tree.find_range(0, 2000)), 1999)
+        with self.assertRaises(ValueError):
+            PersBTree(self.file_path, prefetch_pages=8)
+
+    def test_should_store_dense_keys_in_compressed_leafs(self):
+        compressed_path = ensure_file_not_exists_in_current_dir('compressed_tree')
+        try:
+            with PersBTree(self.file_path) as tree, PersBTree(compressed_path, compressed_leafs=True) as compressed:
+                # given
+                keys = [i for i in range(8000)]
+                random.shuffle(keys)
+
+                # when
+                for k in keys:
+                    tree.insert(k, DbRecordPointer(k // 20, k % 20))
+                    compressed.insert(k, DbRecordPointer(k // 20, k % 20))
+                pages = tree._page_manager.end_pointer().block_number
+                compressed_pages = compressed._page_manager.end_pointer().block_number
+                for k in keys[:2000]:
+                    compressed.delete(k)
+                compressed.update(keys[2000], DbRecordPointer(2 ** 24 - 1, 2 ** 16 - 1))
+
+                # then
+                self.assertLess(compressed_pages * 2, pages)
+                self.assertEqual([t.key for t in compressed.get_leafs()], sorted(keys[2000:]))
+                self.assertEqual(compressed.find(keys[2000]), DbRecordPointer(2 ** 24 - 1, 2 ** 16 - 1))
+                self.assertEqual(compressed.find(keys[3000]), DbRecordPointer(keys[3000] // 20, keys[3000] % 20))
+                self.assertIsNone(compressed.find(keys[0]))
+            with PersBTree(compressed_path, compressed_leafs=True) as compressed:
+                self.assertEqual(len(compressed.find_range(0, 8000)), 6000)
+        finally:
+            os.remove(compressed_path)
+
+    def test_should_index_string_keys_with_shared_prefixes(self):
+        with PersBTree(self.file_path, key_type=str) as tree:
+            # given
+            keys = [f'topic/partition-{i % 7}/offset-{i:08d}' for i in range(2000)]
+            random.shuffle(keys)
+
+            # when
+            for i, k in enumerate(keys):
+                tree.insert(k, DbRecordPointer(i, 0))
+            for k in keys[:1000]:
+                tree.delete(k)
+
+            # then
+            self.assertEqual([t.key for t in tree.get_leafs()], sorted(keys[1000:]))
+            self.assertEqual(tree.find(keys[1500]), DbRecordPointer(1500, 0))
+            self.assertIsNone(tree.find(keys[0]))
+            self.assertEqual([k for k, _ in tree.find_range('topic/partition-3/', 'topic/partition-3/~')],
+                             sorted(k for k in keys[1000:] if k.startswith('topic/partition-3/')))
+            self.assertFalse(tree._root.is_leaf())
+            with self.assertRaises(ValueError):
+                tree.insert('x' * 256, DbRecordPointer(1, 1))
+
+    def test_should_bulk_load_byte_string_keys(self):
+        with PersBTree(self.file_path, 4, key_type=bytes) as tree:
+            # given
+            keys = [f'{i * 7919 % 2000:05d}'.encode() * (i % 5 + 1) for i in range(2000)]
+
+            # when
+            tree.bulk_load(((k, DbRecordPointer(i, 0)) for i, k in enumerate(keys)), sort_input=True,
+                           sort_buffer_records=128)
+
+            # then
+            self.assertEqual([t.key for t in tree.get_leafs()], sorted(keys))
+            for i, k in enumerate(keys):
+                self.assertEqual(tree.find(k), DbRecordPointer(i, 0))
+
+    def test_should_follow_right_links_of_not_completed_splits(self):
+        with PersBTree(self.file_path, 3) as tree:
+            # given
+            for k in range(10):
+                tree.insert(k, DbRecordPointer(k, 0))
+            insert_separator = tree._insert_separator
+            tree._insert_separator = lambda separator, right_pointer: None
+            for k in range(10, 20):
+                tree.insert(k, DbRecordPointer(k, 0))
+            tree._insert_separator = insert_separator
+
+            # when
+            found = [tree.find(k) for k in range(20)]
+            tree.update(19, DbRecordPointer(19, 1))
+            tree.delete(10)
+
+            # then
+            self.assertEqual(found, [DbRecordPointer(k, 0) for k in range(20)])
+            self.assertEqual(tree.find(19), DbRecordPointer(19, 1))
+            self.assertIsNone(tree.find(10))
+            self.assertEqual([k.key for k in tree.get_leafs()], [k for k in range(20) if k != 10])
+            self.assertEqual([k for k, _ in tree.find_range(5, 15)], [5, 6, 7, 8, 9, 11, 12, 13, 14, 15])
+
+    def test_should_reuse_freed_pages(self):
+        # given
+        keys = [i for i in range(300)]
+        random.shuffle(keys)
+        with PersBTree(self.file_path, 3) as tree:
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+            for k in keys[:200]:
+                tree.delete(k)
+        file_size = os.path.getsize(self.file_path)
+
+        # when
+        with PersBTree(self.file_path, 3) as tree:
+            for k in keys[:100]:
+                tree.insert(k, DbRecordPointer(k, 0))
+
+            # then
+            self.assertEqual(os.path.getsize(self.file_path), file_size)
+            self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys[:100] + keys[200:]))
+
+    def test_should_shrink_index_file(self):
+        with PersBTree(self.file_path, 3) as tree:
+            # given
+            for k in range(300):
+                tree.insert(k, DbRecordPointer(k, 0))
+            for k in range(300):
+                tree.delete(k)
+            file_size = os.path.getsize(self.file_path)
+
+            # when
+            released = tree.shrink()
+
+            # then
+            self.assertGreater(released, 0)
+            self.assertEqual(os.path.getsize(self.file_path), file_size - released * 4096)
+            tree.insert(1, DbRecordPointer(1, 0))
+            self.assertEqual(tree.find(1), DbRecordPointer(1, 0))
+
+    def test_should_compact_index_file(self):
+        # given
+        keys = [i for i in range(500)]
+        random.shuffle(keys)
+        with PersBTree(self.file_path, 3) as tree:
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+            for k in keys[:400]:
+                tree.delete(k)
+        file_size = os.path.getsize(self.file_path)
+
+        # when
+        PersBTree.compact(self.file_path, 3)
+
+        # then
+        self.assertLess(os.path.getsize(self.file_path), file_size)
+        with PersBTree(self.file_path, 3) as tree:
+            self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys[400:]))
+            for k in keys[400:]:
+                self.assertEqual(tree.find(k), DbRecordPointer(k, 0))
+
+    def test_should_rebuild_index_file_online(self):
+        with PersBTree(self.file_path, 3) as tree:
+            # given
+            keys = [i for i in range(600)]
+            random.shuffle(keys)
+            for k in keys:
+                tree.insert(k, DbRecordPointer(k, 0))
+            for k in keys[:400]:
+                tree.delete(k)
+            file_size = os.path.getsize(self.file_path)
+
+            # when
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                writes = executor.submit(lambda: [tree.insert(k, DbRecordPointer(k, 1)) for k in keys[:100]])
+                tree.rebuild()
+                writes.result()
+            tree.rebuild()
+
+            # then
+            self.assertLess(os.path.getsize(self.file_path), file_size)
+            self.assertEqual([k.key for k in tree.get_leafs()], sorted(keys[:100] + keys[400:]))
+            pointers = []
+            leaf = tree._page_manager.read_page(tree._min_leaf_pointer())
+            while leaf.next:
+                pointers.append(leaf.next.block_number)
+                leaf = tree._page_manager.read_page(leaf.next)
+            self.assertEqual(pointers, sorted(pointers))
+
+        # and
+        with PersBTree(self.file_path, 3) as tree:
+            for k in keys[:100]:
+                self.assertEqual(tree.find(k), DbRecordPointer(k, 1))
+            self.assertFalse(os.path.exists(self.file_path + '.rebuilt'))
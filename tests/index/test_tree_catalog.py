@@ -0,0 +1,62 @@
+import os
+import random
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.broker.index.persistent_btree import PersBTree
+from apps.broker.index.tree_catalog import PersBTreeCatalog
+from apps.broker.storage.storage_engine import DbRecordPointer
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestPersBTreeCatalog(unittest.TestCase):
+    def setUp(self):
+        self.file_path = ensure_file_not_exists_in_current_dir('catalog')
+
+    def tearDown(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def test_should_keep_named_trees_apart_in_one_file(self):
+        names = [f'topic-{i}' for i in range(300)]
+        with PersBTreeCatalog(self.file_path, 3, cache_pages=64) as catalog:
+            # given
+            keys = [i for i in range(200)]
+            random.shuffle(keys)
+
+            # when
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                for f in [executor.submit(lambda i: [catalog.tree(names[i]).insert(k, DbRecordPointer(k, i))
+                                                     for k in keys], i) for i in range(8)]:
+                    f.result()
+            for name in names[8:]:
+                catalog.tree(name).insert(1, DbRecordPointer(1, 1))
+            for k in keys[:100]:
+                catalog.tree('topic-0').delete(k)
+
+            # then
+            self.assertEqual([k for k, _ in catalog.tree('topic-0').find_range(0, 200)], sorted(keys[100:]))
+            self.assertEqual(catalog.tree('topic-3').find(150), DbRecordPointer(150, 3))
+            self.assertIs(catalog.tree('topic-3'), catalog.tree('topic-3'))
+            self.assertLessEqual(len(catalog._page_manager._cache), 64)
+
+        # and
+        with PersBTreeCatalog(self.file_path, 3) as catalog:
+            self.assertEqual(catalog.names(), sorted(names))
+            self.assertEqual(catalog.tree('topic-7').find_range(10, 12),
+                             [(k, DbRecordPointer(k, 7)) for k in range(10, 13)])
+            self.assertEqual(catalog.tree('topic-299').find(1), DbRecordPointer(1, 1))
+            free_pages = catalog._page_manager.free_pages_count()
+            for k in range(500):
+                catalog.tree('new').insert(k, DbRecordPointer(k, 0))
+            self.assertLess(catalog._page_manager.free_pages_count(), free_pages)
+
+    def test_should_not_open_a_single_tree_file_as_catalog(self):
+        # given
+        with PersBTree(self.file_path) as tree:
+            tree.insert(1, DbRecordPointer(1, 1))
+
+        # then
+        with self.assertRaises(ValueError):
+            with PersBTreeCatalog(self.file_path):
+                pass
@@ -0,0 +1,50 @@
+import os
+import unittest
+
+from apps.broker.index.persistent_data import BLOCK_SIZE_BYTES, PagePointer
+from apps.broker.index.write_ahead_log import WriteAheadLog
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.file_path = ensure_file_not_exists_in_current_dir('tree.wal')
+
+    def tearDown(self):
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def test_should_read_records_in_append_order(self):
+        # given
+        first = [(PagePointer(3), bytes([3]) * BLOCK_SIZE_BYTES), (PagePointer(0), bytes([0]) * BLOCK_SIZE_BYTES)]
+        second = [(PagePointer(3), bytes([4]) * BLOCK_SIZE_BYTES)]
+        log = WriteAheadLog(self.file_path)
+
+        # when
+        log.append(first)
+        log.append(second)
+        log.close()
+
+        # then
+        log = WriteAheadLog(self.file_path)
+        self.assertEqual(list(log.records()), [first, second])
+        log.truncate()
+        self.assertEqual(list(log.records()), [])
+        log.close()
+
+    def test_should_skip_torn_last_record(self):
+        # given
+        record = [(PagePointer(1), bytes([1]) * BLOCK_SIZE_BYTES)]
+        log = WriteAheadLog(self.file_path)
+        log.append(record)
+        log.append(record)
+        log.close()
+
+        # when
+        with open(self.file_path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.file_path) - 100)
+
+        # then
+        log = WriteAheadLog(self.file_path)
+        self.assertEqual(list(log.records()), [record])
+        log.close()
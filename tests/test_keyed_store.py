@@ -0,0 +1,60 @@
+import os
+import random
+import unittest
+
+from apps.broker.storage.keyed_store import KeyedStore
+from apps.broker.storage.storage_engine import DbRecord
+from tests.test_utils import ensure_file_not_exists_in_current_dir
+
+
+class TestKeyedStore(unittest.TestCase):
+    def setUp(self):
+        self.heap_file_path = ensure_file_not_exists_in_current_dir('keyed')
+        self.index_file_path = ensure_file_not_exists_in_current_dir('keyed.index')
+        ensure_file_not_exists_in_current_dir('keyed.index.dirty')
+
+    def tearDown(self):
+        for file_path in [self.heap_file_path, self.index_file_path, self.index_file_path + '.dirty']:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def test_should_find_latest_records_by_keys(self):
+        with KeyedStore(self.heap_file_path, max_keys=3) as store:
+            # given
+            keys = [f'key-{i:03d}' for i in range(300)]
+            random.shuffle(keys)
+
+            # when
+            for i in range(0, 300, 50):
+                store.append_records([DbRecord(k, 'old') for k in keys[i:i + 50]])
+            store.append_record(DbRecord('key-007', 'new'))
+            store.append_records([DbRecord('key-008', 'first'), DbRecord('key-008', 'second')])
+
+            # then
+            self.assertEqual(store.get('key-007'), DbRecord('key-007', 'new'))
+            self.assertEqual(store.get('key-008'), DbRecord('key-008', 'second'))
+            self.assertIsNone(store.get('key-300'))
+            self.assertTrue(store.exists('key-299'))
+            self.assertFalse(store.exists('key-300'))
+            self.assertEqual(store.range('key-006', 'key-009'), [DbRecord('key-006', 'old'), DbRecord('key-007', 'new'),
+                                                                 DbRecord('key-008', 'second'),
+                                                                 DbRecord('key-009', 'old')])
+            with self.assertRaises(ValueError):
+                store.append_record(DbRecord('key:1', 'data'))
+
+    def test_should_rebuild_index_from_heap_after_crash(self):
+        # given
+        store = KeyedStore(self.heap_file_path, max_keys=3).__enter__()
+        store.append_records([DbRecord(f'key-{i:03d}', str(i)) for i in range(100)])
+
+        # when
+        store._index.__exit__(None, None, None)  # crashed after the record was written to the heap only
+        store._engine.append_record(DbRecord('key-001', 'updated'))
+
+        # then
+        with KeyedStore(self.heap_file_path, max_keys=3) as recovered:
+            self.assertEqual(recovered.get('key-001'), DbRecord('key-001', 'updated'))
+            self.assertEqual(len(recovered.range('key-000', 'key-999')), 100)
+            recovered.rebuild_index()
+            self.assertEqual(recovered.get('key-099'), DbRecord('key-099', '99'))
+        self.assertFalse(os.path.exists(self.index_file_path + '.dirty'))